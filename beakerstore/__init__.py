@@ -1,2 +1,16 @@
 from .version import __version__
-from .beakerstore import BeakerOptions, path
+from .beakerstore import (BeakerOptions, enable_logging, list_files, memory_map, open_file, path,
+                          paths, sync, using, view)
+
+# open_file() is beakerstore.open(). It goes by another name where it is defined, so as not to
+# hide the builtin there.
+open = open_file
+
+
+def __getattr__(name):
+    # apath needs asyncio, which takes a while to import, so it is only imported when it is
+    # asked for
+    if name == 'apath':
+        from .aio import apath
+        return apath
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
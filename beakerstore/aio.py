@@ -0,0 +1,37 @@
+import asyncio
+import functools
+
+from pathlib import Path
+from typing import Optional, Sequence
+
+from .beakerstore import BeakerOptions, Cache, DownloadOptions, Revalidate, path
+
+
+# An asyncio version of beakerstore.path().
+#
+# This is not a non-blocking client. apath() runs path() in the running loop's default executor,
+# so that looking things up, downloading, hashing, and the cache's disk and sqlite work all happen
+# off the event loop's thread, with the same retries, token refreshes and locking as path(). The
+# files of a dataset are downloaded by path()'s own options.max_workers threads.
+#
+# So each call takes a thread of the default executor for as long as it runs, and how many run at
+# once is up to that executor's size. Each call also has its own session, connection pool and
+# download threads, and calls don't share one limit on concurrent downloads. To get many items
+# under one limit, await beakerstore.paths() run in an executor instead.
+
+
+async def apath(given_path: str,
+                which_beaker: BeakerOptions = BeakerOptions.PUBLIC,
+                cache: Optional[Cache] = None,
+                options: Optional[DownloadOptions] = None,
+                revalidate: Revalidate = Revalidate.NEVER,
+                ttl: float = 24 * 60 * 60,
+                include: Optional[Sequence[str]] = None,
+                exclude: Optional[Sequence[str]] = None) -> Path:
+    """A local path to the given dataset, or file within a dataset. See beakerstore.path().
+
+    This runs path() in a thread of the event loop's default executor. See above.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, functools.partial(
+        path, given_path, which_beaker, cache, options, revalidate, ttl, include, exclude))
@@ -1,22 +1,54 @@
 import atexit
+import base64
+import binascii
+import datetime
+import fcntl
+import fnmatch
+import hashlib
+import io
+import json
 import logging
+import mmap
 import os
 import platform
-import requests
+import queue
+import re
+import shutil
+import socket
+import sqlite3
 import tempfile
+import threading
 import time
 
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, ExitStack
 from enum import Enum
 from pathlib import Path
-from random import shuffle
-from typing import Optional, Set, Union
+from random import shuffle, uniform
+from typing import (TYPE_CHECKING, BinaryIO, Callable, Dict, Iterable, Iterator, List, Optional,
+                    Sequence, Set, Tuple, Union)
 
-from . import __version__
+from . import events
+
+if TYPE_CHECKING:
+    # requests is imported when it is needed, in http.py
+    import requests
 
 # Logging stuff
 
-logging.basicConfig(format='%(levelname)s %(name)s %(asctime)s  %(message)s', level=logging.INFO)
 _logger = logging.getLogger('beakerstore')
+_logger.addHandler(logging.NullHandler())
+
+
+def enable_logging(level: int = logging.INFO) -> None:
+    """Prints what beakerstore does to stderr.
+
+    Without this, beakerstore logs like any library, to whatever the application has set up.
+    """
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(levelname)s %(name)s %(asctime)s  %(message)s'))
+    _logger.addHandler(handler)
+    _logger.setLevel(level)
 
 
 # Cleanup stuff
@@ -29,7 +61,10 @@ def _cleanup_cleanup_files() -> None:
     global _cleanup_files
     for p in _cleanup_files:
         assert p.is_absolute()   # safety
-        p.unlink()
+        try:
+            p.unlink()
+        except FileNotFoundError:
+            pass
     _cleanup_files = set()
 
 
@@ -47,7 +82,21 @@ def forget_cleanup(p: Union[Path, str]) -> None:
     global _cleanup_files
     if type(p) is str:
         p = Path(p)
-    _cleanup_files.remove(p)
+    _cleanup_files.discard(p.absolute())
+
+
+def _write_atomically(target: Path, contents: str) -> None:
+    """Writes a small file such that readers see either the old or the new contents."""
+    if not target.parent.is_dir():
+        target.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_name = tempfile.mkstemp(dir=str(target.parent), prefix=f'.{target.name}', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(contents)
+        os.replace(tmp_name, str(target))
+    except BaseException:
+        os.unlink(tmp_name)
+        raise
 
 
 class BeakerOptions(Enum):
@@ -55,12 +104,861 @@ class BeakerOptions(Enum):
     PUBLIC = 'public'
 
 
+class LockBackend(Enum):
+    """How the processes sharing a cache make sure only one of them writes an entry at a time."""
+
+    # flock(2) on the lock file. Waiting is done by the OS, and the lock goes away with the
+    # process holding it.
+    FLOCK = 'flock'
+
+    # the lock file existing is the lock. For file systems where flock(2) can't be trusted.
+    # Locks left behind by processes that died are detected using the host name and process id
+    # recorded in the lock file.
+    FILE = 'file'
+
+
+class EvictionPolicy(Enum):
+    """Which entries go first when the cache is over its size limit."""
+
+    # the ones that were used least recently
+    LRU = 'lru'
+
+    # the ones that were used the fewest times, least recently used first among those
+    LFU = 'lfu'
+
+
+class Verification(Enum):
+    """How thoroughly files in the cache are checked."""
+
+    # they aren't
+    NONE = 'none'
+
+    # their sizes are checked
+    SIZE = 'size'
+
+    # their sizes and digests are checked
+    FULL = 'full'
+
+
+class Promotion(Enum):
+    """What happens when an entry is found in one of the read-only layers of a cache."""
+
+    # it is used from where it is. Files of a dataset that is being downloaded into the writable
+    # layer are symlinked there.
+    NONE = 'none'
+
+    # it is copied to the writable layer
+    COPY = 'copy'
+
+    # it is reflinked to the writable layer, or copied, if the file system can't do that
+    REFLINK = 'reflink'
+
+
+class Revalidate(Enum):
+    """When to check with Beaker before using an item that is already completely in the cache."""
+
+    # never, once an item is in the cache it is used as is
+    NEVER = 'never'
+
+    # every time the item is asked for
+    ALWAYS = 'always'
+
+    # when it has been more than a given number of seconds since the item was last checked
+    TTL = 'ttl'
+
+
+class DownloadOptions:
+    """Settings that control how items are downloaded."""
+    def __init__(self,
+                 max_workers: int = 8,
+                 max_connections_per_host: Optional[int] = None,
+                 segment_threshold: Optional[int] = 256 * 1024 * 1024,
+                 segment_size: int = 32 * 1024 * 1024,
+                 segment_workers: int = 4,
+                 timeout: float = 60.,
+                 max_retries: int = 5,
+                 backoff: float = 0.5,
+                 max_backoff: float = 30.,
+                 rate_limiter: Optional['RateLimiter'] = None,
+                 bandwidth_limiter: Optional['RateLimiter'] = None,
+                 mapped_writes: bool = False,
+                 write_buffers: int = 0,
+                 min_chunk_size: int = 64 * 1024,
+                 max_chunk_size: int = 4 * 1024 * 1024,
+                 preallocate: bool = False,
+                 fadvise: bool = False):
+
+        # how many files of a dataset are downloaded at the same time
+        self.max_workers = max_workers
+
+        # the most connections that are kept open to any one host. Defaults to one per worker.
+        self.max_connections_per_host = \
+            max_workers if max_connections_per_host is None else max_connections_per_host
+
+        # Files larger than this many bytes are downloaded in segments, several at the same
+        # time, each over its own connection. None turns this off.
+        self.segment_threshold = segment_threshold
+
+        # How many bytes are in each segment, and how many segments of a file are downloaded
+        # at the same time. A file only gets the connections past its first that 'max_workers'
+        # has to spare, given the other files being downloaded with these options, and gives
+        # them back as soon as those files need them.
+        self.segment_size = segment_size
+        self.segment_workers = segment_workers
+
+        # How many seconds to wait for a connection, or for the next bytes of a response, before
+        # giving up on a request.
+        self.timeout = timeout
+
+        # Requests that fail in a way that might not last (no connection, a timeout, a 429 or
+        # a 5xx response, or a download that breaks off) are tried again, up to this many times.
+        # The waits in between start at about 'backoff' seconds, and double each time, up to
+        # 'max_backoff'. A Retry-After header says how long to wait instead, unless it says to
+        # wait longer than 'max_backoff', in which case the request fails right away.
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        # if given, this limits how many requests are made, e.g. across all the processes on a node
+        self.rate_limiter = rate_limiter
+
+        # if given, this limits how many bytes are downloaded a second, its rate being in bytes
+        self.bandwidth_limiter = bandwidth_limiter
+
+        # Whether files that are downloaded from start to end (not in segments) are made full
+        # size up front, and read into from the network through a memory map of them, rather
+        # than written a chunk at a time. This is only done when the response says how large
+        # the file is.
+        self.mapped_writes = mapped_writes
+
+        # Otherwise, a file is read from the network into a buffer that is used over and over.
+        # With 'write_buffers' above 0, there are that many, and a thread of their own writes
+        # them to disk, so that a slow disk doesn't hold up the network. On a disk that keeps up,
+        # the hand-off only costs time, which is why it is off by default. How much is read at a
+        # time goes by how fast the bytes come, between 'min_chunk_size' and 'max_chunk_size'.
+        self.write_buffers = write_buffers
+        self.min_chunk_size = min_chunk_size
+        self.max_chunk_size = max_chunk_size
+
+        # Whether files are made full size before they are written to, when the response says
+        # how large they are, so that the file system can keep them in one piece.
+        self.preallocate = preallocate
+
+        # Whether to tell the OS that files are written from start to end, and won't be read
+        # again soon, so that what was written can go from the page cache as soon as it is on
+        # disk, rather than pushing out what is in use.
+        self.fadvise = fadvise
+
+        # how many connections the downloads using these options have open
+        self._connections = 0
+        self._connections_lock = threading.Lock()
+
+    def _open_connections(self, wanted: int, extra: bool = False) -> int:
+        """Counts 'wanted' more connections as open, and returns that. 'extra' ones are only
+        what 'max_workers' has to spare, so fewer might be."""
+        with self._connections_lock:
+            if extra:
+                wanted = max(0, min(wanted, self.max_workers - self._connections))
+            self._connections += wanted
+            return wanted
+
+    def _close_connections(self, num: int, if_over: bool = False) -> bool:
+        """Counts 'num' connections as closed. With 'if_over', only if more than 'max_workers'
+        are open. Returns whether they were."""
+        with self._connections_lock:
+            if if_over and self._connections <= self.max_workers:
+                return False
+            self._connections -= num
+            return True
+
+    def retry_delay(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        """How long to wait before trying again, after 'attempt' tries (counting from 0) failed."""
+        if retry_after is not None:
+            # A little more than asked for, so that everyone who was told the same thing doesn't
+            # try again at the same time.
+            retry_after = min(self.max_backoff, retry_after)
+            return uniform(retry_after, min(self.max_backoff, retry_after + self.backoff))
+
+        # Somewhere between half and all of the backoff, so that everyone who failed at the
+        # same time doesn't try again at the same time.
+        delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+        return uniform(delay / 2, delay)
+
+
+class RateLimiter:
+    """A token bucket, which allows 'rate' requests a second on average, in bursts of up to 'burst'.
+
+    What is counted needn't be requests: to limit bandwidth, acquire the number of bytes instead.
+
+    It is shared by all the threads that use it. Given a 'state_path', the bucket is kept in that
+    file, and so is shared with every process that uses the same file, e.g. all the processes on a
+    node that use the same cache. Tokens are then taken from the file at least 'batch' at a time
+    (by default, a twentieth of a second's worth), and handed out from here, so that the file
+    isn't locked for every chunk of a download.
+    """
+    def __init__(self,
+                 rate: float,
+                 burst: Optional[float] = None,
+                 state_path: Optional[Path] = None,
+                 batch: Optional[float] = None):
+        self.rate = rate
+        self.burst = max(1., rate) if burst is None else burst
+        self.state_path = state_path
+        self.batch = min(rate / 20, self.burst) if batch is None else batch
+
+        self._lock = threading.Lock()
+        self._tokens = self.burst
+        self._updated = time.time()
+
+        # tokens taken from the state file, and not handed out yet
+        self._reserve = 0.
+
+    def acquire(self, amount: float = 1.) -> None:
+        """Waits until a request may be made, or 'amount' of whatever is being limited used."""
+        while True:
+            wait = self._take(amount)
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    def _take(self, amount: float = 1.) -> float:
+        """Takes 'amount' tokens if there are enough. If not, returns how long until there will
+        be."""
+        with self._lock:
+            if self.state_path is None:
+                self._tokens, self._updated, wait = self._refill(self._tokens, self._updated,
+                                                                 amount)
+                return wait
+
+            if self._reserve >= amount:
+                self._reserve -= amount
+                return 0.
+            batch = max(amount - self._reserve, self.batch)
+
+            if not self.state_path.parent.is_dir():
+                self.state_path.parent.mkdir(parents=True, exist_ok=True)
+            fd = os.open(str(self.state_path), os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                try:
+                    state = json.loads(os.pread(fd, 1024, 0).decode('utf-8'))
+                    tokens, updated = state['tokens'], state['updated']
+                except (ValueError, KeyError):
+                    tokens, updated = self.burst, time.time()
+
+                tokens, updated, wait = self._refill(tokens, updated, batch)
+                state = json.dumps({'tokens': tokens, 'updated': updated}).encode('utf-8')
+                os.ftruncate(fd, 0)
+                os.pwrite(fd, state, 0)
+                if wait <= 0:
+                    self._reserve += batch - amount
+                return wait
+            finally:
+                os.close(fd)
+
+    def _refill(self, tokens: float, updated: float, amount: float) -> Tuple[float, float, float]:
+        now = time.time()
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+
+        # More than the bucket holds is let through once it is full, and the bucket goes into
+        # debt, so that whoever is next waits for it to be paid off.
+        needed = min(amount, self.burst)
+        if tokens >= needed:
+            return tokens - amount, now, 0.
+        return tokens, now, (needed - tokens) / self.rate
+
+
+class MetadataIndex:
+    """What the cache knows about datasets: their ids, storage details, and other names.
+
+    This lives in a SQLite database inside the cache, so that it is shared by all the processes
+    using the cache. Lookups are remembered in memory, until any process changes the database.
+    """
+
+    _open_indexes: Dict[Tuple[int, Path], 'MetadataIndex'] = {}
+    _open_indexes_lock = threading.Lock()
+
+    def __init__(self, db_path: Path):
+        if not db_path.parent.is_dir():
+            db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.db_path = db_path
+
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(str(db_path), timeout=60, check_same_thread=False,
+                                     isolation_level=None)
+        self._conn.executescript('''
+            CREATE TABLE IF NOT EXISTS datasets (
+                which TEXT NOT NULL,
+                id TEXT NOT NULL,
+                info TEXT NOT NULL,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (which, id)
+            );
+            CREATE TABLE IF NOT EXISTS aliases (
+                which TEXT NOT NULL,
+                alias TEXT NOT NULL,
+                dataset_id TEXT NOT NULL,
+                PRIMARY KEY (which, alias)
+            );
+
+            -- the ledger of complete cache entries, their sizes, and how they are used
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY,
+                dataset_key TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                last_access REAL NOT NULL,
+                access_count INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS entries_by_dataset ON entries (dataset_key);
+            CREATE INDEX IF NOT EXISTS entries_lru ON entries (last_access);
+            CREATE INDEX IF NOT EXISTS entries_lfu ON entries (access_count, last_access);
+
+            -- what files were like when they were downloaded, to check them against later
+            CREATE TABLE IF NOT EXISTS files (
+                key TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                blob_key TEXT,
+                recorded_at REAL NOT NULL
+            );
+
+            -- the manifests of datasets, a page at a time, as of when they were last gone through.
+            -- 'cursor' is what the page was asked for with.
+            CREATE TABLE IF NOT EXISTS manifest_pages (
+                which TEXT NOT NULL,
+                dataset_id TEXT NOT NULL,
+                page INTEGER NOT NULL,
+                cursor TEXT,
+                files TEXT NOT NULL,
+                fetched_at REAL NOT NULL,
+                PRIMARY KEY (which, dataset_id, page)
+            );
+
+            -- which processes are using which entries, so that no process evicts them. Each
+            -- process renews its leases every so often. See Cache.in_use().
+            CREATE TABLE IF NOT EXISTS leases (
+                key TEXT NOT NULL,
+                host TEXT NOT NULL,
+                pid INTEGER NOT NULL,
+                heartbeat REAL NOT NULL,
+                PRIMARY KEY (key, host, pid)
+            );
+
+            -- the total size of the entries, kept up to date so it never needs adding up
+            CREATE TABLE IF NOT EXISTS entries_total (id INTEGER PRIMARY KEY,
+                                                      size INTEGER NOT NULL);
+            INSERT OR IGNORE INTO entries_total VALUES (0, 0);
+            CREATE TRIGGER IF NOT EXISTS entries_insert AFTER INSERT ON entries BEGIN
+                UPDATE entries_total SET size = size + NEW.size;
+            END;
+            CREATE TRIGGER IF NOT EXISTS entries_delete AFTER DELETE ON entries BEGIN
+                UPDATE entries_total SET size = size - OLD.size;
+            END;
+            CREATE TRIGGER IF NOT EXISTS entries_update AFTER UPDATE OF size ON entries BEGIN
+                UPDATE entries_total SET size = size - OLD.size + NEW.size;
+            END;
+        ''')
+
+        self._memo: Dict[tuple, Optional[Union[str, dict]]] = {}
+        self._data_version: Optional[int] = None
+
+        # Accesses are written to the ledger in batches, so that using something from the cache
+        # doesn't mean a write to the database every time.
+        self._pending_accesses: Dict[str, Tuple[float, int]] = {}
+        self._last_access_flush = time.time()
+        atexit.register(self._flush_accesses_at_exit)
+
+    @classmethod
+    def for_path(cls, db_path: Path) -> 'MetadataIndex':
+        """The index at 'db_path', opened once per process and kept open."""
+
+        # connections can't be shared with a forked process, hence the pid
+        key = (os.getpid(), db_path)
+        with cls._open_indexes_lock:
+            if key not in cls._open_indexes:
+                cls._open_indexes[key] = MetadataIndex(db_path)
+            return cls._open_indexes[key]
+
+    def dataset_info(self, which_beaker: BeakerOptions, dataset_id: str) -> Optional[dict]:
+        """What Beaker said about this dataset, without any tokens."""
+        def query():
+            row = self._conn.execute('SELECT info FROM datasets WHERE which = ? AND id = ?',
+                                     (which_beaker.value, dataset_id)).fetchone()
+            return None if row is None else json.loads(row[0])
+
+        return self._remembered(('dataset', which_beaker.value, dataset_id), query)
+
+    def alias_target(self, which_beaker: BeakerOptions, alias: str) -> Optional[str]:
+        """The id of the dataset that goes by 'alias' (an author/name pair)."""
+        def query():
+            row = self._conn.execute('SELECT dataset_id FROM aliases WHERE which = ? AND alias = ?',
+                                     (which_beaker.value, alias)).fetchone()
+            return None if row is None else row[0]
+
+        return self._remembered(('alias', which_beaker.value, alias), query)
+
+    def record(self, which_beaker: BeakerOptions, identifier: str, beaker_info: dict) -> None:
+        """Remembers what Beaker said about the dataset it found for 'identifier'."""
+        dataset_id = beaker_info['id']
+        aliases = {identifier, _author_and_name(beaker_info)} - {dataset_id, None}
+
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                self._conn.execute('INSERT OR REPLACE INTO datasets VALUES (?, ?, ?, ?)',
+                                   (which_beaker.value, dataset_id,
+                                    json.dumps(_without_tokens(beaker_info)), time.time()))
+                self._conn.executemany('INSERT OR REPLACE INTO aliases VALUES (?, ?, ?)',
+                                       [(which_beaker.value, a, dataset_id) for a in aliases])
+                self._conn.execute('COMMIT')
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+            finally:
+                self._memo = {}
+
+    def forget_dataset(self, which_beaker: BeakerOptions, dataset_id: str) -> None:
+        """Forgets a dataset that no longer exists, along with its aliases."""
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                self._conn.execute('DELETE FROM datasets WHERE which = ? AND id = ?',
+                                   (which_beaker.value, dataset_id))
+                self._conn.execute('DELETE FROM aliases WHERE which = ? AND dataset_id = ?',
+                                   (which_beaker.value, dataset_id))
+                self._conn.execute('DELETE FROM manifest_pages WHERE which = ? AND dataset_id = ?',
+                                   (which_beaker.value, dataset_id))
+                self._conn.execute('COMMIT')
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+            finally:
+                self._memo = {}
+
+    def forget_alias(self, which_beaker: BeakerOptions, alias: str) -> None:
+        """Forgets an alias that no longer refers to the dataset it used to."""
+        with self._lock:
+            self._conn.execute('DELETE FROM aliases WHERE which = ? AND alias = ?',
+                               (which_beaker.value, alias))
+            self._memo = {}
+
+    def record_manifest(self,
+                        which_beaker: BeakerOptions,
+                        dataset_id: str,
+                        pages: List[Tuple[Optional[str], List[dict], float]]) -> None:
+        """Replaces the stored manifest of a dataset with one that was just gone through.
+
+        'pages' are (cursor, files, fetched at) tuples, in order.
+        """
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                self._conn.execute('DELETE FROM manifest_pages WHERE which = ? AND dataset_id = ?',
+                                   (which_beaker.value, dataset_id))
+                self._conn.executemany('INSERT INTO manifest_pages VALUES (?, ?, ?, ?, ?, ?)',
+                                       [(which_beaker.value, dataset_id, i, cursor,
+                                         json.dumps(files), fetched_at)
+                                        for i, (cursor, files, fetched_at) in enumerate(pages)])
+                self._conn.execute('COMMIT')
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+
+    def manifest(self, which_beaker: BeakerOptions, dataset_id: str) -> Optional[List[dict]]:
+        """The files in the stored manifest of a dataset, or None if there isn't one."""
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT files FROM manifest_pages WHERE which = ? AND dataset_id = ? ORDER BY page',
+                (which_beaker.value, dataset_id)).fetchall()
+        if not rows:
+            return None
+        return [f for row in rows for f in json.loads(row[0])]
+
+    def record_file(self, key: str, size: int, blob_key: Optional[str]) -> None:
+        """Records the size and digest (as a blob key) of a file that was just downloaded."""
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)',
+                               (key, size, blob_key, time.time()))
+
+    def file_record(self, key: str) -> Optional[Tuple[int, Optional[str]]]:
+        """The size and blob key recorded for a file, if any."""
+        with self._lock:
+            return self._conn.execute('SELECT size, blob_key FROM files WHERE key = ?',
+                                      (key,)).fetchone()
+
+    def file_records(self, key_prefix: str = '') -> List[Tuple[str, int, Optional[str]]]:
+        """The keys, sizes and blob keys recorded for files whose keys start with 'key_prefix'."""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT key, size, blob_key FROM files WHERE substr(key, 1, ?) = ? ORDER BY key",
+                (len(key_prefix), key_prefix)).fetchall()
+
+    def record_entry(self, key: str, dataset_key: str, size: int) -> None:
+        """Adds a complete cache entry to the ledger, or updates its size.
+
+        A dataset's entry covers all of its files, so recording a dataset takes the files that
+        were recorded on their own out of the ledger.
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                if key == dataset_key:
+                    self._conn.execute('DELETE FROM entries WHERE dataset_key = ? AND key != ?',
+                                       (dataset_key, key))
+                self._conn.execute('''
+                    INSERT INTO entries VALUES (?, ?, ?, ?, 1)
+                    ON CONFLICT (key) DO UPDATE SET
+                        size = excluded.size,
+                        last_access = excluded.last_access,
+                        access_count = access_count + 1
+                ''', (key, dataset_key, size, now))
+                self._conn.execute('COMMIT')
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+
+    def record_access(self, keys: List[str]) -> None:
+        """Notes that the entries with these keys (if they are in the ledger) were just used."""
+        now = time.time()
+        with self._lock:
+            for key in keys:
+                _, count = self._pending_accesses.get(key, (now, 0))
+                self._pending_accesses[key] = (now, count + 1)
+            if now - self._last_access_flush > 10 or len(self._pending_accesses) > 1000:
+                self.flush_accesses()
+
+    def flush_accesses(self) -> None:
+        with self._lock:
+            pending = self._pending_accesses
+            self._pending_accesses = {}
+            self._last_access_flush = time.time()
+            if not pending:
+                return
+            self._conn.executemany('''
+                UPDATE entries SET
+                    last_access = MAX(last_access, ?),
+                    access_count = access_count + ?
+                WHERE key = ?
+            ''', [(when, count, key) for key, (when, count) in pending.items()])
+
+    def _flush_accesses_at_exit(self) -> None:
+        try:
+            self.flush_accesses()
+        except sqlite3.Error as e:
+            _logger.warning(f'Unable to record the use of cache entries: {e}')
+
+    def total_size(self) -> int:
+        """The total size of the entries in the ledger, in bytes."""
+        with self._lock:
+            return self._conn.execute('SELECT size FROM entries_total').fetchone()[0]
+
+    def eviction_candidates(self, policy: EvictionPolicy, skip: int,
+                            limit: int) -> List[Tuple[str, int, float]]:
+        """The next entries to evict, as (key, size, last access) tuples.
+
+        This walks an index, so each call costs O(log n) plus the number of rows returned.
+        """
+        order = 'last_access' if policy == EvictionPolicy.LRU else 'access_count, last_access'
+        with self._lock:
+            self.flush_accesses()
+
+            # blobs go when the last entry that links to them does
+            return self._conn.execute(
+                f'SELECT key, size, last_access FROM entries WHERE substr(key, 1, 6) != ? '
+                f'ORDER BY {order} LIMIT ? OFFSET ?',
+                ('blobs/', limit, skip)).fetchall()
+
+    def remove_entry(self, key: str) -> None:
+        """Takes an entry, and for a dataset the entries for its files, out of the ledger."""
+        with self._lock:
+            self._pending_accesses.pop(key, None)
+            self._conn.execute('DELETE FROM entries WHERE key = ? OR dataset_key = ?', (key, key))
+            self._conn.execute('DELETE FROM leases WHERE key = ?', (key,))
+            self._conn.execute('DELETE FROM files WHERE key = ? OR substr(key, 1, ?) = ?',
+                               (key, len(key) + 1, f'{key}/'))
+
+    def take_leases(self, keys: List[str]) -> None:
+        """Notes that this process is using the entries with these keys."""
+        now = time.time()
+        with self._lock:
+            self._conn.executemany('INSERT OR REPLACE INTO leases VALUES (?, ?, ?, ?)',
+                                   [(key, socket.gethostname(), os.getpid(), now) for key in keys])
+
+    def release_leases(self, keys: List[str]) -> None:
+        """Notes that this process is done using the entries with these keys."""
+        with self._lock:
+            self._conn.executemany('DELETE FROM leases WHERE key = ? AND host = ? AND pid = ?',
+                                   [(key, socket.gethostname(), os.getpid()) for key in keys])
+
+    def renew_leases(self) -> None:
+        """Notes that this process is still using the entries it has leases on."""
+        with self._lock:
+            self._conn.execute('UPDATE leases SET heartbeat = ? WHERE host = ? AND pid = ?',
+                               (time.time(), socket.gethostname(), os.getpid()))
+
+    def leases(self, key: str) -> List[Tuple[str, int, float]]:
+        """The leases on the entry with this key, as (host, pid, last renewed) tuples."""
+        with self._lock:
+            return self._conn.execute('SELECT host, pid, heartbeat FROM leases WHERE key = ?',
+                                      (key,)).fetchall()
+
+    def _remembered(self, key: tuple, query):
+        with self._lock:
+
+            # data_version changes whenever another connection changes the database
+            data_version = self._conn.execute('PRAGMA data_version').fetchone()[0]
+            if data_version != self._data_version:
+                self._memo = {}
+                self._data_version = data_version
+
+            if key not in self._memo:
+                self._memo[key] = query()
+            return self._memo[key]
+
+
+def _disk_usage(p: Path, skip_linked: bool = False) -> int:
+    """The size of a file, or of all the files under a directory, in bytes.
+
+    With 'skip_linked', files that are hard linked from elsewhere, as the files of a content
+    addressed cache are from their blobs, aren't counted. Their blobs are.
+    """
+    def size(stat: os.stat_result) -> int:
+        return 0 if skip_linked and stat.st_nlink > 1 else stat.st_size
+
+    if p.is_file():
+        return size(p.stat())
+    total = 0
+    for root, _, files in os.walk(str(p)):
+        for f in files:
+            try:
+                total += size(os.lstat(os.path.join(root, f)))
+            except FileNotFoundError:
+                pass
+    return total
+
+
+def _author_and_name(beaker_info: dict) -> Optional[str]:
+    """The author/name pair that this dataset can be found by, if Beaker said what it is."""
+    author = beaker_info.get('author') or beaker_info.get('user') or {}
+    name = beaker_info.get('name')
+    if not isinstance(author, dict) or not author.get('name') or not name:
+        return None
+    return f'{author["name"]}/{name}'
+
+
+def _without_tokens(beaker_info: dict) -> dict:
+    """A copy of 'beaker_info' without the short-lived storage tokens."""
+    stripped = dict(beaker_info)
+    if isinstance(stripped.get('storage'), dict):
+        stripped['storage'] = {k: v for k, v in stripped['storage'].items()
+                               if 'token' not in k.lower()}
+    return stripped
+
+
+class CredentialCache:
+    """The storage details of datasets, tokens included, kept between calls until they expire.
+
+    With these, a dataset that was looked up once can be downloaded from without asking Beaker
+    about it again. When a token turns out to have been rejected, refresh() gets a new one. When
+    several threads find that out at once, one of them asks Beaker, and the others use what it
+    got.
+
+    There is one of these per process, or with a 'shared_path', one per file that it is kept in,
+    so that other processes can use the tokens too.
+    """
+
+    _instances: Dict[Optional[Path], 'CredentialCache'] = {}
+    _instances_lock = threading.Lock()
+
+    # how long tokens are taken to last, when Beaker doesn't say
+    default_lifetime = 60 * 60.
+
+    # tokens are not used in the last this many seconds before they expire
+    expiry_margin = 60.
+
+    def __init__(self, shared_path: Optional[Path] = None):
+        self.shared_path = shared_path
+
+        # (which beaker, dataset id) -> (storage details, when they expire)
+        self._storage: Dict[Tuple[str, str], Tuple[dict, float]] = {}
+        self._lock = threading.Lock()
+        self._refresh_locks: Dict[Tuple[str, str], threading.Lock] = {}
+
+    @classmethod
+    def for_path(cls, shared_path: Optional[Path] = None) -> 'CredentialCache':
+        with cls._instances_lock:
+            if shared_path not in cls._instances:
+                cls._instances[shared_path] = CredentialCache(shared_path)
+            return cls._instances[shared_path]
+
+    def get(self, which_beaker: BeakerOptions, dataset_id: str) -> Optional[dict]:
+        """The storage details of the dataset, if there are some that haven't expired."""
+        key = (which_beaker.value, dataset_id)
+        with self._lock:
+            found = self._storage.get(key)
+        if (found is None or not self._usable(found)) and self.shared_path is not None:
+            found = self._read_shared().get(key)
+            if found is not None:
+                with self._lock:
+                    self._storage[key] = found
+        return found[0] if found is not None and self._usable(found) else None
+
+    def put(self, which_beaker: BeakerOptions, dataset_id: str, storage: dict) -> None:
+        key = (which_beaker.value, dataset_id)
+        found = (storage, _token_expiry(storage))
+        with self._lock:
+            self._storage[key] = found
+        if self.shared_path is not None:
+            self._write_shared(key, found)
+
+    def refresh(self,
+                which_beaker: BeakerOptions,
+                dataset_id: str,
+                rejected: dict,
+                fetch: Callable[[], dict]) -> dict:
+        """New storage details for a dataset, in place of 'rejected'.
+
+        'fetch' asks Beaker for them, unless someone else already did since 'rejected' was
+        handed out.
+        """
+        key = (which_beaker.value, dataset_id)
+        with self._lock:
+            refresh_lock = self._refresh_locks.setdefault(key, threading.Lock())
+
+        with refresh_lock:
+            current = self.get(which_beaker, dataset_id)
+            if current is not None and current.get('token') != rejected.get('token'):
+                return current
+
+            storage = fetch()
+            self.put(which_beaker, dataset_id, storage)
+            return storage
+
+    def forget(self, which_beaker: BeakerOptions, dataset_id: str) -> None:
+        with self._lock:
+            self._storage.pop((which_beaker.value, dataset_id), None)
+
+    def _usable(self, found: Tuple[dict, float]) -> bool:
+        return found[1] - self.expiry_margin > time.time()
+
+    def _read_shared(self) -> Dict[Tuple[str, str], Tuple[dict, float]]:
+        try:
+            stored = json.loads(self.shared_path.read_text())
+        except (FileNotFoundError, ValueError):
+            return {}
+        return {tuple(k.split('/', 1)): (v['storage'], v['expires_at']) for k, v in stored.items()}
+
+    def _write_shared(self, key: Tuple[str, str], found: Tuple[dict, float]) -> None:
+        # Processes could write at the same time, and the last one wins. What the others wrote
+        # is then asked for again, which is no worse than not sharing it.
+        stored = {k: v for k, v in self._read_shared().items() if self._usable(v)}
+        stored[key] = found
+        contents = json.dumps({'/'.join(k): {'storage': v[0], 'expires_at': v[1]}
+                               for k, v in stored.items()})
+
+        if not self.shared_path.parent.is_dir():
+            self.shared_path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_name = tempfile.mkstemp(dir=str(self.shared_path.parent),
+                                        prefix=f'.{self.shared_path.name}', suffix='.tmp')
+        try:
+            # mkstemp makes the file readable by its owner only, as it should be for tokens
+            with os.fdopen(fd, 'w') as f:
+                f.write(contents)
+            os.replace(tmp_name, str(self.shared_path))
+        except BaseException:
+            os.unlink(tmp_name)
+            raise
+
+
+def _token_expiry(storage: dict) -> float:
+    """When the token in a dataset's storage details expires, going by what Beaker says."""
+    expires = storage.get('tokenExpires')
+    if isinstance(expires, str):
+        # before Python 3.11, fromisoformat() takes neither a 'Z' nor more than six digits of a
+        # second, and Beaker may send either
+        expires = re.sub(r'(\.\d{6})\d+', r'\1', expires.strip())
+        if expires[-1:] in ('Z', 'z'):
+            expires = expires[:-1] + '+00:00'
+        try:
+            expires_at = datetime.datetime.fromisoformat(expires)
+        except ValueError:
+            pass
+        else:
+            if expires_at.tzinfo is None:
+                expires_at = expires_at.replace(tzinfo=datetime.timezone.utc)
+            return expires_at.timestamp()
+    return time.time() + CredentialCache.default_lifetime
+
+
 class Cache:
-    def __init__(self, custom_path: Optional[Path] = None):
+    def __init__(self,
+                 custom_path: Optional[Path] = None,
+                 lock_backend: LockBackend = LockBackend.FLOCK,
+                 lock_timeout: Optional[float] = None,
+                 stale_lock_after: Optional[float] = None,
+                 max_bytes: Optional[int] = None,
+                 eviction_policy: EvictionPolicy = EvictionPolicy.LRU,
+                 eviction_grace: float = 60.,
+                 lease_timeout: float = 10 * 60.,
+                 content_addressed: bool = False,
+                 verify_on_read: Verification = Verification.NONE,
+                 layers: Sequence[Path] = (),
+                 promotion: Promotion = Promotion.NONE,
+                 share_credentials: bool = False):
         self.base_path = Cache._get_default_cache_base() if custom_path is None else custom_path
         if custom_path is not None:
             _logger.info(f'Cache at custom path: {custom_path}')
 
+        self.lock_backend = lock_backend
+
+        # how many seconds to wait for a lock before giving up. None means forever.
+        self.lock_timeout = lock_timeout
+
+        # With LockBackend.FILE, a lock held by a process on another host can't be checked on.
+        # It is considered abandoned once it hasn't been touched for this many seconds. The
+        # process holding it touches it four times as often. None means never.
+        self.stale_lock_after = stale_lock_after
+
+        # How many bytes the cache may hold. When there is more than that, entries are evicted
+        # according to the eviction policy. None means there is no limit.
+        self.max_bytes = max_bytes
+        self.eviction_policy = eviction_policy
+
+        # entries used less than this many seconds ago are left alone, since they may be in use
+        self.eviction_grace = eviction_grace
+
+        # Entries that a process holds with in_use() are leased to it in the index, so that no
+        # process evicts them. A lease held by a process on another host can't be checked on, so
+        # it is taken to be abandoned once it hasn't been renewed for this many seconds. The
+        # process holding it renews it four times as often.
+        self.lease_timeout = lease_timeout
+
+        # In content addressed mode, each file is stored once by its digest, under blobs_loc().
+        # The files of datasets are hard links to these (or reflinks, or copies, if that's not
+        # possible), so datasets that have files in common share them.
+        self.content_addressed = content_addressed
+
+        # How files that are already in the cache are checked before they are used. Files that
+        # fail are downloaded again.
+        self.verify_on_read = verify_on_read
+
+        # Read-only caches, e.g. on a shared file system, that are looked in (in order) for what
+        # isn't in this one. Nothing is ever written to them, or locked in them. What is found in
+        # them is promoted to this cache according to 'promotion'.
+        self.layers = tuple(layers)
+        self.promotion = promotion
+
+        # Whether the storage tokens of datasets are kept in the cache, readable only by you, for
+        # other processes to use. Otherwise, they are only kept for as long as this process runs.
+        self.share_credentials = share_credentials
+
+        self._in_use: Dict[str, int] = {}
+        self._in_use_lock = threading.Lock()
+        self._in_use_changed = threading.Condition(self._in_use_lock)
+        self._lease_thread: Optional[threading.Thread] = None
+        self._gc_thread: Optional[threading.Thread] = None
+        self._gc_stop = threading.Event()
+
     @staticmethod
     def _get_default_cache_base() -> Path:
 
@@ -81,13 +979,295 @@ class Cache:
                 raise ValueError(f'Unsupported platform: {platform.system()}')
 
         if not cache_loc_base.is_dir():
-            cache_loc_base.mkdir(parents=True)
+            cache_loc_base.mkdir(parents=True, exist_ok=True)
 
         return cache_loc_base
 
+    def spool_loc(self) -> Path:
+        """Where requests for the prefetch daemon wait to be picked up. See prefetch.py."""
+        return self.base_path / 'spool'
+
     def tmp_loc(self) -> Path:
         return self.base_path / 'tmp'
 
+    def packs_loc(self) -> Path:
+        """Where datasets are kept in packed form. See packs.py."""
+        return self.base_path / 'packs'
+
+    def meta_loc(self) -> Path:
+        """Where the cache keeps what it knows about its entries, e.g. completion markers."""
+        return self.base_path / 'meta'
+
+    def record_entry(self, cache_entry: 'CacheEntry') -> None:
+        """Adds a complete entry to the ledger that eviction works from."""
+        index = self.index()
+        if index is None:
+            return
+        dataset_key = cache_entry.dataset_cache_key()
+        size = _disk_usage(cache_entry.local_path(), skip_linked=self.content_addressed)
+        if cache_entry.is_dir():
+            size += _disk_usage(cache_entry.packs_path())
+        index.record_entry(cache_entry.cache_key(), dataset_key, size)
+
+    def record_blob(self, blob: Path) -> None:
+        """Adds a new blob to the ledger. The files that link to it aren't counted, so that its
+        bytes are counted once, however many datasets have it."""
+        index = self.index()
+        if index is not None:
+            key = self._blob_ledger_key(blob)
+            index.record_entry(key, key, blob.stat().st_size)
+
+    def _blob_ledger_key(self, blob: Path) -> str:
+        return blob.relative_to(self.base_path).as_posix()
+
+    def record_access(self, cache_entry: 'CacheEntry') -> None:
+        """Notes that an entry was used."""
+        index = self.index()
+        if index is not None:
+            index.record_access([cache_entry.cache_key(), cache_entry.dataset_cache_key()])
+
+    @contextmanager
+    def in_use(self, cache_entry: 'CacheEntry') -> Iterator[Path]:
+        """Keeps the entry (and its dataset) from being evicted, by any process, while in use."""
+        index = self.index()
+        keys = [cache_entry.cache_key(), cache_entry.dataset_cache_key()]
+        with self._in_use_lock:
+            new_keys = [key for key in keys if key not in self._in_use]
+            for key in keys:
+                self._in_use[key] = self._in_use.get(key, 0) + 1
+            if index is not None:
+                index.take_leases(new_keys)
+                if self._lease_thread is None:
+                    self._lease_thread = threading.Thread(target=self._renew_leases,
+                                                          name='beakerstore-leases', daemon=True)
+                    self._lease_thread.start()
+        try:
+            yield cache_entry.cache_path()
+        finally:
+            with self._in_use_lock:
+                done_keys = []
+                for key in keys:
+                    self._in_use[key] -= 1
+                    if self._in_use[key] == 0:
+                        del self._in_use[key]
+                        done_keys.append(key)
+                if index is not None:
+                    index.release_leases(done_keys)
+                self._in_use_changed.notify()
+
+    def _renew_leases(self) -> None:
+        """Renews the leases of the entries in use, for as long as there are any."""
+        index = self.index()
+        interval = self.lease_timeout / 4
+        with self._in_use_lock:
+            renew_at = time.time() + interval
+            while self._in_use:
+                self._in_use_changed.wait(max(0., renew_at - time.time()))
+                if self._in_use and time.time() >= renew_at:
+                    try:
+                        index.renew_leases()
+                    except sqlite3.Error as e:
+                        _logger.warning(f'Unable to renew the leases on cache entries: {e}')
+                    renew_at = time.time() + interval
+            self._lease_thread = None
+
+    def _leased(self, key: str) -> bool:
+        """Is the entry with this key in use by some process, going by its leases?"""
+        for host, pid, heartbeat in self.index().leases(key):
+            if host == socket.gethostname():
+                if _process_exists(pid):
+                    return True
+            elif time.time() - heartbeat < self.lease_timeout:
+                return True
+        return False
+
+    def gc(self, max_bytes: Optional[int] = None) -> int:
+        """Evicts entries until the cache holds at most 'max_bytes' (by default, its limit).
+
+        Entries that are locked, in use by any process, or were used within the eviction grace
+        period are skipped. Returns how many bytes were freed.
+        """
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        index = self.index()
+        if max_bytes is None or index is None:
+            return 0
+
+        freed = 0
+        skipped = 0
+        total = index.total_size()
+        while total > max_bytes:
+            candidates = index.eviction_candidates(self.eviction_policy, skipped, 16)
+            if not candidates:
+                _logger.warning(f'The cache is over its limit by {total - max_bytes} bytes, '
+                                f'but everything left in it is in use.')
+                break
+
+            for key, size, last_access in candidates:
+                if total <= max_bytes:
+                    break
+                evicted = self._evict(key, size, last_access)
+                if evicted is None:
+                    skipped += 1
+                else:
+                    freed += evicted
+                    total -= evicted
+
+        return freed
+
+    def start_background_gc(self, interval: float = 60.) -> None:
+        """Runs gc() every 'interval' seconds in a background thread, until stop_background_gc()."""
+        if self._gc_thread is not None:
+            return
+
+        def run():
+            while not self._gc_stop.wait(interval):
+                try:
+                    self.gc()
+                    if self.content_addressed:
+                        self.prune_blobs()
+                except Exception as e:
+                    _logger.warning(f'Unable to clean up the cache: {e}')
+
+        self._gc_stop.clear()
+        self._gc_thread = threading.Thread(target=run, name='beakerstore-gc', daemon=True)
+        self._gc_thread.start()
+
+    def stop_background_gc(self) -> None:
+        if self._gc_thread is None:
+            return
+        self._gc_stop.set()
+        self._gc_thread.join()
+        self._gc_thread = None
+
+    def _evict(self, key: str, size: int, last_access: float) -> Optional[int]:
+        """Removes an entry from the cache, unless it might be in use.
+
+        'size' is what the ledger says it takes up. Returns how many bytes were freed, counting
+        the blobs that nothing links to once it is gone, or None if it wasn't evicted.
+        """
+        if key in self._in_use or time.time() - last_access < self.eviction_grace or \
+                self._leased(key):
+            return None
+
+        cache_entry = CacheEntry.from_cache_key(key, self)
+        lock = CacheLock(cache_entry)
+        if not lock.try_lock():
+            return None
+
+        try:
+            _logger.info(f'Evicting {cache_entry.item_name()} from the cache.')
+            events.emit('eviction', key=key)
+
+            # the blobs of its files, which it may be the last to link to
+            blobs = set()
+            if self.content_addressed:
+                blobs = {self.blob_path(blob_key)
+                         for file_key, _, blob_key in self.index().file_records(key)
+                         if blob_key and (file_key == key or file_key.startswith(f'{key}/'))}
+
+            # The markers go first: without them, nothing takes the entry to be complete.
+            cache_entry.unmark_complete()
+            if cache_entry.is_dir():
+                shutil.rmtree(str(self.meta_loc() / key), ignore_errors=True)
+                shutil.rmtree(str(cache_entry.local_path()), ignore_errors=True)
+                shutil.rmtree(str(cache_entry.packs_path()), ignore_errors=True)
+            else:
+                dataset_entry = CacheEntry.from_cache_key(cache_entry.dataset_cache_key(), self)
+                dataset_entry.unmark_complete()
+                try:
+                    cache_entry.local_path().unlink()
+                except FileNotFoundError:
+                    pass
+
+            self.index().remove_entry(key)
+            return size + sum(self._remove_blob(blob) for blob in blobs)
+
+        finally:
+            lock.release_lock()
+
+    def verify(self,
+               cache_entry: Optional['CacheEntry'] = None,
+               verification: Verification = Verification.FULL,
+               max_workers: Optional[int] = None,
+               remove: bool = False) -> List[Path]:
+        """Checks files against what was recorded about them when they were downloaded.
+
+        This checks the files of 'cache_entry', or everything in the cache, several at a time.
+        (Hashing doesn't hold the GIL, so threads make use of all the cores.) Returns the paths of
+        the files that fail. With 'remove', these are removed, to be downloaded again.
+        """
+        index = self.index()
+        if index is None:
+            return []
+
+        if cache_entry is None:
+            records = index.file_records()
+        elif cache_entry.is_dir():
+            records = index.file_records(f'{cache_entry.cache_key()}/')
+        else:
+            records = [r for r in index.file_records(cache_entry.cache_key())
+                       if r[0] == cache_entry.cache_key()]
+
+        def check(record: Tuple[str, int, Optional[str]]) -> bool:
+            key, size, blob_key = record
+            return _matches_record(self.base_path / key, (size, blob_key), verification)
+
+        with ThreadPoolExecutor(max_workers=max_workers or os.cpu_count()) as executor:
+            failed = [record[0] for record, ok in zip(records, executor.map(check, records))
+                      if not ok]
+
+        if remove:
+            for key in failed:
+                CacheEntry.from_cache_key(key, self)._remove_corrupt()
+        return [self.base_path / key for key in failed]
+
+    def blobs_loc(self) -> Path:
+        return self.base_path / 'blobs'
+
+    def blob_path(self, blob_key: str) -> Path:
+        """Where the blob with the given key (e.g. 'sha256/abcd...') is stored."""
+        algorithm, value = blob_key.split('/', 1)
+        return self.blobs_loc() / algorithm / value[:2] / value
+
+    def prune_blobs(self) -> int:
+        """Removes the blobs that no dataset file links to anymore. Returns the bytes freed.
+
+        This goes through every blob, so it is not done by gc().
+        """
+        freed = 0
+        for root, _, files in os.walk(str(self.blobs_loc())):
+            for f in files:
+                freed += self._remove_blob(Path(root, f))
+        return freed
+
+    def _remove_blob(self, blob: Path) -> int:
+        """Removes a blob, and takes it out of the ledger, if nothing links to it anymore.
+        Returns the bytes freed."""
+        try:
+            stat = blob.stat()
+            if stat.st_nlink > 1:
+                return 0
+            blob.unlink()
+        except FileNotFoundError:
+            return 0
+        index = self.index()
+        if index is not None:
+            index.remove_entry(self._blob_ledger_key(blob))
+        return stat.st_size
+
+    def index(self) -> Optional[MetadataIndex]:
+        """The metadata index of this cache, if it can be used."""
+        try:
+            return MetadataIndex.for_path(self.meta_loc() / 'index.sqlite')
+        except (sqlite3.Error, OSError) as e:
+            _logger.warning(f'Unable to use the metadata index in {self.meta_loc()}: {e}')
+            return None
+
+    def credentials(self) -> CredentialCache:
+        """Where the storage tokens of datasets are kept between calls."""
+        return CredentialCache.for_path(self.meta_loc() / 'credentials.json'
+                                        if self.share_credentials else None)
+
     def cache_base(self) -> Path:
         return self.base_path
 
@@ -98,7 +1278,10 @@ class BeakerItem:
                  is_dir: bool,
                  beaker_info: dict,
                  file_name: Optional[str],
-                 which_beaker: BeakerOptions = BeakerOptions.PUBLIC):
+                 which_beaker: BeakerOptions = BeakerOptions.PUBLIC,
+                 credentials: Optional[CredentialCache] = None,
+                 index: Optional[MetadataIndex] = None,
+                 identifier: Optional[str] = None):
 
         # Note: this corresponds to whether the user wants a whole dataset, or just a file
         # within a dataset. This is different from the Beaker single-file dataset idea.
@@ -111,15 +1294,28 @@ class BeakerItem:
 
         self.which_beaker = which_beaker
 
+        # Where storage tokens come from. When beaker_info doesn't have one (e.g. it came from
+        # the metadata index), or it is rejected, a new one is gotten, and kept in these.
+        self.credentials = credentials
+
+        # What the given path started with, if the dataset it is for came from the index, or from
+        # 'credentials', rather than from Beaker. If Beaker turns out to say otherwise, what they
+        # said is forgotten, and StaleMetadataError raised, for the caller to look it up again.
+        self.index = index
+        self.identifier = identifier
+
     def dataset_id(self) -> str:
         return self.beaker_info['id']
 
-    def make_directory_manifest_request(self, sess: requests.Session, cursor: Optional[str]) -> requests.Response:
-        url = f'{self._get_file_heap_base_url()}/manifest'
+    def make_directory_manifest_request(self, sess: 'requests.Session',
+                                        cursor: Optional[str]) -> 'requests.Response':
         params = {'cursor': cursor} if cursor is not None else None
-        return self._make_fileheap_request(url, sess, params=params)
+        return self._make_fileheap_request('/manifest', sess, params=params)
 
-    def make_one_file_download_request(self, name: str, sess: requests.Session) -> requests.Response:
+    def make_one_file_download_request(self,
+                                       name: str,
+                                       sess: 'requests.Session',
+                                       headers: Optional[dict] = None) -> 'requests.Response':
 
         # name == self.file_name corresponds to the case where the user specified a file
         # within a dataset. is_dir is False, and this BeakerItem corresponds to one instance
@@ -131,22 +1327,98 @@ class BeakerItem:
         assert (name == self.file_name) or self.is_dir, \
             'Was expecting a directory BeakerItem or the same filename.'
 
-        url = f'{self._get_file_heap_base_url()}/files/{name}'
-        return self._make_fileheap_request(url, sess, stream=True)
+        return self._make_fileheap_request(f'/files/{name}', sess, stream=True, headers=headers)
+
+    def manifest_url(self) -> str:
+        return f'{self._get_file_heap_base_url()}/manifest'
+
+    def file_url(self, name: str) -> str:
+        return f'{self._get_file_heap_base_url()}/files/{name}'
+
+    def auth_headers(self) -> dict:
+        """The headers that fileheap requests need."""
+        return {'Authorization': f'Bearer {self._get_storage_token()}'}
 
     def _get_file_heap_base_url(self) -> str:
         return f'{self._get_storage_address()}/datasets/{self._get_storage_id()}'
 
     def _make_fileheap_request(self,
-                               url: str,
-                               sess: requests.Session,
+                               path: str,
+                               sess: 'requests.Session',
                                params: Optional[dict] = None,
-                               stream: bool = False) -> requests.Response:
-        headers = {
-            'Authorization': f'Bearer {self._get_storage_token()}'
-        }
+                               stream: bool = False,
+                               headers: Optional[dict] = None) -> 'requests.Response':
+        """Requests 'path', under the dataset's fileheap URL, getting a storage token if need be."""
+        storage = self.beaker_info.get('storage') or {}
+        if 'token' not in storage:
+            self._refresh_storage(sess, storage)
+            storage = self.beaker_info['storage']
+
+        res = sess.get(self._get_file_heap_base_url() + path,
+                       headers={**(headers or {}), **self.auth_headers()},
+                       params=params, stream=stream)
+        if res.status_code == 404 and self.identifier is not None:
+            # the dataset may be gone, without the index knowing yet
+            self._look_up(sess)
+        if res.status_code not in (401, 403) or self.credentials is None:
+            return res
+
+        # The token expired, or was revoked. This gets a new one, and tries again, once.
+        res.close()
+        self._refresh_storage(sess, storage)
+        return sess.get(self._get_file_heap_base_url() + path,
+                        headers={**(headers or {}), **self.auth_headers()},
+                        params=params, stream=stream)
+
+    def _refresh_storage(self, sess: 'requests.Session', rejected: dict) -> None:
+        """Replaces storage details that were rejected, or have no token, with new ones."""
+        def fetch() -> dict:
+            if 'token' in rejected:
+                _logger.info(f'The storage token of dataset {self.dataset_id()} was rejected. '
+                             f'Getting a new one.')
+                events.emit('retry', reason='token', item=self.dataset_id())
+            return self._look_up(sess)['storage']
+
+        if self.credentials is None:
+            storage = fetch()
+        else:
+            storage = self.credentials.refresh(self.which_beaker, self.dataset_id(), rejected,
+                                               fetch)
 
-        return sess.get(url, headers=headers, params=params, stream=stream)
+        # this is shared by the entries of all the files of the dataset, so they all get it
+        self.beaker_info = {**self.beaker_info, 'storage': storage}
+
+    def _look_up(self, sess: 'requests.Session') -> dict:
+        """What Beaker says about the dataset now.
+
+        If the dataset came from the index, and Beaker no longer has it, or it no longer goes by
+        the name it was asked for by, the index and credentials forget it, and this raises
+        StaleMetadataError.
+        """
+        item_request = ItemRequest(self.dataset_id(), self.which_beaker)
+        try:
+            beaker_info = item_request._get_dataset_details_helper(
+                self.dataset_id(), sess, credentials=self.credentials).beaker_info
+        except (DatasetNotFoundError, DatasetForbiddenError):
+            if self.identifier is None:
+                raise
+            if self.index is not None:
+                self.index.forget_dataset(self.which_beaker, self.dataset_id())
+            if self.credentials is not None:
+                self.credentials.forget(self.which_beaker, self.dataset_id())
+            raise StaleMetadataError(f'Dataset {self.dataset_id()}, which {self.identifier} '
+                                     f'was known to be, is no longer there.')
+
+        if self.identifier is not None and \
+                ItemRequest._was_renamed(self.identifier, self.dataset_id(), beaker_info):
+            if self.index is not None:
+                self.index.forget_alias(self.which_beaker, self.identifier)
+            raise StaleMetadataError(f'{self.identifier} is no longer dataset '
+                                     f'{self.dataset_id()}.')
+
+        if self.index is not None:
+            self.index.record(self.which_beaker, self.identifier, beaker_info)
+        return beaker_info
 
     def _get_storage_address(self) -> str:
         return self.beaker_info['storage']['address']
@@ -163,6 +1435,7 @@ class CacheEntry:
     def __init__(self, beaker_item: BeakerItem):
         self.beaker_item = beaker_item
         self.cache = None
+        self.options = None
 
     def which_beaker(self) -> BeakerOptions:
         return self.beaker_item.which_beaker
@@ -178,6 +1451,14 @@ class CacheEntry:
     def set_cache(self, cache: Cache):
         self.cache = cache
 
+    def get_options(self) -> DownloadOptions:
+        if self.options is None:
+            self.options = DownloadOptions()
+        return self.options
+
+    def set_options(self, options: DownloadOptions):
+        self.options = options
+
     def is_dir(self) -> bool:
         """Does this entry correspond to a dataset?
 
@@ -188,9 +1469,67 @@ class CacheEntry:
         raise NotImplementedError()
 
     def cache_path(self) -> Path:
-        """The path to this entry in the cache."""
+        """The path to this entry in the cache.
+
+        This is in the first read-only layer that has the entry, if it isn't in the writable one.
+        """
+        if not self.get_cache().layers or self._is_local():
+            return self.local_path()
+        layer_path = self.layer_path()
+        return self.local_path() if layer_path is None else layer_path
+
+    def local_path(self) -> Path:
+        """The path to this entry in the writable layer of the cache, whether it is there or not."""
         return self.cache_base() / self.cache_key()
 
+    def _is_local(self) -> bool:
+        """Is this entry in the writable layer of the cache?"""
+        raise NotImplementedError()
+
+    def layer_path(self) -> Optional[Path]:
+        """The path to this entry in the first read-only layer of the cache that has it, if any."""
+        raise NotImplementedError()
+
+    def _layer_marker_time(self) -> Optional[float]:
+        """When this entry was marked as complete in a read-only layer, if it is in one."""
+        raise NotImplementedError()
+
+    def resolve(self) -> Path:
+        """The path to use this complete entry from.
+
+        If the entry is only in a read-only layer, and the cache promotes what it finds there, it
+        is put in the writable layer first.
+        """
+        cache = self.get_cache()
+        if cache.promotion == Promotion.NONE or self._is_local():
+            return self.cache_path()
+
+        layer_path = self.layer_path()
+        if layer_path is None:
+            return self.local_path()
+
+        lock = CacheLock(self)
+        self._prepare_parent_dir()
+        lock.get_lock()
+        try:
+            if not self._is_local():
+                _logger.info(f'Promoting {self.item_name()} from {layer_path}.')
+                if layer_path.is_dir():
+                    for root, _, files in os.walk(str(layer_path)):
+                        for f in files:
+                            src = Path(root) / f
+                            target = self.local_path() / src.relative_to(layer_path)
+                            target.parent.mkdir(parents=True, exist_ok=True)
+                            _promote(src, target, cache.promotion)
+                else:
+                    _promote(layer_path, self.local_path(), cache.promotion)
+                self.mark_complete()
+                cache.record_entry(self)
+        finally:
+            lock.release_lock()
+
+        return self.local_path()
+
     def cache_base(self) -> Path:
         """The path to the root of the cache."""
         return self.get_cache().cache_base()
@@ -202,6 +1541,10 @@ class CacheEntry:
         """
         return f'{self.which_beaker().value}/{self.item_name()}'
 
+    def dataset_cache_key(self) -> str:
+        """The cache key of the dataset this entry is, or is part of."""
+        return f'{self.which_beaker().value}/{self.dataset_id()}'
+
     def item_name(self) -> str:
         """The name of the item corresponding to this entry.
 
@@ -210,14 +1553,60 @@ class CacheEntry:
         """
         raise NotImplementedError()
 
-    def download(self, sess: requests.Session) -> bool:
-        """Download the Beaker dataset or file to the corresponding cache location."""
+    def marker_path(self) -> Path:
+        """The path to the marker that says this entry was completely downloaded."""
+        return self.get_cache().meta_loc() / f'{self.cache_key()}.complete'
+
+    def mark_complete(self) -> None:
+        """Records that this entry was completely downloaded, and when."""
+        _write_atomically(self.marker_path(), json.dumps({'completed_at': time.time()}))
+
+    def unmark_complete(self) -> None:
+        try:
+            self.marker_path().unlink()
+        except FileNotFoundError:
+            pass
+
+    def is_complete(self, revalidate: Revalidate = Revalidate.NEVER, ttl: float = 0.) -> bool:
+        """Can this entry be used as is, without checking with Beaker?"""
+        if revalidate == Revalidate.ALWAYS:
+            return False
+        marker_time = self._marker_time()
+        if marker_time is None and self.get_cache().layers:
+            marker_time = self._layer_marker_time()
+        if marker_time is None:
+            return False
+        return revalidate == Revalidate.NEVER or time.time() - marker_time < ttl
+
+    def _marker_time(self) -> Optional[float]:
+        """When this entry was last marked as complete, if it ever was."""
+        try:
+            return self.marker_path().stat().st_mtime
+        except FileNotFoundError:
+            return None
+
+    def download(self, sess: 'requests.Session') -> int:
+        """Download the Beaker dataset or file to the corresponding cache location.
+
+        Returns the number of bytes that were downloaded.
+        """
         raise NotImplementedError()
 
     def _prepare_parent_dir(self):
-        parent_dir = self.cache_path().parent
+        parent_dir = self.local_path().parent
         if not parent_dir.is_dir():
-            parent_dir.mkdir(parents=True)
+            parent_dir.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def from_cache_key(key: str, cache: Cache) -> 'CacheEntry':
+        """The entry with the given cache key, e.g. 'public/ds_abc' or 'public/ds_abc/file.txt'."""
+        split = key.split('/', 2)
+        file_name = split[2] if len(split) > 2 else None
+        beaker_item = BeakerItem(file_name is None, {'id': split[1]}, file_name,
+                                 which_beaker=BeakerOptions(split[0]))
+        cache_entry = CacheEntry.from_beaker_item(beaker_item)
+        cache_entry.set_cache(cache)
+        return cache_entry
 
     @staticmethod
     def from_beaker_item(beaker_item: BeakerItem):
@@ -231,18 +1620,215 @@ class DirCacheEntry(CacheEntry):
     def __init__(self, beaker_item: BeakerItem):
         super().__init__(beaker_item)
 
+        # Glob patterns for which files of the dataset are wanted. None means all of them.
+        self.include: Optional[Tuple[str, ...]] = None
+        self.exclude: Tuple[str, ...] = ()
+
     def is_dir(self):
         return True
 
     def item_name(self) -> str:
         return self.dataset_id()
 
-    def download(self, sess: requests.Session) -> None:
+    def set_filters(self,
+                    include: Optional[Sequence[str]] = None,
+                    exclude: Optional[Sequence[str]] = None) -> None:
+        """Only the files whose names match one of 'include', and none of 'exclude', are wanted."""
+        self.include = None if include is None else tuple(sorted(set(include)))
+        self.exclude = tuple(sorted(set(exclude or ())))
+
+    def is_filtered(self) -> bool:
+        return self.include is not None or len(self.exclude) > 0
+
+    def _is_local(self) -> bool:
+        return self.marker_path().is_file() or self._subset_time() is not None
+
+    def _layer_marker(self) -> Optional[Path]:
+        for layer in self.get_cache().layers:
+            marker = layer / 'meta' / f'{self.cache_key()}.complete'
+            if marker.is_file() and (layer / self.cache_key()).is_dir():
+                return marker
+        return None
+
+    def layer_path(self) -> Optional[Path]:
+        marker = self._layer_marker()
+        return None if marker is None else marker.parents[2] / self.cache_key()
+
+    def _layer_marker_time(self) -> Optional[float]:
+        marker = self._layer_marker()
+        return None if marker is None else marker.stat().st_mtime
+
+    def wants(self, file_name: str) -> bool:
+        """Is the file with this name one of the files of the dataset that are wanted?"""
+        if self.include is not None and \
+                not any(fnmatch.fnmatchcase(file_name, p) for p in self.include):
+            return False
+        return not any(fnmatch.fnmatchcase(file_name, p) for p in self.exclude)
+
+    def subsets_path(self) -> Path:
+        """The path to the record of which filtered subsets of this dataset are complete."""
+        return self.get_cache().meta_loc() / f'{self.cache_key()}.subsets'
+
+    def _subsets(self) -> List[dict]:
+        try:
+            return json.loads(self.subsets_path().read_text())['subsets']
+        except (FileNotFoundError, ValueError, KeyError):
+            return []
 
-        done = False
-        cursor: Optional[str] = None
-        while not done:
+    def _filters(self) -> dict:
+        return {'include': None if self.include is None else list(self.include),
+                'exclude': list(self.exclude)}
+
+    def mark_complete(self) -> None:
+        if not self.is_filtered():
+            super().mark_complete()
+            return
+
+        # Whatever else is in the dataset might not be here, so this doesn't get the full marker.
+        filters = self._filters()
+        subsets = [s for s in self._subsets() if s['filters'] != filters]
+        subsets.append({'filters': filters, 'completed_at': time.time()})
+        _write_atomically(self.subsets_path(), json.dumps({'subsets': subsets}))
+
+    def unmark_complete(self) -> None:
+        super().unmark_complete()
+        for p in (self.subsets_path(), self.packed_marker_path()):
+            try:
+                p.unlink()
+            except FileNotFoundError:
+                pass
+
+    def packs_path(self) -> Path:
+        """Where this dataset is kept in packed form, if it is. See packs.py."""
+        return self.get_cache().packs_loc() / self.cache_key()
+
+    def packed_marker_path(self) -> Path:
+        """The path to the marker that says this dataset was completely packed."""
+        return self.get_cache().meta_loc() / f'{self.cache_key()}.packed'
+
+    def _subset_time(self) -> Optional[float]:
+        """When the subset of this dataset that its filters pick out was completed, if it was."""
+        if not self.is_filtered():
+            return None
+        filters = self._filters()
+        return next((s['completed_at'] for s in self._subsets() if s['filters'] == filters), None)
+
+    def _marker_time(self) -> Optional[float]:
+        marker_time = super()._marker_time()
+        if marker_time is None:
+            marker_time = self._subset_time()
+        if marker_time is None or not self.local_path().is_dir():
+            return None
+
+        cache = self.get_cache()
+        if cache.verify_on_read != Verification.NONE:
+            failed = cache.verify(self, cache.verify_on_read, remove=True)
+            if failed:
+                _logger.warning(f'{len(failed)} files of dataset {self.dataset_id()} failed '
+                                f'verification. Getting them again.')
+                return None
+
+        return marker_time
+
+    def download(self,
+                 sess: 'requests.Session',
+                 executor: Optional[ThreadPoolExecutor] = None,
+                 prune: bool = False) -> int:
+        """Downloads the files of this dataset, or the ones that pass its filters.
+
+        Files that are already in the cache are skipped, so getting more of a dataset than was
+        gotten before only downloads what is missing. Files that are different on Beaker than
+        they were the last time the manifest was gone through are downloaded again. With
+        'prune', files that the dataset no longer has are removed from the cache.
+
+        The files are downloaded by 'executor' if one is given, which is how several datasets
+        share one limit on concurrent downloads. Otherwise, this makes its own.
+        """
+
+        start = time.time()
+        own_executor = executor is None
+        if own_executor:
+            executor = ThreadPoolExecutor(max_workers=self.get_options().max_workers)
+        futures = []
+        previous = {f['path']: f for f in self.manifest() or ()}
+        pages = []
 
+        try:
+            for page in self._manifest_pages(sess):
+                pages.append(page)
+                items_with_details = self._files_to_get(page[1], previous)
+
+                # not totally necessary but it does mean that if you're running two of this at the
+                # same time on the same dataset, they may work on downloading different files
+                # (instead of going through the files in the same order, one downloading the current
+                # file, the other waiting on the lock)
+                shuffle(items_with_details)
+
+                # The files on this page start downloading while we go get the next page. Files
+                # that someone else is downloading are skipped for now.
+                futures.extend((item, executor.submit(item.download, sess, False))
+                               for item in items_with_details)
+
+            num_files = len(futures)
+
+            # this raises the first error encountered by any of the downloads, if there was one
+            total_bytes = 0
+            deferred = []
+            for item, future in futures:
+                written = future.result()
+                if written is None:
+                    deferred.append(item)
+                else:
+                    total_bytes += written
+
+            # Only now wait for whoever is downloading the rest. Since this wasn't holding threads
+            # waiting on them, it could get other files in the meantime.
+            if deferred:
+                _logger.info(f'Waiting on {len(deferred)} files of dataset {self.dataset_id()} '
+                             f'that someone else is downloading.')
+                futures = [(item, executor.submit(item.download, sess)) for item in deferred]
+                total_bytes += sum(future.result() for _, future in futures)
+
+            # Only once every file is in place does the manifest say what is in the cache.
+            self._record_manifest(pages)
+            if prune:
+                self._prune(pages)
+
+        except BaseException:
+            for _, future in futures:
+                future.cancel()
+            raise
+
+        finally:
+            if own_executor:
+                executor.shutdown(wait=True)
+
+        self._log_throughput(num_files, total_bytes, time.time() - start)
+        events.emit('dataset_download', dataset=self.dataset_id(), files=num_files,
+                    bytes=total_bytes, seconds=time.time() - start)
+        return total_bytes
+
+    def manifest(self) -> Optional[List[dict]]:
+        """The files of this dataset as of the last time its manifest was gone through, if it was.
+
+        Each is a dict like {'path': 'a.txt', 'size': 12, 'digest': 'SHA256 ...'}, as Beaker has it.
+        """
+        index = self.get_cache().index()
+        return None if index is None else index.manifest(self.which_beaker(), self.dataset_id())
+
+    def fetch_manifest(self, sess: 'requests.Session') -> List[dict]:
+        """Goes through the manifest of this dataset on Beaker, and stores it. Returns its files."""
+        pages = list(self._manifest_pages(sess))
+        self._record_manifest(pages)
+        return [f for _, files, _ in pages for f in files]
+
+    def _manifest_pages(self, sess: 'requests.Session'
+                        ) -> Iterator[Tuple[Optional[str], List[dict], float]]:
+        """The pages of the manifest of this dataset on Beaker, as (cursor, files, fetched at)
+        tuples."""
+        cursor: Optional[str] = None
+        while True:
+            page_start = time.time()
             dir_res = self.beaker_item.make_directory_manifest_request(sess, cursor)
 
             if not dir_res.status_code == 200:
@@ -251,144 +1837,1550 @@ class DirCacheEntry(CacheEntry):
                      f'Response code: {dir_res.status_code}.'))
 
             json_dir_res = dir_res.json()
-            file_names = list(map(lambda f: f['path'], json_dir_res['files']))
-            items_with_details = list(map(lambda file_name: self.dir_to_file(file_name), file_names))
-
-            # not totally necessary but it does mean that if you're running two of this at the same
-            # time on the same dataset, they may work on downloading different files (instead of going
-            # through the files in the same order, one downloading the current file, the other
-            # waiting on the lock)
-            shuffle(items_with_details)
-            for item in items_with_details:
-                item.download(sess)
-
-            cursor_key = 'cursor'
-            if cursor_key in json_dir_res:
-                cursor = json_dir_res[cursor_key]
-            else:
-                cursor = None
+            events.emit('manifest_page', dataset=self.dataset_id(),
+                        files=len(json_dir_res['files']), seconds=time.time() - page_start)
+            yield cursor, json_dir_res['files'], page_start
+
+            cursor = json_dir_res.get('cursor')
+            if cursor is None:
+                return
+
+    def _record_manifest(self, pages: List[Tuple[Optional[str], List[dict], float]]) -> None:
+        index = self.get_cache().index()
+        if index is not None:
+            index.record_manifest(self.which_beaker(), self.dataset_id(), pages)
 
-            done = cursor is None
+    def _files_to_get(self, files: List[dict], previous: Dict[str, dict]) -> List['FileCacheEntry']:
+        """The entries for the wanted files of a manifest page.
 
-    def dir_to_file(self, file_name: str):
+        'previous' is the stored manifest, by path. The files that changed since then are taken
+        out of the cache, wanted or not, since the whole page is recorded as the manifest after
+        this. The wanted ones are downloaded again.
+        """
+        entries = []
+        for f in files:
+            entry = self.dir_to_file(f['path'], f.get('size'), f.get('digest'))
+            if _manifest_changed(previous.get(f['path']), f):
+                # this also drops the markers that say the dataset, or a subset of it, is complete
+                _logger.info(f'{entry.file_name} of dataset {self.dataset_id()} changed on Beaker.')
+                entry._remove_outdated()
+            if self.wants(f['path']):
+                entries.append(entry)
+        return entries
+
+    def _prune(self, pages: List[Tuple[Optional[str], List[dict], float]]) -> int:
+        """Removes the files in the cache that aren't in the manifest anymore. Returns how many.
+
+        Files whose lock is held are left alone, along with the temporary files next to them.
+        Lock files are left to whoever holds them.
+        """
+        current = {f['path'] for _, files, _ in pages for f in files}
+        local_path = self.local_path()
+        removed = 0
+        for root, _, file_names in os.walk(str(local_path)):
+            for file_name in file_names:
+                name = Path(root, file_name).relative_to(local_path).as_posix()
+                if name in current or name.endswith('.lock'):
+                    continue
+
+                # e.g. .file.txt.1234.5678.tmp, which _materialize() puts file.txt together in
+                tmp_match = re.match(r'\.(.+)\.\d+\.\d+\.tmp$', file_name)
+                owner = name if tmp_match is None else \
+                    Path(root, tmp_match.group(1)).relative_to(local_path).as_posix()
+
+                file_entry = self.dir_to_file(owner)
+                lock = CacheLock(file_entry)
+                if not lock.try_lock():
+                    continue
+                try:
+                    if tmp_match is None:
+                        file_entry._remove_outdated()
+                    else:
+                        Path(root, file_name).unlink(missing_ok=True)
+                finally:
+                    lock.release_lock()
+                removed += 1
+        if removed > 0:
+            _logger.info(f'Removed {removed} files that dataset {self.dataset_id()} no longer has.')
+        return removed
+
+    def _log_throughput(self, num_files: int, num_bytes: int, seconds: float) -> None:
+        if num_bytes == 0:
+            return
+        mib = num_bytes / (1024 * 1024)
+        rate = mib / seconds if seconds > 0 else float('inf')
+        _logger.info((f'Downloaded {mib:.1f}MiB of dataset {self.dataset_id()} ({num_files} files) '
+                      f'in {seconds:.1f} seconds ({rate:.1f}MiB/s).'))
+
+    def dir_to_file(self, file_name: str, size: Optional[int] = None, digest: Optional[str] = None):
         """Makes an instance of FileCacheEntry from this instance of DirCacheEntry.
 
         The resulting entry corresponds to the file with filename 'file_name' within the dataset
-        that corresponds to this current entry.
+        that corresponds to this current entry. 'size' and 'digest' are what the dataset manifest
+        says about the file, if anything.
         """
-        entry = FileCacheEntry(self.beaker_item, file_name)
+        entry = FileCacheEntry(self.beaker_item, file_name, size=size, digest=digest)
         entry.set_cache(self.cache)
+        entry.set_options(self.options)
         return entry
 
 
 class FileCacheEntry(CacheEntry):
-    def __init__(self, beaker_item: BeakerItem, file_name: str):
+    def __init__(self,
+                 beaker_item: BeakerItem,
+                 file_name: str,
+                 size: Optional[int] = None,
+                 digest: Optional[str] = None):
         super().__init__(beaker_item)
         self.file_name = file_name
 
+        # the size of the file in bytes, and its digest, if the dataset manifest said what they are
+        self.size = size
+        self.digest = digest
+
+        # the blob key of the file's contents, if they were hashed while being downloaded
+        self.computed_blob_key: Optional[str] = None
+
     def is_dir(self):
         return False
 
     def item_name(self) -> str:
         return f'{self.dataset_id()}/{self.file_name}'
 
-    def already_exists(self) -> bool:
-        """Does this entry already exist in the cache?"""
-        return self.cache_path().is_file()
+    def _is_local(self) -> bool:
+        return self.local_path().is_file()
 
-    def download(self, sess: requests.Session) -> None:
+    def layer_path(self) -> Optional[Path]:
+        # Files only show up in a cache once they are completely downloaded.
+        for layer in self.get_cache().layers:
+            layer_path = layer / self.cache_key()
+            if layer_path.is_file():
+                return layer_path
+        return None
 
-        if self.already_exists():
-            return
+    def _layer_marker_time(self) -> Optional[float]:
+        layer_path = self.layer_path()
+        return None if layer_path is None else layer_path.stat().st_mtime
+
+    def already_exists(self, verify: bool = True) -> bool:
+        """Does this entry already exist in the cache?
+
+        If the cache verifies files on read, a file that fails is removed, and doesn't count.
+        """
+        if not self.local_path().is_file():
+            # A file asked for by itself can be used from a read-only layer. The files of a
+            # dataset need to be in the writable layer with the rest of the dataset.
+            return not self.beaker_item.is_dir and self.layer_path() is not None
+
+        verification = self.get_cache().verify_on_read
+        if not verify or verification == Verification.NONE:
+            return True
 
-        _logger.info(f'Getting {self.file_name} of dataset {self.dataset_id()}.')
+        if self.verify(verification):
+            return True
 
-        res = self.beaker_item.make_one_file_download_request(self.file_name, sess)
+        _logger.warning(f'{self.file_name} of dataset {self.dataset_id()} failed verification. '
+                        f'Getting it again.')
+        self._remove_corrupt()
+        return False
+
+    def _remove_corrupt(self) -> None:
+        """Removes this file, and with it the markers that say it (or its dataset) is complete."""
+        self.unmark_complete()
+        CacheEntry.from_cache_key(self.dataset_cache_key(), self.get_cache()).unmark_complete()
+        try:
+            self.local_path().unlink()
+        except FileNotFoundError:
+            pass
+
+    def _remove_outdated(self) -> None:
+        """Removes this file, which is no longer what the dataset has under its name, if
+        anything."""
+        self._remove_corrupt()
+        index = self.get_cache().index()
+        if index is not None:
+            index.remove_entry(self.cache_key())
+
+    def _marker_time(self) -> Optional[float]:
+
+        # a file is also complete if the whole dataset it is part of is
+        marker_time = super()._marker_time()
+        if marker_time is None:
+            dataset_entry = DirCacheEntry(self.beaker_item)
+            dataset_entry.set_cache(self.cache)
+            marker_time = CacheEntry._marker_time(dataset_entry)
+
+        if marker_time is None or not self.already_exists():
+            return None
+        return marker_time
+
+    def download(self, sess: 'requests.Session', wait: bool = True) -> Optional[int]:
+        """Downloads this file, unless it is in the cache already.
+
+        The lock for the file is taken before anything is requested, so that no more than one
+        process ever downloads it. If someone else has the lock, this waits for them to be done,
+        unless 'wait' is False, in which case it returns None straight away.
+        """
 
-        if not res.status_code == 200:
-            raise BeakerstoreError((f'Unable to get the requested file. '
-                                    f'Response code: {res.status_code}.'))
+        if self.already_exists():
+            return 0
 
         self._prepare_parent_dir()
 
         lock = CacheLock(self)
-        lock.get_lock()
+        if wait:
+            lock.get_lock()
+        elif not lock.try_lock():
+            return None
+
+        try:
+            if self._in_place_without_download():
+                return 0
+
+            _logger.info(f'Getting {self.file_name} of dataset {self.dataset_id()}.')
+            return self._download_with_resume(sess)
+
+        finally:
+            lock.release_lock()
+
+    def memory_map(self) -> mmap.mmap:
+        """A read-only memory map of this file, which must be in the cache. See memory_map()."""
+        return _map_read_only(self.resolve())
+
+    def _in_place_without_download(self) -> bool:
+        """Is this file in place, or can it be put there without downloading it?
+
+        Only call this while holding the lock for this entry.
+        """
 
         # If something else downloaded this in the meantime, no need to do it once more.
-        if not self.already_exists():
-            self._write_file_from_response(res)
+        if self.already_exists():
+            return True
+
+        # Nor if some other dataset has the same file, or a read-only layer has it.
+        return self._link_from_blob() or self._link_from_layer()
+
+    def _link_from_layer(self) -> bool:
+        """Puts this file in place from a read-only layer, if one has it. Returns whether it did."""
+        layer_path = self.layer_path()
+        if layer_path is None:
+            return False
+        _promote(layer_path, self.local_path(), self.get_cache().promotion)
+        return True
+
+    def blob_key(self) -> Optional[str]:
+        """The key of the blob with this file's contents, if it is known without hashing it."""
+        if self.digest is not None:
+            blob_key = _blob_key(self.digest)
+            if blob_key is not None:
+                return blob_key
+        return self.computed_blob_key
+
+    def _link_from_blob(self) -> bool:
+        """Puts this file in place from the blob store, if it is there. Returns whether it was."""
+        blob_key = self.blob_key()
+        if not self.get_cache().content_addressed or blob_key is None:
+            return False
+
+        blob = self.get_cache().blob_path(blob_key)
+        if not blob.is_file():
+            return False
+
+        _materialize(blob, self.local_path())
+
+        # so that what is evicted along with it is known
+        self._record_integrity()
+        return True
+
+    def _store_as_blob(self) -> None:
+        """Moves the contents of this (just downloaded) file into the blob store."""
+        blob_key = self.blob_key()
+        if blob_key is None:
+            blob_key = f'sha256/{_hash_file(self.local_path(), hashlib.sha256())}'
+
+        blob = self.get_cache().blob_path(blob_key)
+        if not blob.parent.is_dir():
+            blob.parent.mkdir(parents=True, exist_ok=True)
+
+        try:
+            os.link(str(self.local_path()), str(blob))
+            self.get_cache().record_blob(blob)
+        except FileExistsError:
+            # someone else got the same contents in the meantime, so use theirs
+            _materialize(blob, self.local_path())
+        except OSError as e:
+            _logger.warning(f'Unable to add {self.file_name} to the blob store: {e}')
 
-        lock.release_lock()
+    def _download_with_resume(self, sess: 'requests.Session') -> int:
+        """Downloads this file, picking up from an earlier attempt if there was one.
 
-    def _write_file_from_response(self, res: requests.Response) -> None:
+        Only call this while holding the lock for this entry.
+        """
+        from .http import TRANSIENT_ERRORS
+
+        start = time.time()
+        partial = self.partial_download()
+        resumed_from = partial.size()
+        self.computed_blob_key = None
+
+        options = self.get_options()
+        threshold = options.segment_threshold
+        segmented = threshold is not None and (self.size is None or self.size > threshold)
+
+        # If the download breaks off, it carries on from where it got to.
+        written = 0
+        attempt = 0
+        options._open_connections(1)
+        try:
+            while True:
+                try:
+                    if segmented:
+                        first = self._request_first_segment(sess, partial)
+                        if first.status_code == 206 and _content_range_total(first) is not None:
+                            written += self._download_in_segments(sess, partial, first)
+                            break
+
+                        # the server doesn't do ranges, so it sent all of the file instead
+                        segmented = False
+                        written += self._download_sequentially(sess, partial, first)
+                    else:
+                        written += self._download_sequentially(sess, partial)
+                    break
+                except TRANSIENT_ERRORS as e:
+                    if attempt >= options.max_retries:
+                        raise
+                    delay = options.retry_delay(attempt)
+                    _logger.info(f'Getting {self.file_name} of dataset {self.dataset_id()} '
+                                 f'broke off ({type(e).__name__}). Carrying on in {delay:.1f} '
+                                 f'seconds.')
+                    events.emit('retry', reason='interrupted', item=self.item_name())
+                    time.sleep(delay)
+                    attempt += 1
+        finally:
+            options._close_connections(1)
+
+        self._commit_download(partial)
+        events.emit('file_download', dataset=self.dataset_id(), file=self.file_name, bytes=written,
+                    seconds=time.time() - start, resumed_from=resumed_from, segmented=segmented)
+        return written
+
+    def _commit_download(self, partial: 'PartialDownload') -> None:
+        """Checks the downloaded file, and puts it in the right place."""
+        self._check_integrity(partial)
+        partial.commit(self.local_path())
+        self._record_integrity()
+
+        if self.get_cache().content_addressed:
+            self._store_as_blob()
+
+    def _download_sequentially(self, sess: 'requests.Session', partial: 'PartialDownload',
+                               res: Optional['requests.Response'] = None) -> int:
+        """Downloads this file from start to end, or from where an earlier attempt got to.
+
+        'res' is a response that was already gotten for the file, if there is one.
+        """
+        if res is None:
+            res = self.beaker_item.make_one_file_download_request(
+                self.file_name, sess, headers=partial.resume_headers())
+
+        if res.status_code == 416:
+            # What we have doesn't fit the file as it is now. Start over.
+            events.emit('retry', reason='range_not_satisfiable', item=self.item_name())
+            res.close()
+            partial.discard()
+            res = self.beaker_item.make_one_file_download_request(self.file_name, sess)
+
+        try:
+            options = self.get_options()
+            full_size = _full_size(res)
+            mapped = bool(full_size) and (options.mapped_writes or options.preallocate)
+            offset = partial.start_from(res, mapped=mapped)
+
+            # The digest is worked out on the way, so the file doesn't need reading again. If this
+            # carries on from an earlier attempt, what came before is hashed first.
+            algorithm = self._digest_algorithm()
+            hasher = None if algorithm is None else hashlib.new(algorithm)
+            if hasher is not None and offset > 0:
+                _hash_file(partial.path, hasher, limit=offset)
+
+            if mapped and options.mapped_writes:
+                written = self._write_mapped(res, partial, offset, full_size, hasher)
+            elif _body_is_file(res):
+                written = self._write_buffered(res, partial, offset, full_size, hasher)
+            else:
+                written = 0
+                with partial.path.open('r+b' if offset > 0 else 'wb') as f:
+                    f.seek(offset)
+                    try:
+                        written = self._write_file_from_response(res, f, hasher)
+                    finally:
+                        partial.record(offset + written)
+
+            # what was received so far stays, for the next attempt to carry on from
+            _check_received(res, written)
+        finally:
+            res.close()
+
+        if hasher is not None:
+            self.computed_blob_key = f'{algorithm}/{hasher.hexdigest()}'
+        return written
+
+    def _digest_algorithm(self) -> Optional[str]:
+        """Which hash of this file is needed, if any: to check it, or to store it by."""
+        expected = None if self.digest is None else _blob_key(self.digest)
+        if expected is not None:
+            return expected.split('/', 1)[0]
+        if self.get_cache().content_addressed:
+            return 'sha256'
+        return None
+
+    def _check_integrity(self, partial: 'PartialDownload') -> None:
+        """Makes sure that what was downloaded is what the dataset manifest says it should be."""
+        problem = None
+        size = partial.size()
+
+        # if the manifest doesn't say how large the file is, the response it came in might have
+        expected_size = self.size if self.size is not None else partial.sidecar().get('size')
+        if expected_size is not None and size != expected_size:
+            problem = f'Expected {expected_size} bytes, got {size}.'
+
+        expected = None if self.digest is None else _blob_key(self.digest)
+        if problem is None and expected is not None:
+            if self.computed_blob_key is None:
+                # this was downloaded out of order, so it wasn't hashed on the way
+                algorithm = expected.split('/', 1)[0]
+                digest = _hash_file(partial.path, hashlib.new(algorithm))
+                self.computed_blob_key = f'{algorithm}/{digest}'
+            if self.computed_blob_key != expected:
+                problem = f'Expected digest {self.digest}, got {self.computed_blob_key}.'
+
+        if problem is not None:
+            events.emit('integrity_failure', item=self.item_name(), problem=problem)
+            partial.discard()
+            raise IntegrityError(f'{self.file_name} of dataset {self.dataset_id()} is not right. '
+                                 f'{problem}')
+
+    def _record_integrity(self) -> None:
+        index = self.get_cache().index()
+        if index is not None:
+            index.record_file(self.cache_key(), self.local_path().stat().st_size, self.blob_key())
+
+    def verify(self, verification: 'Verification' = None) -> bool:
+        """Checks this file in the cache against what was recorded when it was downloaded.
+
+        Files that nothing was recorded for pass, as long as they exist.
+        """
+        verification = Verification.FULL if verification is None else verification
+        if not self.already_exists(verify=False):
+            return False
+
+        index = self.get_cache().index()
+        record = None if index is None else index.file_record(self.cache_key())
+        return record is None or _matches_record(self.local_path(), record, verification)
+
+    def _request_first_segment(self, sess: 'requests.Session',
+                               partial: 'PartialDownload') -> 'requests.Response':
+        """Asks for the first segment of this file. The answer says how large the file is, and
+        whether the server does ranges at all."""
+        headers = {'Range': f'bytes=0-{self.get_options().segment_size - 1}'}
+        previous = partial.segments_state()
+        if previous is not None:
+            headers['If-Range'] = previous['validator']
+        return self.beaker_item.make_one_file_download_request(self.file_name, sess,
+                                                                headers=headers)
+
+    def _download_in_segments(self, sess: 'requests.Session', partial: 'PartialDownload',
+                              first: 'requests.Response') -> int:
+        """Downloads this file as several byte ranges at the same time.
+
+        'first' is the response to _request_first_segment(). If the file turns out to be small,
+        that is all there is to it.
+        """
+        from .http import read_into
 
-        def write_chunks(write_to, chunk_size=1024 * 256):
+        options = self.get_options()
+        segment_size = options.segment_size
+
+        previous = partial.segments_state()
+        total_size = _content_range_total(first)
+        validator = _validator(first)
+        num_segments = (total_size + segment_size - 1) // segment_size
+
+        done: Set[int] = set()
+        if (previous is not None and previous['validator'] == validator and
+                previous['size'] == total_size and previous['segment_size'] == segment_size):
+            done = set(previous['segments'])
+        else:
+            partial.discard()
+        if num_segments > 1 and done:
+            _logger.info(f'Resuming {self.file_name} of dataset {self.dataset_id()} '
+                         f'with {len(done)} of {num_segments} segments done.')
+
+        fd = os.open(str(partial.path), os.O_RDWR | os.O_CREAT, 0o644)
+        progress_lock = threading.Lock()
+        written = 0
+
+        def fetch_segment(i: int, res: Optional['requests.Response']) -> None:
+            nonlocal written
+            start = i * segment_size
+            end = min(start + segment_size, total_size) - 1
+
+            if res is None:
+                res = self.beaker_item.make_one_file_download_request(
+                    self.file_name, sess,
+                    headers={'Range': f'bytes={start}-{end}', 'If-Range': validator})
+            try:
+                if res.status_code != 206 or _content_range_start(res) != start:
+                    raise BeakerstoreError(
+                        (f'Unable to get bytes {start}-{end} of the requested file. It may have '
+                         f'changed while being downloaded. Response code: {res.status_code}.'))
+
+                offset = start
+                buffer = bytearray(1024 * 256)
+                with memoryview(buffer) as view:
+                    while offset <= end:
+                        n = read_into(res, view)
+                        if not n:
+                            break
+                        self._throttle(n)
+                        with view[:n] as chunk:
+                            os.pwrite(fd, chunk, offset)
+                        offset += n
+
+                if offset != end + 1:
+                    raise IncompleteDownloadError(
+                        f'Got {offset - start} bytes of the requested file instead of '
+                        f'{end + 1 - start}.')
+            finally:
+                res.close()
+
+            with progress_lock:
+                done.add(i)
+                written += end + 1 - start
+                partial.record_segments(validator, total_size, segment_size, done)
+
+        try:
+            if not done:
+                _preallocate(fd, total_size)
+                partial.record_segments(validator, total_size, segment_size, done)
+
+            self.computed_blob_key = None
+            if 0 in done:
+                first.close()
+
+            to_do = iter([i for i in range(num_segments) if i not in done])
+            to_do_lock = threading.Lock()
+            failed = threading.Event()
+
+            def fetch_segments(extra: bool) -> None:
+                # An extra worker stops once other downloads need its connection back. The
+                # first one keeps going, on the connection that this download has anyway.
+                try:
+                    while not failed.is_set():
+                        if extra and options._close_connections(1, if_over=True):
+                            extra = False
+                            return
+                        with to_do_lock:
+                            i = next(to_do, None)
+                        if i is None:
+                            return
+                        fetch_segment(i, first if i == 0 else None)
+                except BaseException:
+                    failed.set()
+                    raise
+                finally:
+                    if extra:
+                        options._close_connections(1)
+
+            num_extra = options._open_connections(
+                min(options.segment_workers, num_segments - len(done)) - 1, extra=True)
+            with ThreadPoolExecutor(max_workers=1 + num_extra) as executor:
+                futures = [executor.submit(fetch_segments, i > 0) for i in range(1 + num_extra)]
+                for future in futures:
+                    future.result()
+        finally:
+            first.close()
+            os.close(fd)
+
+        return written
+
+    def _write_file_from_response(self, res: 'requests.Response', write_to, hasher=None) -> int:
+
+        def write_chunks(chunk_size=1024 * 256) -> int:
+            written = 0
             for chunk in res.iter_content(chunk_size=chunk_size):
                 if chunk:
+                    self._throttle(len(chunk))
                     write_to.write(chunk)
+                    written += len(chunk)
+                    if hasher is not None:
+                        hasher.update(chunk)
+            return written
+
+        return write_chunks()
+
+    def _write_buffered(self,
+                        res: 'requests.Response',
+                        partial: 'PartialDownload',
+                        offset: int,
+                        full_size: Optional[int] = None,
+                        hasher=None) -> int:
+        """Reads the response into reusable buffers, which are written to the partial file.
+
+        See DownloadOptions.write_buffers. 'full_size' is how large the whole file is, if the
+        response says. With DownloadOptions.preallocate, the file is made that large first, and
+        cut down to what was received once this is done.
+        """
+        from .http import read_into
 
-        if self.already_exists():
-            return
-
-        # prepare the tmp location if necessary
-        tmp_dir = self.get_cache().tmp_loc()
-        if not tmp_dir.is_dir():
-            tmp_dir.mkdir(parents=True)
+        options = self.get_options()
+        preallocate = options.preallocate and bool(full_size)
+        remaining = None if full_size is None else full_size - offset
+        chunk_sizer = _ChunkSizer(options.min_chunk_size, options.max_chunk_size)
 
-        # make the file
-        tmp_file = tempfile.NamedTemporaryFile(
-            dir=tmp_dir,
-            prefix=self._tmp_file_prefix(),
-            suffix='.tmp',
-            delete=False)
-        remember_cleanup(tmp_file.name)
+        # a file that fits in a buffer or two isn't worth starting a thread for
+        num_buffers = options.write_buffers
+        if remaining is not None and remaining <= 2 * options.max_chunk_size:
+            num_buffers = 0
 
-        # write to the file
-        write_chunks(tmp_file)
-        tmp_file.close()
+        flags = os.O_WRONLY | os.O_CREAT | (0 if offset > 0 else os.O_TRUNC)
+        fd = os.open(str(partial.path), flags, 0o644)
+        writer = _BufferWriter(fd, offset, hasher, num_buffers, options.fadvise)
+        try:
+            if preallocate:
+                _preallocate(fd, full_size)
+            try:
+                while True:
+                    chunk_size = chunk_sizer.size
+                    if remaining is not None:
+                        chunk_size = min(chunk_size, remaining - writer.received)
+                    if chunk_size <= 0:
+                        break
+                    buffer = writer.take(chunk_size)
+                    start = time.perf_counter()
+                    with memoryview(buffer) as view, view[:chunk_size] as chunk:
+                        n = read_into(res, chunk)
+                    if not n:
+                        writer.give_back(buffer)
+                        break
+                    chunk_sizer.update(n, time.perf_counter() - start)
+                    self._throttle(n)
+                    writer.write(buffer, n)
+            finally:
+                # whatever was received is written, even if something went wrong since
+                writer.close()
+        finally:
+            if preallocate:
+                os.ftruncate(fd, offset + writer.written)
+            os.close(fd)
+            partial.record(offset + writer.written)
+        return writer.written
+
+    def _write_mapped(self,
+                      res: 'requests.Response',
+                      partial: 'PartialDownload',
+                      offset: int,
+                      size: int,
+                      hasher=None,
+                      chunk_size: int = 1024 * 1024) -> int:
+        """Reads the response into a memory map of the partial file, which is made 'size' long
+        first.
+
+        The bytes go from the connection into the page cache, without a buffer in between. Once
+        this is done, whether or not it got all of the file, the file is cut down to what it got.
+        """
+        from .http import read_into
 
-        # put the file in the right place
-        Path(tmp_file.name).rename(self.cache_path())
-        forget_cleanup(tmp_file.name)
+        fd = os.open(str(partial.path), os.O_RDWR | os.O_CREAT, 0o644)
+        written = 0
+        try:
+            _preallocate(fd, size)
+            with mmap.mmap(fd, size) as mapped, memoryview(mapped) as view:
+                position = offset
+                while position < size:
+                    with view[position:min(position + chunk_size, size)] as chunk:
+                        n = read_into(res, chunk)
+                        if not n:
+                            break
+                        self._throttle(n)
+                        if hasher is not None:
+                            hasher.update(chunk[:n])
+                    position += n
+                    written += n
+        finally:
+            os.ftruncate(fd, offset + written)
+            os.close(fd)
+            partial.record(offset + written)
+        return written
+
+    def _throttle(self, num_bytes: int) -> None:
+        """Waits until 'num_bytes' more may be downloaded, if the bandwidth is limited."""
+        bandwidth_limiter = self.get_options().bandwidth_limiter
+        if bandwidth_limiter is not None:
+            bandwidth_limiter.acquire(num_bytes)
+
+    def partial_download(self) -> 'PartialDownload':
+        """Where this file goes while it is being downloaded."""
+        tmp_dir = self.get_cache().tmp_loc()
+        if not tmp_dir.is_dir():
+            tmp_dir.mkdir(parents=True, exist_ok=True)
+        return PartialDownload(tmp_dir, self._tmp_file_prefix())
 
     def _tmp_file_prefix(self) -> str:
         no_subdirs = self.cache_key().replace('/', '%')
         return f'ai2-beakerstore-{no_subdirs}'
 
 
+class PartialDownload:
+    """A file that is partway through being downloaded.
+
+    It sits in the cache's tmp location under a name that comes from its cache entry, next to a
+    sidecar that records how much of it was received and which version of the file it is part
+    of. A download that gets interrupted can then carry on from there, using a Range request.
+    """
+    def __init__(self, tmp_dir: Path, name: str):
+        self.path = tmp_dir / f'{name}.part'
+        self.sidecar_path = tmp_dir / f'{name}.part.json'
+
+    def size(self) -> int:
+        try:
+            return self.path.stat().st_size
+        except FileNotFoundError:
+            return 0
+
+    def sidecar(self) -> dict:
+        try:
+            return json.loads(self.sidecar_path.read_text())
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def resume_headers(self) -> dict:
+        """The headers to ask for the rest of the file with, if some of it is already here."""
+
+        # The file on disk is what counts: the sidecar is only updated every now and then.
+        # That is, unless it was downloaded in segments, and so isn't filled in from the start,
+        # or it was left full size while being written through a memory map.
+        size = self.size()
+        if size == 0 or self.segments_state() is not None or self.sidecar().get('mapped'):
+            return {}
+
+        headers = {'Range': f'bytes={size}-'}
+        validator = self.sidecar().get('validator')
+        if validator is not None:
+            # if the file changed since, this gets us all of the new one instead
+            headers['If-Range'] = validator
+        return headers
+
+    def start_from(self, res: 'requests.Response', mapped: bool = False) -> int:
+        """Where in the file the contents of 'res' go, given how the server responded.
+
+        'mapped' is whether the file will be made full size before they are written, as it is for
+        writing through a memory map (see _write_mapped()), or with DownloadOptions.preallocate.
+        """
+        if res.status_code == 206:
+            offset = _content_range_start(res)
+            if offset == self.size():
+                self._set_validator(res, offset, mapped)
+                return offset
+
+            raise BeakerstoreError(f'Got an unexpected range of the requested file: '
+                                   f'{res.headers.get("Content-Range")}.')
+
+        if res.status_code == 200:
+            # either there was nothing to resume, or the server wants to send all of it
+            self._set_validator(res, 0, mapped)
+            return 0
+
+        raise BeakerstoreError((f'Unable to get the requested file. '
+                                f'Response code: {res.status_code}.'))
+
+    def segments_state(self) -> Optional[dict]:
+        """If this file is being downloaded in segments, which of them are done."""
+        sidecar = self.sidecar()
+        if 'segments' not in sidecar or sidecar.get('validator') is None:
+            return None
+        return sidecar
+
+    def record_segments(self, validator: str, size: int, segment_size: int, done: Set[int]) -> None:
+        _write_atomically(self.sidecar_path, json.dumps({
+            'validator': validator,
+            'size': size,
+            'segment_size': segment_size,
+            'segments': sorted(done),
+            'received': len(done) * segment_size
+        }))
+
+    def record(self, received: int) -> None:
+        sidecar = {k: v for k, v in self.sidecar().items() if k != 'mapped'}
+        _write_atomically(self.sidecar_path, json.dumps(dict(sidecar, received=received)))
+
+    def commit(self, target: Path) -> None:
+        self.path.rename(target)
+        self._remove_sidecar()
+
+    def discard(self) -> None:
+        try:
+            self.path.unlink()
+        except FileNotFoundError:
+            pass
+        self._remove_sidecar()
+
+    def _set_validator(self, res: 'requests.Response', received: int, mapped: bool = False) -> None:
+        sidecar = {'validator': _validator(res), 'received': received}
+        full_size = _full_size(res)
+        if full_size is not None:
+            sidecar['size'] = full_size
+        if mapped:
+            # the size of the file says nothing about how much of it is here
+            sidecar['mapped'] = True
+        _write_atomically(self.sidecar_path, json.dumps(sidecar))
+
+    def _remove_sidecar(self) -> None:
+        try:
+            self.sidecar_path.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def _validator(res: 'requests.Response') -> Optional[str]:
+    """What identifies the version of the file in 'res', for use with If-Range."""
+    etag = res.headers.get('ETag')
+    if etag is not None and not etag.startswith('W/'):
+        # weak etags can't be used with If-Range
+        return etag
+    return res.headers.get('Last-Modified')
+
+
+def _content_range_total(res: 'requests.Response') -> Optional[int]:
+    """The size of the whole file, from a header like 'bytes 100-199/1000'."""
+    total = res.headers.get('Content-Range', '').rpartition('/')[2]
+    return int(total) if total.isdigit() else None
+
+
+def _manifest_changed(before: Optional[dict], after: dict) -> bool:
+    """Is a file in a dataset manifest different from what the manifest said before, if anything?"""
+    if before is None:
+        return False
+    return (before.get('size'), before.get('digest')) != (after.get('size'), after.get('digest'))
+
+
+def _check_received(res: 'requests.Response', received: int) -> None:
+    """Raises IncompleteDownloadError if less of the body of 'res' came than it said would.
+
+    'received' is how much of the body was read. With urllib3 1.x, a connection that goes away
+    partway through looks like the end of the body, so this is how that is found out. For a
+    compressed body, what came over the connection is counted instead.
+    """
+    length = res.headers.get('Content-Length', '')
+    if not length.isdigit():
+        return
+    if not _body_is_file(res):
+        received = res.raw.tell()
+    if received < int(length):
+        raise IncompleteDownloadError(f'The connection closed after {received} of the {length} '
+                                      f'bytes of {res.url}.')
+
+
+def _body_is_file(res: 'requests.Response') -> bool:
+    """Whether what comes over the connection is the file as it is, rather than compressed."""
+    return res.headers.get('Content-Encoding', 'identity') == 'identity'
+
+
+def _full_size(res: 'requests.Response') -> Optional[int]:
+    """How large the whole file is, from a response with all or the rest of it, if it says."""
+    if not _body_is_file(res):
+        return None
+    if res.status_code == 206:
+        return _content_range_total(res)
+    length = res.headers.get('Content-Length', '')
+    return int(length) if length.isdigit() else None
+
+
+def _blob_key(digest: str) -> Optional[str]:
+    """The blob key for a digest, e.g. 'sha256/abcd...'.
+
+    Digests can be like the ones in fileheap manifests, 'SHA256 <base64>', or like 'sha256:<hex>'.
+    """
+    try:
+        if ' ' in digest:
+            algorithm, value = digest.split(' ', 1)
+            value = base64.b64decode(value, validate=True).hex()
+        else:
+            algorithm, value = digest.split(':', 1)
+            value = bytes.fromhex(value).hex()
+    except (ValueError, binascii.Error):
+        return None
+    return f'{algorithm.lower()}/{value}' if value else None
+
+
+def _hash_file(p: Path, hasher, limit: Optional[int] = None) -> str:
+    """Feeds the file (or its first 'limit' bytes) to 'hasher'. Returns the hex digest."""
+    remaining = limit
+    with p.open('rb') as f:
+        while remaining is None or remaining > 0:
+            chunk = f.read(1024 * 1024 if remaining is None else min(1024 * 1024, remaining))
+            if not chunk:
+                break
+            hasher.update(chunk)
+            if remaining is not None:
+                remaining -= len(chunk)
+    return hasher.hexdigest()
+
+
+def _matches_record(p: Path, record: Tuple[int, Optional[str]],
+                    verification: 'Verification') -> bool:
+    """Does the file at 'p' match what was recorded about it?"""
+    size, blob_key = record
+    try:
+        if p.stat().st_size != size:
+            return False
+    except FileNotFoundError:
+        return False
+
+    if verification != Verification.FULL or blob_key is None:
+        return True
+    algorithm, expected = blob_key.split('/', 1)
+    return _hash_file(p, hashlib.new(algorithm)) == expected
+
+
+# from linux/fs.h
+_FICLONE = 0x40049409
+
+
+def _materialize(blob: Path, target: Path) -> None:
+    """Puts the contents of 'blob' at 'target', sharing storage with it if at all possible."""
+    tmp_target = target.parent / f'.{target.name}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        os.link(str(blob), str(tmp_target))
+    except OSError:
+        # Hard links aren't possible, e.g. across file systems. Try a reflink, then a copy.
+        with blob.open('rb') as src, tmp_target.open('wb') as dst:
+            try:
+                fcntl.ioctl(dst.fileno(), _FICLONE, src.fileno())
+            except OSError:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+    os.replace(str(tmp_target), str(target))
+
+
+def _promote(source: Path, target: Path, promotion: Promotion) -> None:
+    """Puts the file at 'source', in a read-only layer, at 'target' in the writable one."""
+    tmp_target = target.parent / f'.{target.name}.{os.getpid()}.{threading.get_ident()}.tmp'
+    if promotion == Promotion.NONE:
+        os.symlink(str(source.absolute()), str(tmp_target))
+    else:
+        with source.open('rb') as src, tmp_target.open('wb') as dst:
+            reflinked = False
+            if promotion == Promotion.REFLINK:
+                try:
+                    fcntl.ioctl(dst.fileno(), _FICLONE, src.fileno())
+                    reflinked = True
+                except OSError:
+                    pass
+            if not reflinked:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+    os.replace(str(tmp_target), str(target))
+
+
+def _map_read_only(p: Path) -> mmap.mmap:
+    with open(str(p), 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            raise ValueError(f'{p} is empty, and so can\'t be memory mapped.')
+        # the map stays valid once the file is closed
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _preallocate(fd: int, size: int) -> None:
+    """Makes the file 'size' bytes long, reserving the space for it if possible."""
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except (AttributeError, OSError):
+        # not on macOS, and not on some file systems
+        os.ftruncate(fd, size)
+
+
+class _ChunkSizer:
+    """How many bytes to read from a response at a time: about a tenth of a second's worth.
+
+    This goes by how fast the bytes have come so far, and is a power of two between 'min_size'
+    and 'max_size', so that buffers of the size can be used again.
+    """
+
+    interval = 0.1
+
+    def __init__(self, min_size: int, max_size: int):
+        self.min_size = min_size
+        self.max_size = max(min_size, max_size)
+        self.size = self.min_size
+        self._rate: Optional[float] = None
+
+    def update(self, received: int, seconds: float) -> None:
+        """Notes that 'received' bytes took 'seconds' to come."""
+        rate = received / max(seconds, 1e-6)
+        self._rate = rate if self._rate is None else 0.7 * self._rate + 0.3 * rate
+
+        size = self.min_size
+        while size < self._rate * self.interval and size < self.max_size:
+            size *= 2
+        self.size = min(size, self.max_size)
+
+
+class _BufferWriter:
+    """Writes buffers to a file in order, from 'offset' on, and hands them back to be used again.
+
+    The writing is done by a thread of its own. There are at most 'num_buffers' buffers: once all
+    of them are waiting to be written, take() waits for one to be done. With num_buffers=0, there
+    is one buffer, and it is written right away by whoever gives it to write().
+    """
+
+    # with 'fadvise', how many bytes are written between asking the OS to drop them from its cache
+    drop_interval = 64 * 1024 * 1024
+
+    def __init__(self, fd: int, offset: int, hasher=None, num_buffers: int = 4,
+                 fadvise: bool = False):
+        self.fd = fd
+        self.hasher = hasher
+        self.fadvise = fadvise
+
+        # bytes handed to write(), and bytes that are in the file
+        self.received = 0
+        self.written = 0
+
+        self._position = offset
+        self._dropped_to = offset
+        self._error: Optional[BaseException] = None
+        self._num_buffers = max(1, num_buffers)
+        self._num_made = 0
+        self._free: queue.Queue = queue.Queue()
+        self._full: queue.Queue = queue.Queue()
+
+        if fadvise:
+            _fadvise(fd, offset, 0, 'POSIX_FADV_SEQUENTIAL')
+
+        self._thread = None
+        if num_buffers > 0:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def take(self, size: int) -> bytearray:
+        """A buffer of at least 'size' bytes. Raises what went wrong writing, if anything did."""
+        if self._error is not None:
+            raise self._error
+        if self._free.empty() and self._num_made < self._num_buffers:
+            self._num_made += 1
+            return bytearray(size)
+
+        buffer = self._free.get()
+        if self._error is not None:
+            raise self._error
+        # the chunk size went up since this one was made
+        return buffer if len(buffer) >= size else bytearray(size)
+
+    def give_back(self, buffer: bytearray) -> None:
+        """Returns a buffer that nothing was read into."""
+        self._free.put(buffer)
+
+    def write(self, buffer: bytearray, n: int) -> None:
+        """Writes the first 'n' bytes of 'buffer' after what came before, now or soon."""
+        self.received += n
+        if self._thread is None:
+            self._write(buffer, n)
+            self._free.put(buffer)
+        else:
+            self._full.put((buffer, n))
+
+    def close(self) -> None:
+        """Waits for everything given to write() to be written. Raises what went wrong, if
+        anything."""
+        if self._thread is not None:
+            self._full.put(None)
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            raise self._error
+
+    def _run(self) -> None:
+        while True:
+            item = self._full.get()
+            if item is None:
+                return
+            buffer, n = item
+            if self._error is None:
+                try:
+                    self._write(buffer, n)
+                except BaseException as e:
+                    self._error = e
+            self._free.put(buffer)
+
+    def _write(self, buffer: bytearray, n: int) -> None:
+        with memoryview(buffer) as view, view[:n] as chunk:
+            done = 0
+            while done < n:
+                done += os.pwrite(self.fd, chunk[done:], self._position + done)
+            if self.hasher is not None:
+                self.hasher.update(chunk)
+        self._position += n
+        self.written += n
+
+        if self.fadvise and self._position - self._dropped_to >= 2 * self.drop_interval:
+            # Only what is on disk can be dropped, so this stays a while behind what was just
+            # written, giving it time to get there.
+            drop_to = self._position - self.drop_interval
+            _fadvise(self.fd, self._dropped_to, drop_to - self._dropped_to, 'POSIX_FADV_DONTNEED')
+            self._dropped_to = drop_to
+
+
+def _fadvise(fd: int, offset: int, length: int, advice: str) -> None:
+    """Tells the OS how a file is going to be used, if it can be told."""
+    try:
+        os.posix_fadvise(fd, offset, length, getattr(os, advice))
+    except (AttributeError, OSError):
+        # not on macOS
+        pass
+
+
+def _content_range_start(res: 'requests.Response') -> Optional[int]:
+    """The first byte in a 206 response, from a header like 'bytes 100-199/1000'."""
+    content_range = res.headers.get('Content-Range', '')
+    try:
+        unit, byte_range = content_range.split(' ', 1)
+        return int(byte_range.split('-', 1)[0]) if unit == 'bytes' else None
+    except ValueError:
+        return None
+
+
+class CacheStream(io.RawIOBase):
+    """Reads a file as it is downloaded, putting it in the cache at the same time.
+
+    Whatever bytes are read are also written to the entry's partial download. Once the whole
+    file has been read, it is checked and put in place, just like FileCacheEntry.download()
+    would. If the stream is closed before the end, the partial download stays behind for a
+    later download to carry on from.
+
+    If some of the file was already downloaded, that part is read from disk first. 'lock' is
+    the entry's lock, held by the caller, and released once this is done.
+    """
+    def __init__(self,
+                 cache_entry: 'FileCacheEntry',
+                 res: 'requests.Response',
+                 lock: 'CacheLock'):
+        super().__init__()
+        self.cache_entry = cache_entry
+        self.res = res
+        self.lock = lock
+
+        # the response is read from directly, so decompressing is up to us
+        self.res.raw.decode_content = True
+
+        self._partial: Optional[PartialDownload] = None
+        self._partial_file = None
+        self._prefix = None
+        self._hasher = None
+        self._received = 0
+
+        self._partial = cache_entry.partial_download()
+        offset = self._partial.start_from(res)
+        self._partial_file = self._partial.path.open('r+b' if offset > 0 else 'wb')
+        self._partial_file.seek(offset)
+        self._received = offset
+        self._offset = offset
+
+        if offset > 0:
+            self._prefix = self._partial.path.open('rb')
+
+        algorithm = cache_entry._digest_algorithm()
+        cache_entry.computed_blob_key = None
+        if algorithm is not None:
+            self._hasher = hashlib.new(algorithm)
+            if offset > 0:
+                _hash_file(self._partial.path, self._hasher, limit=offset)
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        if self._prefix is not None:
+            n = self._prefix.readinto(b)
+            if n:
+                return n
+            self._prefix.close()
+            self._prefix = None
+
+        from .http import read_into
+
+        n = read_into(self.res, b)
+        if n:
+            self.cache_entry._throttle(n)
+        if n and self._partial_file is not None:
+            data = memoryview(b)[:n]
+            self._partial_file.write(data)
+            if self._hasher is not None:
+                self._hasher.update(data)
+            self._received += n
+        elif not n and self._partial_file is not None:
+            try:
+                _check_received(self.res, self._received - self._offset)
+            except IncompleteDownloadError:
+                # what was received stays, for a later download to carry on from
+                self._stop_writing()
+                raise
+            self._commit()
+        return n
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        try:
+            self._stop_writing()
+            self.res.close()
+        finally:
+            super().close()
+
+    def _commit(self) -> None:
+        """The whole file was read, so put it in the cache."""
+        if self._partial_file is None:
+            return
+
+        self._stop_writing(commit=True)
+
+    def _stop_writing(self, commit: bool = False) -> None:
+        if self._partial_file is None:
+            return
+
+        try:
+            self._partial_file.close()
+            self._partial.record(self._received)
+            if self._prefix is not None:
+                self._prefix.close()
+
+            if commit:
+                if self._hasher is not None:
+                    self.cache_entry.computed_blob_key = \
+                        f'{self._hasher.name}/{self._hasher.hexdigest()}'
+                self.cache_entry._commit_download(self._partial)
+                _finish_entries(self.cache_entry.get_cache(), [self.cache_entry])
+        finally:
+            self._partial_file = None
+            self.lock.release_lock()
+
+
+class FollowStream(io.RawIOBase):
+    """Reads a file that someone else is downloading, as it is downloaded.
+
+    What is in the partial download so far is read first. When that runs out, this waits for
+    more, until the file is in place in the cache, and then reads the rest from there.
+    """
+    def __init__(self, cache_entry: 'FileCacheEntry', partial: 'PartialDownload'):
+        super().__init__()
+        self.cache_entry = cache_entry
+        self.partial = partial
+
+        self._validator = partial.sidecar().get('validator')
+        self._file = partial.path.open('rb')
+        self._in_place = False
+        self._delay = 0.001
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        while True:
+            n = self._file.readinto(b)
+            if n or self._in_place:
+                self._delay = 0.001
+                return n
+            self._wait_for_more()
+
+    def close(self) -> None:
+        if not self.closed:
+            self._file.close()
+        super().close()
+
+    def _wait_for_more(self) -> None:
+        target = self.cache_entry.local_path()
+        if not target.is_file():
+            lock = CacheLock(self.cache_entry)
+            if not lock.try_lock():
+                # the sidecar also goes away when the download is put in place, just after that
+                if self.partial.sidecar().get('validator') != self._validator and \
+                        not target.is_file():
+                    raise BeakerstoreError(f'{self.cache_entry.item_name()} changed while it was '
+                                           f'being downloaded.')
+                time.sleep(self._delay)
+                self._delay = min(self._delay * 2, 0.05)
+                return
+
+            # nobody is downloading it anymore
+            lock.release_lock()
+            if not target.is_file():
+                raise BeakerstoreError(f'The download of {self.cache_entry.item_name()} stopped '
+                                       f'before it was done.')
+
+        # It's in place. Carry on from the same spot in it.
+        position = self._file.tell()
+        self._file.close()
+        self._file = target.open('rb')
+        self._file.seek(position)
+        self._in_place = True
+
+
 class CacheLock:
     def __init__(self, cache_entry: CacheEntry):
-        self.lock_loc = Path(f'{cache_entry.cache_path()}.lock')
+        self.lock_loc = Path(f'{cache_entry.local_path()}.lock')
         self.item_name = cache_entry.item_name()
 
-    def _wait_for_lock(self) -> None:
+        cache = cache_entry.get_cache()
+        self.backend = cache.lock_backend
+        self.timeout = cache.lock_timeout
+        self.stale_after = cache.stale_lock_after
 
-        if not self.lock_loc.is_file():
-            return
+        self._fd: Optional[int] = None
 
-        start = time.time()
-        _logger.info(f'Waiting for the lock for {self.item_name}.')
-        last_message_time = start
+    def get_lock(self, timeout: Optional[float] = None) -> None:
+        """Waits for, and takes, the lock.
 
-        while self.lock_loc.is_file():
-            if time.time() - last_message_time > 60:
-                now = time.time()
-                _logger.info(f'Still waiting for the lock. It\'s been {now - start} seconds.')
-                last_message_time = now
-            time.sleep(1)
+        Raises LockTimeoutError if that takes longer than 'timeout' seconds (or the cache's lock
+        timeout, if 'timeout' is not given).
+        """
+        timeout = self.timeout if timeout is None else timeout
+        waiter = _LockWaiter(self.item_name, timeout)
 
-    def get_lock(self) -> None:
-        self._wait_for_lock()
         try:
-            self.lock_loc.touch(mode=0o644, exist_ok=False)
-            remember_cleanup(self.lock_loc)
-        except FileExistsError:
-            self.get_lock()
+            if self.backend == LockBackend.FLOCK:
+                self._get_flock(waiter)
+            else:
+                self._get_file_lock(waiter)
+        except LockTimeoutError:
+            if timeout != 0:
+                events.emit('lock_timeout', item=self.item_name, backend=self.backend.value,
+                            seconds=time.time() - waiter.start)
+            raise
+
+        remember_cleanup(self.lock_loc)
+        if self.backend == LockBackend.FILE and self.stale_after is not None:
+            _lock_heartbeat.add(self.lock_loc, self.stale_after / 4)
+        if waiter.start is not None:
+            events.emit('lock_wait', item=self.item_name, backend=self.backend.value,
+                        seconds=time.time() - waiter.start)
+
+    def try_lock(self) -> bool:
+        """Takes the lock if nobody else has it. Does not wait."""
+        try:
+            self.get_lock(timeout=0)
+            return True
+        except LockTimeoutError:
+            return False
 
     def release_lock(self) -> None:
-        self.lock_loc.unlink()
+        _lock_heartbeat.remove(self.lock_loc)
+
+        # Removing the file before letting go of it means that anyone waiting on the old file
+        # will notice that it is gone, and start over on a new one. With LockBackend.FILE, a lock
+        # that looked abandoned may have been taken over since, and then it isn't ours to remove.
+        if self._is_ours():
+            self.lock_loc.unlink(missing_ok=True)
+        else:
+            _logger.warning(f'The lock for {self.item_name} was taken over while we held it.')
         forget_cleanup(self.lock_loc)
 
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+
+    def _get_flock(self, waiter: '_LockWaiter') -> None:
+        while True:
+            fd = os.open(str(self.lock_loc), os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                self._flock(fd, waiter)
+                if self._is_current_lock_file(fd):
+                    os.ftruncate(fd, 0)
+                    os.write(fd, _lock_owner().encode('utf-8'))
+                    self._fd = fd
+                    return
+            except BaseException:
+                os.close(fd)
+                raise
+
+            # whoever had the lock removed the file we were waiting on. Start over.
+            os.close(fd)
+
+    def _flock(self, fd: int, waiter: '_LockWaiter') -> None:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return
+        except BlockingIOError:
+            pass
+
+        if waiter.timeout is None:
+            waiter.started()
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            return
+
+        while True:
+            waiter.wait()
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return
+            except BlockingIOError:
+                pass
+
+    def _is_current_lock_file(self, fd: int) -> bool:
+        try:
+            path_stat = os.stat(str(self.lock_loc))
+        except FileNotFoundError:
+            return False
+        fd_stat = os.fstat(fd)
+        return (path_stat.st_dev, path_stat.st_ino) == (fd_stat.st_dev, fd_stat.st_ino)
+
+    def _is_ours(self) -> bool:
+        if self._fd is not None:
+            return self._is_current_lock_file(self._fd)
+        try:
+            return self.lock_loc.read_text() == _lock_owner()
+        except FileNotFoundError:
+            return False
+
+    def _get_file_lock(self, waiter: '_LockWaiter') -> None:
+        while True:
+            try:
+                fd = os.open(str(self.lock_loc), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+            except FileExistsError:
+                if self._remove_if_stale():
+                    continue
+                waiter.wait()
+                continue
+
+            try:
+                os.write(fd, _lock_owner().encode('utf-8'))
+            finally:
+                os.close(fd)
+            return
+
+    def _remove_if_stale(self) -> bool:
+        """Removes the lock file if whoever made it is gone. Returns whether it did."""
+        try:
+            contents = self.lock_loc.read_text()
+            age = time.time() - self.lock_loc.stat().st_mtime
+        except FileNotFoundError:
+            # it's gone already
+            return True
+
+        try:
+            host, pid = contents.split()
+            pid = int(pid)
+        except ValueError:
+            # Probably in the middle of being written. If it stays this way, it's from a process
+            # that died before it could say who it was.
+            host, pid = None, None
+
+        if host == socket.gethostname():
+            stale = not _process_exists(pid)
+        else:
+            stale = self.stale_after is not None and age > self.stale_after
+
+        if not stale:
+            return False
+
+        _logger.warning(f'Removing the abandoned lock for {self.item_name} '
+                        f'(held by {contents.strip()}).')
+        try:
+            self.lock_loc.unlink()
+        except FileNotFoundError:
+            pass
+        return True
+
+
+class _LockWaiter:
+    """Keeps track of how long we've been waiting for a lock, and sleeps between attempts."""
+    def __init__(self, item_name: str, timeout: Optional[float]):
+        self.item_name = item_name
+        self.timeout = timeout
+        self.start: Optional[float] = None
+        self.last_message_time: Optional[float] = None
+        self.delay = 0.001
+
+    def started(self) -> None:
+        if self.start is None:
+            self.start = self.last_message_time = time.time()
+            if self.timeout != 0:
+                _logger.info(f'Waiting for the lock for {self.item_name}.')
+
+    def wait(self) -> None:
+        self.started()
+        now = time.time()
+
+        if self.timeout is not None and now - self.start >= self.timeout:
+            raise LockTimeoutError(
+                f'Gave up on the lock for {self.item_name} after {now - self.start:.1f} seconds.')
+
+        if now - self.last_message_time > 60:
+            _logger.info(f'Still waiting for the lock. It\'s been {now - self.start} seconds.')
+            self.last_message_time = now
+
+        delay = self.delay
+        if self.timeout is not None:
+            delay = min(delay, max(self.start + self.timeout - now, 0))
+        time.sleep(delay)
+        self.delay = min(self.delay * 2, 0.1)
+
+
+def _lock_owner() -> str:
+    return f'{socket.gethostname()} {os.getpid()}\n'
+
+
+class _LockHeartbeat:
+    """Touches the lock files this process holds with LockBackend.FILE, every so often.
+
+    A lock held by a process on another host is taken to be abandoned once its file hasn't
+    been touched for Cache.stale_lock_after seconds, so this keeps long downloads' locks from
+    looking that way. One thread does it for all of them, and only while there are any.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._held: Dict[Path, float] = {}
+        self._thread: Optional[threading.Thread] = None
+
+    def add(self, lock_loc: Path, interval: float) -> None:
+        with self._lock:
+            self._held[lock_loc] = interval
+            self._changed.notify()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='beakerstore-lock-heartbeat',
+                                                daemon=True)
+                self._thread.start()
+
+    def remove(self, lock_loc: Path) -> None:
+        with self._lock:
+            self._held.pop(lock_loc, None)
+
+    def _run(self) -> None:
+        with self._lock:
+            while self._held:
+                self._changed.wait(min(self._held.values()))
+                for lock_loc in self._held:
+                    try:
+                        os.utime(str(lock_loc))
+                    except FileNotFoundError:
+                        pass
+            self._thread = None
+
+
+_lock_heartbeat = _LockHeartbeat()
+
+
+def _process_exists(pid: Optional[int]) -> bool:
+    if pid is None:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # it exists, it just isn't ours
+        return True
+    return True
+
 
 class ItemRequest:
     def __init__(self,
@@ -397,11 +3389,32 @@ class ItemRequest:
         self.given_path = given_path
         self.which_beaker = which_beaker
 
-    def to_beaker_item(self, sess: requests.Session) -> BeakerItem:
+    def to_beaker_item(self,
+                       sess: 'requests.Session',
+                       index: Optional[MetadataIndex] = None,
+                       credentials: Optional[CredentialCache] = None,
+                       revalidate: bool = False) -> BeakerItem:
+        """The item this request is for, according to Beaker.
+
+        A dataset that the index, or 'credentials', already know about isn't looked up, unless
+        'revalidate' is True. Its storage token is only gotten once a download needs it. Either
+        way, what Beaker says is kept in them.
+        """
+
+        if not revalidate:
+            beaker_item = self._to_beaker_item_without_lookup(index, credentials)
+            if beaker_item is not None:
+                return beaker_item
+
+        if index is not None:
+            beaker_item = self._to_beaker_item_from_index(sess, index, credentials)
+            if beaker_item is not None:
+                return beaker_item
 
         try:
             # this expects a format like: ds_abc
-            return self._get_dataset_details_helper(self._path_to_dataset_id(), sess)
+            return self._get_dataset_details_helper(self._path_to_dataset_id(), sess, index=index,
+                                                    credentials=credentials)
 
         except DatasetNotFoundError as e_id:
 
@@ -410,13 +3423,123 @@ class ItemRequest:
                 try:
                     # we could have been given a dataset in this format: chloea/my-dataset.
                     # Try that.
-                    return self._get_dataset_details_helper(self._path_to_author_and_name(), sess)
+                    return self._get_dataset_details_helper(self._path_to_author_and_name(), sess,
+                                                            index=index, credentials=credentials)
 
                 except DatasetNotFoundError as e_author_and_name:
                     raise DatasetNotFoundError(f'{e_id}\n{e_author_and_name}')
             else:
                 raise e_id
 
+    def _to_beaker_item_without_lookup(self,
+                                       index: Optional[MetadataIndex],
+                                       credentials: Optional[CredentialCache]
+                                       ) -> Optional[BeakerItem]:
+        """The item for a request that the index, or storage details kept since it was looked up,
+        say which dataset it is for.
+
+        The storage details come from 'credentials' if they have some that haven't expired.
+        Otherwise, the item gets them once it needs them. Returns None if neither knows.
+        """
+        found = None if index is None else self._identifier_from_index(index)
+        if found is None:
+            dataset_id = self._path_to_dataset_id()
+            if credentials is None or credentials.get(self.which_beaker, dataset_id) is None:
+                return None
+            identifier = dataset_id
+        else:
+            identifier, dataset_id = found
+
+        beaker_info = None if index is None else index.dataset_info(self.which_beaker, dataset_id)
+        beaker_info = dict(beaker_info or {'id': dataset_id})
+        storage = None if credentials is None else credentials.get(self.which_beaker, dataset_id)
+        if storage is not None:
+            beaker_info['storage'] = storage
+        file_path = self.given_path[len(identifier) + 1:]
+        return BeakerItem(file_path == '', beaker_info, file_path, which_beaker=self.which_beaker,
+                          credentials=credentials, index=index, identifier=identifier)
+
+    def _to_beaker_item_from_index(self,
+                                   sess: 'requests.Session',
+                                   index: MetadataIndex,
+                                   credentials: Optional[CredentialCache] = None
+                                   ) -> Optional[BeakerItem]:
+        """Asks Beaker about the dataset the index says this is, skipping any guesswork.
+
+        Returns None if the index doesn't know, or turns out to be out of date.
+        """
+        found = self._identifier_from_index(index)
+        if found is None:
+            return None
+        identifier, dataset_id = found
+
+        try:
+            beaker_item = self._get_dataset_details_helper(identifier, sess, dataset_id=dataset_id,
+                                                           credentials=credentials)
+        except DatasetNotFoundError:
+            # the dataset was deleted since we last saw it
+            index.forget_dataset(self.which_beaker, dataset_id)
+            return None
+
+        if self._was_renamed(identifier, dataset_id, beaker_item.beaker_info):
+            index.forget_alias(self.which_beaker, identifier)
+            return None
+
+        index.record(self.which_beaker, identifier, beaker_item.beaker_info)
+        return beaker_item
+
+    @staticmethod
+    def _was_renamed(identifier: str, dataset_id: str, beaker_info: dict) -> bool:
+        """Was the dataset that 'identifier' used to be an alias of renamed since?"""
+        current_alias = _author_and_name(beaker_info)
+        return identifier != dataset_id and current_alias is not None and \
+            current_alias != identifier
+
+    def _identifier_from_index(self, index: MetadataIndex) -> Optional[Tuple[str, str]]:
+        """The part of the given path that identifies the dataset, and the dataset's id.
+
+        Returns None if the index doesn't know about the dataset.
+        """
+        possible_id = self._path_to_dataset_id()
+        if index.dataset_info(self.which_beaker, possible_id) is not None:
+            return possible_id, possible_id
+
+        if len(self.given_path.split('/')) > 1:
+            alias = self._path_to_author_and_name()
+            dataset_id = index.alias_target(self.which_beaker, alias)
+            if dataset_id is not None:
+                return alias, dataset_id
+
+        return None
+
+    def to_cached_entry(self, cache: Cache) -> Optional[CacheEntry]:
+        """The cache entry for this request, worked out without asking Beaker.
+
+        This works for requests that start with a dataset id, like ds_abc or ds_abc/file.txt, and
+        for requests that start with an author and name that the metadata index knows about.
+        Returns None if it is not possible to tell.
+        """
+        index = cache.index()
+        found = None if index is None else self._identifier_from_index(index)
+        if found is None:
+            identifier = dataset_id = self._path_to_dataset_id()
+        else:
+            identifier, dataset_id = found
+
+        if dataset_id == '':
+            return None
+
+        beaker_info = None if index is None else index.dataset_info(self.which_beaker, dataset_id)
+        if beaker_info is None:
+            beaker_info = {'id': dataset_id}
+
+        file_path = self.given_path[len(identifier) + 1:]
+        beaker_item = BeakerItem(file_path == '', beaker_info, file_path,
+                                 which_beaker=self.which_beaker)
+        cache_entry = CacheEntry.from_beaker_item(beaker_item)
+        cache_entry.set_cache(cache)
+        return cache_entry
+
     def _path_to_dataset_id(self) -> str:
         return self.given_path.split('/')[0]
 
@@ -427,10 +3550,22 @@ class ItemRequest:
 
     def _get_dataset_details_helper(self,
                                     possible_identifier: str,
-                                    sess: requests.Session) -> BeakerItem:
+                                    sess: 'requests.Session',
+                                    index: Optional[MetadataIndex] = None,
+                                    dataset_id: Optional[str] = None,
+                                    credentials: Optional[CredentialCache] = None) -> BeakerItem:
+        """Asks Beaker about the dataset 'possible_identifier' in the given path refers to.
+
+        If the dataset's id is already known, it is what Beaker is asked about. If an index, or
+        credentials, are given, they are updated with Beaker's answer.
+        """
+        import requests
+
+        url_identifier = possible_identifier if dataset_id is None else dataset_id
 
+        start = time.time()
         try:
-            res = sess.get(self._get_beaker_dataset_url(possible_identifier), timeout=10)
+            res = sess.get(self._get_beaker_dataset_url(url_identifier), timeout=10)
         except requests.exceptions.ConnectTimeout as e:
             if self.which_beaker == BeakerOptions.INTERNAL:
                 raise BeakerstoreError(('Unable to connect to internal Beaker. '
@@ -438,27 +3573,60 @@ class ItemRequest:
             else:
                 raise e
 
-        if res.status_code == 200:
-            beaker_info = res.json()
+        beaker_info = res.json() if res.status_code == 200 else None
+        events.emit('lookup', identifier=url_identifier, seconds=time.time() - start,
+                    found=res.status_code == 200)
+        return self._beaker_item_from_response(possible_identifier, url_identifier, res.status_code,
+                                               beaker_info, index, credentials)
+
+    def _beaker_item_from_response(self,
+                                   possible_identifier: str,
+                                   url_identifier: str,
+                                   status_code: int,
+                                   beaker_info: Optional[dict],
+                                   index: Optional[MetadataIndex],
+                                   credentials: Optional[CredentialCache] = None) -> BeakerItem:
+        """Makes sense of Beaker's answer about 'url_identifier'."""
+
+        if status_code == 200:
+            if index is not None:
+                index.record(self.which_beaker, possible_identifier, beaker_info)
+            if credentials is not None and isinstance(beaker_info.get('storage'), dict):
+                credentials.put(self.which_beaker, beaker_info['id'], beaker_info['storage'])
 
             # add 1 to get past the '/'
             file_path = self.given_path[len(possible_identifier) + 1:]
 
             is_dir = file_path == ''
-            return BeakerItem(is_dir, beaker_info, file_path, which_beaker=self.which_beaker)
-
-        elif res.status_code == 404:
+            return BeakerItem(is_dir, beaker_info, file_path, which_beaker=self.which_beaker,
+                              credentials=credentials)
+
+        elif status_code == 404:
+            if index is not None and \
+                    index.dataset_info(self.which_beaker, url_identifier) is not None:
+                index.forget_dataset(self.which_beaker, url_identifier)
+            if credentials is not None:
+                credentials.forget(self.which_beaker, url_identifier)
             raise DatasetNotFoundError(f'Could not find dataset \'{possible_identifier}\'.')
 
+        elif status_code == 403:
+            raise DatasetForbiddenError(
+                (f'Not allowed to see dataset \'{possible_identifier}\'. '
+                 f'Response status code: {status_code}.'))
+
         else:
             raise BeakerstoreError(
                 (f'Encountered a problem when trying to find dataset \'{possible_identifier}\'. '
-                 f'Response status code: {res.status_code}.'))
+                 f'Response status code: {status_code}.'))
 
     def _get_beaker_dataset_url(self, identifier: str) -> str:
 
-        beaker_prefix = 'allenai.' if self.which_beaker == BeakerOptions.INTERNAL else ''
-        beaker_base = f'https://{beaker_prefix}beaker.org'
+        # e.g. to point at a stand-in for Beaker
+        beaker_base = os.environ.get('AI2_BEAKERSTORE_BEAKER_URL')
+
+        if beaker_base is None:
+            beaker_prefix = 'allenai.' if self.which_beaker == BeakerOptions.INTERNAL else ''
+            beaker_base = f'https://{beaker_prefix}beaker.org'
 
         return f'{beaker_base}/api/v3/datasets/{identifier}'
 
@@ -469,23 +3637,423 @@ class DatasetNotFoundError(Exception):
     pass
 
 
+class StaleMetadataError(DatasetNotFoundError):
+    """The dataset the metadata index said a path is for is gone, or goes by another name now."""
+    pass
+
+
 class BeakerstoreError(Exception):
     pass
 
 
+class IntegrityError(BeakerstoreError):
+    pass
+
+
+class LockTimeoutError(BeakerstoreError):
+    pass
+
+
+class IncompleteDownloadError(BeakerstoreError):
+    pass
+
+
+class DatasetForbiddenError(BeakerstoreError):
+    pass
+
+
 # the central function
 
 def path(given_path: str,
          which_beaker: BeakerOptions = BeakerOptions.PUBLIC,
-         cache: Optional[Cache] = None) -> Path:
+         cache: Optional[Cache] = None,
+         options: Optional[DownloadOptions] = None,
+         revalidate: Revalidate = Revalidate.NEVER,
+         ttl: float = 24 * 60 * 60,
+         include: Optional[Sequence[str]] = None,
+         exclude: Optional[Sequence[str]] = None) -> Path:
+    """A local path to the given dataset, or file within a dataset.
+
+    If the item was completely downloaded before, it is used without talking to Beaker, unless
+    'revalidate' says otherwise. 'ttl' is in seconds, and only matters for Revalidate.TTL.
+
+    For a dataset, 'include' and 'exclude' are glob patterns, like '*.idx' or 'shard-03/*', for
+    which of its files to get. Only the files that match one of 'include' (if given), and none of
+    'exclude', are downloaded.
+    """
+    return paths([given_path], which_beaker, cache, options, revalidate, ttl,
+                 include, exclude)[given_path]
+
+
+
+@contextmanager
+def using(given_path: str,
+          which_beaker: BeakerOptions = BeakerOptions.PUBLIC,
+          cache: Optional[Cache] = None,
+          options: Optional[DownloadOptions] = None,
+          revalidate: Revalidate = Revalidate.NEVER,
+          ttl: float = 24 * 60 * 60,
+          include: Optional[Sequence[str]] = None,
+          exclude: Optional[Sequence[str]] = None) -> Iterator[Path]:
+    """Like path(), but keeps what it gives from being evicted, by any process, until the with
+    block is left.
+
+    A path from path() can be evicted by a gc() once it is 'eviction_grace' seconds old.
+    """
+    cache = Cache() if cache is None else cache
+    item_request = ItemRequest(given_path, which_beaker)
+    cached_entry = item_request.to_cached_entry(cache)
+    if cached_entry is None:
+        # which dataset it is only becomes known by looking it up
+        path(given_path, which_beaker, cache, options, revalidate, ttl, include, exclude)
+        revalidate = Revalidate.NEVER
+        cached_entry = item_request.to_cached_entry(cache)
+
+    if cached_entry is None:
+        # without an index, there are no leases to take
+        yield path(given_path, which_beaker, cache, options, revalidate, ttl, include, exclude)
+        return
+
+    with cache.in_use(cached_entry):
+        yield path(given_path, which_beaker, cache, options, revalidate, ttl, include, exclude)
+
+def paths(given_paths: Iterable[str],
+          which_beaker: BeakerOptions = BeakerOptions.PUBLIC,
+          cache: Optional[Cache] = None,
+          options: Optional[DownloadOptions] = None,
+          revalidate: Revalidate = Revalidate.NEVER,
+          ttl: float = 24 * 60 * 60,
+          include: Optional[Sequence[str]] = None,
+          exclude: Optional[Sequence[str]] = None) -> Dict[str, Path]:
+    """Local paths to several datasets, or files within datasets, keyed by what was given.
+
+    Everything shares one session. The items are looked up on Beaker at the same time, and then
+    downloaded together, with at most options.max_workers files downloading at once. A file
+    within a dataset that was also asked for is downloaded as part of that dataset.
+
+    'include' and 'exclude' apply to each of the datasets, as in path(). Files that are asked
+    for by name are gotten either way.
+    """
+
+    def new_entry(entry: CacheEntry) -> CacheEntry:
+        entry.set_cache(cache)
+        if entry.is_dir():
+            entry.set_filters(include, exclude)
+        return entry
+
+    cache = Cache() if cache is None else cache
+    given_paths = list(dict.fromkeys(given_paths))
+    result: Dict[str, Path] = {}
+
+    item_requests = []
+    for given_path in given_paths:
+        item_request = ItemRequest(given_path, which_beaker)
+        cached_entry = item_request.to_cached_entry(cache)
+        if cached_entry is not None and new_entry(cached_entry).is_complete(revalidate, ttl):
+            _emit_lookup_result('cache_hit', cached_entry)
+            cache.record_access(cached_entry)
+            result[given_path] = cached_entry.resolve()
+        else:
+            item_requests.append(item_request)
+
+    if not item_requests:
+        return result
+
+    from .http import make_session
+
+    options = DownloadOptions() if options is None else options
+    sess = make_session(options)
+    index = cache.index()
+    credentials = cache.credentials()
+
+    def look_up_and_download(look_up: bool) -> Dict[str, CacheEntry]:
+        with ThreadPoolExecutor(max_workers=min(len(item_requests),
+                                                options.max_workers)) as executor:
+            beaker_items = list(executor.map(
+                lambda r: r.to_beaker_item(sess, index=index, credentials=credentials,
+                                           revalidate=look_up),
+                item_requests))
+
+        # the same item could have been asked for in different ways, e.g. by id and by name
+        cache_entries: Dict[str, CacheEntry] = {}
+        requested: Dict[str, CacheEntry] = {}
+        for item_request, beaker_item in zip(item_requests, beaker_items):
+            cache_entry = new_entry(CacheEntry.from_beaker_item(beaker_item))
+            cache_entry.set_options(options)
+            requested[item_request.given_path] = cache_entries.setdefault(cache_entry.cache_key(),
+                                                                          cache_entry)
+            _emit_lookup_result('cache_miss', cache_entry)
+
+        _download_all(list(cache_entries.values()), sess, options)
+        _finish_entries(cache, list(cache_entries.values()))
+        return requested
+
+    try:
+        requested = look_up_and_download(revalidate != Revalidate.NEVER)
+    except StaleMetadataError as e:
+        # What the index said about one of the items was out of date, and it has forgotten that
+        # since. Everything is looked up this time.
+        _logger.info(f'{e} Looking it up again.')
+        requested = look_up_and_download(True)
+
+    for given_path, cache_entry in requested.items():
+        result[given_path] = cache_entry.resolve()
+
+    return {given_path: result[given_path] for given_path in given_paths}
+
+
+def _emit_lookup_result(name: str, cache_entry: CacheEntry) -> None:
+    events.emit(name, kind='dataset' if cache_entry.is_dir() else 'file',
+                key=cache_entry.cache_key())
+
+
+def _finish_entries(cache: Cache, cache_entries: List[CacheEntry]) -> None:
+    """Marks freshly downloaded entries as complete, and makes room for them if need be."""
+    for cache_entry in cache_entries:
+        cache_entry.mark_complete()
+        cache.record_entry(cache_entry)
+
+    if cache.max_bytes is not None:
+        with ExitStack() as stack:
+            for cache_entry in cache_entries:
+                stack.enter_context(cache.in_use(cache_entry))
+            cache.gc()
+
+
+def _download_all(cache_entries: List[CacheEntry], sess: 'requests.Session',
+                  options: DownloadOptions) -> int:
+    """Downloads datasets and files together, sharing one limit on concurrent file downloads."""
+
+    if len(cache_entries) == 1:
+        return cache_entries[0].download(sess)
+
+    datasets = {e.cache_key(): e for e in cache_entries if e.is_dir()}
+
+    def in_dataset(file_entry: FileCacheEntry) -> bool:
+        dataset = datasets.get(file_entry.dataset_cache_key())
+        return dataset is not None and dataset.wants(file_entry.file_name)
+
+    files = [e for e in cache_entries if not e.is_dir() and not in_dataset(e)]
+
+    # The datasets' manifests are gone through in threads of their own, so that they don't take
+    # up file download threads. Leaving the with block waits for the datasets first, and then
+    # for the files.
+    manifest_workers = max(1, min(len(datasets), options.max_workers))
+    with ThreadPoolExecutor(max_workers=options.max_workers) as file_executor, \
+            ThreadPoolExecutor(max_workers=manifest_workers) as manifest_executor:
+        futures = [file_executor.submit(e.download, sess) for e in files]
+        futures.extend(manifest_executor.submit(e.download, sess, file_executor)
+                       for e in datasets.values())
+        total_bytes = sum(future.result() for future in futures)
+
+    return total_bytes
+
+
+def open_file(given_path: str,
+              which_beaker: BeakerOptions = BeakerOptions.PUBLIC,
+              cache: Optional[Cache] = None,
+              options: Optional[DownloadOptions] = None,
+              revalidate: Revalidate = Revalidate.NEVER,
+              ttl: float = 24 * 60 * 60,
+              buffering: int = io.DEFAULT_BUFFER_SIZE) -> BinaryIO:
+    """Opens the given file within a dataset for reading, in binary mode.
+
+    If the file isn't in the cache, its bytes are read as they are downloaded, and it is put in
+    the cache once all of it has been read. With buffering=0, what is returned is a raw stream
+    whose readinto() fills the given buffer straight from the download.
+
+    If another process is downloading the file already, what it downloads is read as it does.
+    """
+
+    cache = Cache() if cache is None else cache
+    item_request = ItemRequest(given_path, which_beaker)
+
+    cached_entry = item_request.to_cached_entry(cache)
+    if cached_entry is not None and cached_entry.is_complete(revalidate, ttl):
+        if cached_entry.is_dir():
+            raise IsADirectoryError(f'{given_path} is a dataset, not a file within one.')
+        _emit_lookup_result('cache_hit', cached_entry)
+        cache.record_access(cached_entry)
+        return open(str(cached_entry.resolve()), 'rb', buffering=buffering or -1)
+
+    from .http import make_session
 
-    sess = requests.Session()
-    sess.headers.update({'User-Agent': f'beakerstore/{__version__}'})
+    options = DownloadOptions() if options is None else options
+    sess = make_session(options)
 
+    def open_download(look_up: bool) -> BinaryIO:
+        beaker_item = item_request.to_beaker_item(sess, index=cache.index(),
+                                                  credentials=cache.credentials(),
+                                                  revalidate=look_up)
+        if beaker_item.is_dir:
+            raise IsADirectoryError(f'{given_path} is a dataset, not a file within one.')
+
+        cache_entry = FileCacheEntry(beaker_item, beaker_item.file_name)
+        cache_entry.set_cache(cache)
+        cache_entry.set_options(options)
+        _emit_lookup_result('cache_miss', cache_entry)
+
+        def open_cached() -> BinaryIO:
+            _finish_entries(cache, [cache_entry])
+            return open(str(cache_entry.resolve()), 'rb', buffering=buffering or -1)
+
+        if cache_entry.already_exists():
+            return open_cached()
+        cache_entry._prepare_parent_dir()
+
+        def buffered(stream: io.RawIOBase) -> BinaryIO:
+            return stream if buffering == 0 else io.BufferedReader(stream, buffer_size=buffering)
+
+        lock = CacheLock(cache_entry)
+        if not lock.try_lock():
+            # Someone else is downloading the file. Read it as they do, if they are downloading
+            # it from start to end, a chunk at a time. Otherwise, wait for them to be done.
+            partial = cache_entry.partial_download()
+            sidecar = partial.sidecar()
+            if sidecar and 'segments' not in sidecar and not sidecar.get('mapped'):
+                try:
+                    return buffered(FollowStream(cache_entry, partial))
+                except FileNotFoundError:
+                    pass
+            lock.get_lock()
+
+        if cache_entry._in_place_without_download():
+            lock.release_lock()
+            return open_cached()
+
+        try:
+            headers = cache_entry.partial_download().resume_headers()
+            res = beaker_item.make_one_file_download_request(cache_entry.file_name, sess,
+                                                             headers=headers)
+            if res.status_code == 416:
+                res.close()
+                cache_entry.partial_download().discard()
+                res = beaker_item.make_one_file_download_request(cache_entry.file_name, sess)
+
+            stream = CacheStream(cache_entry, res, lock)
+        except BaseException:
+            lock.release_lock()
+            raise
+
+        return buffered(stream)
+
+    try:
+        return open_download(revalidate != Revalidate.NEVER)
+    except StaleMetadataError as e:
+        # see paths()
+        _logger.info(f'{e} Looking it up again.')
+        return open_download(True)
+
+
+def memory_map(given_path: str,
+               which_beaker: BeakerOptions = BeakerOptions.PUBLIC,
+               cache: Optional[Cache] = None,
+               options: Optional[DownloadOptions] = None,
+               revalidate: Revalidate = Revalidate.NEVER,
+               ttl: float = 24 * 60 * 60) -> mmap.mmap:
+    """A read-only memory map of the given file within a dataset, downloading it if need be.
+
+    The memory is the page cache's, so every process that maps the same file shares one copy of
+    it. A map supports the buffer protocol, so memoryview(m), or numpy.frombuffer(m, dtype=...),
+    reads it without copying it. Empty files can't be mapped, and raise a ValueError.
+    """
+    local_path = path(given_path, which_beaker, cache, options, revalidate, ttl)
+    if local_path.is_dir():
+        raise IsADirectoryError(f'{given_path} is a dataset, not a file within one.')
+    return _map_read_only(local_path)
+
+
+def view(given_path: str,
+         which_beaker: BeakerOptions = BeakerOptions.PUBLIC,
+         cache: Optional[Cache] = None,
+         options: Optional[DownloadOptions] = None,
+         revalidate: Revalidate = Revalidate.NEVER,
+         ttl: float = 24 * 60 * 60) -> memoryview:
+    """A read-only memoryview of the given file within a dataset, backed by a memory map of it.
+
+    See memory_map(). The map is closed once the view, and anything made from it, is let go of.
+    """
+    local_path = path(given_path, which_beaker, cache, options, revalidate, ttl)
+    if local_path.is_dir():
+        raise IsADirectoryError(f'{given_path} is a dataset, not a file within one.')
+    if local_path.stat().st_size == 0:
+        return memoryview(b'')
+    return memoryview(_map_read_only(local_path))
+
+
+def sync(given_path: str,
+         which_beaker: BeakerOptions = BeakerOptions.PUBLIC,
+         cache: Optional[Cache] = None,
+         options: Optional[DownloadOptions] = None,
+         prune: bool = False,
+         include: Optional[Sequence[str]] = None,
+         exclude: Optional[Sequence[str]] = None) -> Path:
+    """Brings the given dataset in the cache up to date with Beaker. Returns its local path.
+
+    The manifest of the dataset is compared with the one stored the last time it was gone
+    through. Files that are new, or that changed, are downloaded, and the rest are left as they
+    are. With 'prune', files that the dataset no longer has are removed from the cache.
+    """
+    from .http import make_session
+
+    cache = Cache() if cache is None else cache
+    options = DownloadOptions() if options is None else options
+    sess = make_session(options)
+
+    beaker_item = ItemRequest(given_path, which_beaker).to_beaker_item(
+        sess, index=cache.index(), credentials=cache.credentials(), revalidate=True)
+    if not beaker_item.is_dir:
+        raise NotADirectoryError(f'{given_path} is a file within a dataset, not a dataset.')
+
+    cache_entry = DirCacheEntry(beaker_item)
+    cache_entry.set_cache(cache)
+    cache_entry.set_options(options)
+    cache_entry.set_filters(include, exclude)
+
+    cache_entry.download(sess, prune=prune)
+    _finish_entries(cache, [cache_entry])
+    return cache_entry.resolve()
+
+
+def list_files(given_path: str,
+               which_beaker: BeakerOptions = BeakerOptions.PUBLIC,
+               cache: Optional[Cache] = None,
+               options: Optional[DownloadOptions] = None,
+               refresh: bool = False) -> List[str]:
+    """The names of the files in the given dataset.
+
+    This uses the manifest that was stored the last time the dataset was downloaded or synced,
+    without talking to Beaker. If there isn't one, or with 'refresh', Beaker is asked.
+    """
+    cache = Cache() if cache is None else cache
     item_request = ItemRequest(given_path, which_beaker)
-    beaker_item = item_request.to_beaker_item(sess)
-    cache_entry = CacheEntry.from_beaker_item(beaker_item)
-    if cache is not None:
+
+    cached_entry = item_request.to_cached_entry(cache)
+    if cached_entry is not None and cached_entry.is_dir() and not refresh:
+        manifest = cached_entry.manifest()
+        if manifest is not None:
+            return [f['path'] for f in manifest]
+
+    from .http import make_session
+
+    options = DownloadOptions() if options is None else options
+    sess = make_session(options)
+
+    def fetch_names(look_up: bool) -> List[str]:
+        beaker_item = item_request.to_beaker_item(sess, index=cache.index(),
+                                                  credentials=cache.credentials(),
+                                                  revalidate=look_up)
+        if not beaker_item.is_dir:
+            raise NotADirectoryError(f'{given_path} is a file within a dataset, not a dataset.')
+
+        cache_entry = DirCacheEntry(beaker_item)
         cache_entry.set_cache(cache)
-    cache_entry.download(sess)
-    return cache_entry.cache_path()
+        cache_entry.set_options(options)
+        return [f['path'] for f in cache_entry.fetch_manifest(sess)]
+
+    try:
+        return fetch_names(False)
+    except StaleMetadataError as e:
+        # see paths()
+        _logger.info(f'{e} Looking it up again.')
+        return fetch_names(True)
@@ -0,0 +1,142 @@
+import json
+import threading
+import time
+
+from typing import Callable, Dict, List, NamedTuple, Tuple
+
+
+# What beakerstore does, as events, for whoever wants to know: e.g. to count cache hits, or to
+# see how long is spent waiting on locks. Pass a callable that takes an Event to add_sink(). It
+# is called on whichever thread the event happens on, so it should be quick, and thread-safe.
+#
+# Metrics is a sink that keeps totals, and exports them as Prometheus text or JSON:
+#
+#   metrics = beakerstore.events.Metrics()
+#   beakerstore.events.add_sink(metrics)
+#   ...
+#   print(metrics.to_prometheus())
+#
+# The events, and what is in them besides the time they happened:
+#
+#   cache_hit         kind ('dataset', 'file', or 'packed', see packs.py), key
+#   cache_miss        kind, key
+#   lookup            identifier, seconds, found (whether the dataset was found)
+#   manifest_page     dataset, files, seconds
+#   file_download     dataset, file, bytes, seconds, resumed_from, segmented
+#   dataset_download  dataset, files, bytes, seconds
+#   retry             reason, item
+#   lock_wait         item, backend, seconds
+#   lock_timeout      item, backend, seconds
+#   eviction          key
+#   integrity_failure item, problem
+#   prefetch          item, seconds, failed (see prefetch.py)
+#
+# With no sinks, emitting an event costs next to nothing. Nothing is emitted per chunk of a
+# download, only per file.
+
+
+class Event(NamedTuple):
+    name: str
+    time: float
+    fields: Dict[str, object]
+
+
+Sink = Callable[[Event], None]
+
+_sinks: List[Sink] = []
+_sinks_lock = threading.Lock()
+
+
+def add_sink(sink: Sink) -> None:
+    with _sinks_lock:
+        _sinks.append(sink)
+
+
+def remove_sink(sink: Sink) -> None:
+    with _sinks_lock:
+        _sinks.remove(sink)
+
+
+def emit(name: str, **fields) -> None:
+    if not _sinks:
+        return
+    event = Event(name, time.time(), fields)
+    for sink in list(_sinks):
+        sink(event)
+
+
+class Metrics:
+    """A sink that keeps count of events, and adds up how long they took, and how many bytes.
+
+    Each event is counted by its name, along with its low-cardinality fields (like 'kind' or
+    'reason') as labels. For fields like 'seconds' and 'bytes', the totals are kept too.
+    """
+
+    # the fields that events are broken down by. Others, like dataset ids, would be too many.
+    labels = ('kind', 'reason', 'backend', 'found', 'segmented')
+
+    # the fields that are added up
+    totals = ('seconds', 'bytes', 'files')
+
+    def __init__(self, prefix: str = 'beakerstore'):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._counts: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], int] = {}
+        self._totals: Dict[Tuple[str, str, Tuple[Tuple[str, str], ...]], float] = {}
+
+    def __call__(self, event: Event) -> None:
+        labels = tuple((k, str(event.fields[k])) for k in self.labels if k in event.fields)
+        with self._lock:
+            key = (event.name, labels)
+            self._counts[key] = self._counts.get(key, 0) + 1
+            for field in self.totals:
+                value = event.fields.get(field)
+                if value is not None:
+                    total_key = (event.name, field, labels)
+                    self._totals[total_key] = self._totals.get(total_key, 0) + value
+
+    def reset(self) -> None:
+        with self._lock:
+            self._counts.clear()
+            self._totals.clear()
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            counts = sorted(self._counts.items())
+            totals = sorted(self._totals.items())
+        return {
+            'counts': [{'event': name, 'labels': dict(labels), 'count': count}
+                       for (name, labels), count in counts],
+            'totals': [{'event': name, 'field': field, 'labels': dict(labels), 'total': total}
+                       for (name, field, labels), total in totals]
+        }
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict())
+
+    def to_prometheus(self) -> str:
+        """The metrics in the Prometheus text exposition format."""
+        with self._lock:
+            counts = sorted(self._counts.items())
+            totals = sorted(self._totals.items())
+
+        lines = []
+        metric_names = set()
+
+        def add(metric: str, labels: Tuple[Tuple[str, str], ...], value: float) -> None:
+            if metric not in metric_names:
+                metric_names.add(metric)
+                lines.append(f'# TYPE {metric} counter')
+            label_text = ','.join(f'{k}="{_escape(v)}"' for k, v in labels)
+            lines.append(f'{metric}{{{label_text}}} {value}' if label_text else f'{metric} {value}')
+
+        for (name, labels), count in counts:
+            add(f'{self.prefix}_{name}_total', labels, count)
+        for (name, field, labels), total in totals:
+            add(f'{self.prefix}_{name}_{field}_total', labels, total)
+
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
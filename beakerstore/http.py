@@ -0,0 +1,114 @@
+import email.utils
+import requests
+import time
+import urllib3
+
+from typing import Optional
+
+from . import __version__
+from . import events
+from .beakerstore import DownloadOptions, IncompleteDownloadError, _logger
+
+
+# Everything that needs requests, which takes a while to import. This is imported only once
+# something needs to be downloaded, so that using what is in the cache doesn't pay for it.
+
+
+# the responses that are worth trying again after a while
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# what a download breaking off partway through looks like
+TRANSIENT_ERRORS = (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout,
+                    requests.exceptions.ChunkedEncodingError,
+                    IncompleteDownloadError)
+
+
+class _RetryingAdapter(requests.adapters.HTTPAdapter):
+    """Sends requests with a timeout, no faster than the rate limiter allows.
+
+    Requests that fail in a way that might not last are tried again, after a backoff. The last
+    response is returned either way, to be handled like any other.
+    """
+    def __init__(self, options: DownloadOptions, **kwargs):
+        super().__init__(**kwargs)
+        self.options = options
+
+    def send(self, request: requests.PreparedRequest, **kwargs) -> requests.Response:
+        options = self.options
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = options.timeout
+
+        attempt = 0
+        while True:
+            if options.rate_limiter is not None:
+                options.rate_limiter.acquire()
+
+            retry_after = None
+            try:
+                res = super().send(request, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if attempt >= options.max_retries:
+                    raise
+                reason = type(e).__name__
+            else:
+                if res.status_code not in RETRY_STATUSES or attempt >= options.max_retries:
+                    return res
+                reason = f'status {res.status_code}'
+                retry_after = _retry_after(res)
+                if retry_after is not None and retry_after > options.max_backoff:
+                    _logger.info(f'Not trying {request.url} again, since it says to wait '
+                                 f'{retry_after:.0f} seconds ({reason}).')
+                    return res
+                res.close()
+
+            delay = options.retry_delay(attempt, retry_after)
+            _logger.info(f'Trying {request.url} again in {delay:.1f} seconds ({reason}).')
+            events.emit('retry', reason=reason, item=request.url)
+            time.sleep(delay)
+            attempt += 1
+
+
+def _retry_after(res: requests.Response) -> Optional[float]:
+    """How many seconds the Retry-After header says to wait, if there is one."""
+    value = res.headers.get('Retry-After')
+    if value is None:
+        return None
+    try:
+        return max(0., float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0., email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def read_into(res: requests.Response, buffer) -> int:
+    """Reads the next bytes of the body of 'res' into 'buffer'. Returns how many there were.
+
+    This reads through urllib3, so that the connection goes back to the pool once the body has
+    been read. It fails the way iter_content() would, e.g. with a ChunkedEncodingError if the
+    connection breaks off.
+    """
+    try:
+        return res.raw.readinto(buffer)
+    except urllib3.exceptions.ProtocolError as e:
+        raise requests.exceptions.ChunkedEncodingError(e)
+    except urllib3.exceptions.ReadTimeoutError as e:
+        raise requests.exceptions.ConnectionError(e)
+    except urllib3.exceptions.SSLError as e:
+        raise requests.exceptions.SSLError(e)
+
+
+def make_session(options: DownloadOptions) -> requests.Session:
+    sess = requests.Session()
+    sess.headers.update({'User-Agent': f'beakerstore/{__version__}'})
+
+    # requests keeps one connection pool per host. Blocking when the pool is used up is what
+    # caps the number of connections to a host.
+    adapter = _RetryingAdapter(options, pool_maxsize=options.max_connections_per_host,
+                               pool_block=True)
+    sess.mount('http://', adapter)
+    sess.mount('https://', adapter)
+    return sess
@@ -0,0 +1,465 @@
+import hashlib
+import io
+import json
+import mmap
+import os
+import shutil
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from pathlib import Path
+from typing import BinaryIO, Dict, Iterator, List, Optional, Tuple
+
+from . import events
+from .beakerstore import (BeakerOptions, BeakerstoreError, Cache, CacheLock, DirCacheEntry,
+                          DownloadOptions, FileCacheEntry, IntegrityError, ItemRequest,
+                          StaleMetadataError, _blob_key, _check_received, _logger,
+                          _map_read_only, _write_atomically)
+
+
+# Packed storage, for datasets with a great many small files.
+#
+# Normally each file of a dataset is a file in the cache. For a dataset of many small files,
+# that is a lot of files to create, lock, rename, and later open, which on a network file system
+# is where most of the time goes. packed() instead appends the small files of a dataset to a few
+# large pack files, and keeps an index of where each one is. Files larger than 'max_file_size'
+# are kept in the cache as usual.
+#
+#   dataset = beakerstore.packs.packed('ds_abc')
+#   data = dataset.read('shard-000/0001.json')
+#   with dataset.open('shard-000/0002.json') as f:
+#       ...
+#
+# The packs are in packs/{public|internal}/{dataset id}/ in the cache: pack-00000.bin and so on,
+# and index.json, which has the pack, offset and size of each packed file. They are written by
+# one process, holding the lock for the whole dataset, instead of a lock per file. A marker next
+# to the dataset's other markers says when they are complete. Read-only cache layers aren't
+# looked in for packs.
+
+
+class PackedDataset:
+    """The files of a dataset that was packed. Reading them is safe from any number of threads."""
+
+    def __init__(self, cache_entry: DirCacheEntry):
+        self.cache_entry = cache_entry
+        self.packs_path = cache_entry.packs_path()
+
+        index = json.loads((self.packs_path / 'index.json').read_text())
+
+        # name -> (pack, offset, size) for the packed files, and the names of the others
+        self._packed: Dict[str, Tuple[int, int, int]] = {n: tuple(loc)
+                                                         for n, loc in index['packed'].items()}
+        self._unpacked = set(index['unpacked'])
+
+        self._lock = threading.Lock()
+        self._fds: Dict[int, int] = {}
+        self._maps: Dict[int, mmap.mmap] = {}
+
+    def names(self) -> List[str]:
+        """The names of the files of the dataset, in order."""
+        return sorted(self._packed.keys() | self._unpacked)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._packed or name in self._unpacked
+
+    def size(self, name: str) -> int:
+        if name in self._packed:
+            return self._packed[name][2]
+        return self._unpacked_path(name).stat().st_size
+
+    def read(self, name: str) -> bytes:
+        """The contents of the file with the given name."""
+        if name not in self._packed:
+            return self._unpacked_path(name).read_bytes()
+        pack, offset, size = self._packed[name]
+        return os.pread(self._fd(pack), size, offset)
+
+    def view(self, name: str) -> memoryview:
+        """A read-only view of the file with the given name, without copying it.
+
+        The view is of a memory map of the pack it is in. Release views (or let them go) before
+        close(): a map that still has views is only closed once the last of them is released.
+        """
+        if name not in self._packed:
+            local_path = self._unpacked_path(name)
+            if local_path.stat().st_size == 0:
+                return memoryview(b'')
+            return memoryview(_map_read_only(local_path))
+        pack, offset, size = self._packed[name]
+        if size == 0:
+            return memoryview(b'')
+        return memoryview(self._map(pack))[offset:offset + size]
+
+    def open(self, name: str, buffering: int = io.DEFAULT_BUFFER_SIZE) -> BinaryIO:
+        """Opens the file with the given name for reading, in binary mode."""
+        if name not in self._packed:
+            return io.open(str(self._unpacked_path(name)), 'rb', buffering=buffering or -1)
+        pack, offset, size = self._packed[name]
+        stream = _PackedFile(self._fd(pack), offset, size, name)
+        return stream if buffering == 0 else io.BufferedReader(stream, buffer_size=buffering)
+
+    def path(self, name: str = '') -> 'PackedPath':
+        """A path-like view of the file (or directory) with the given name."""
+        return PackedPath(self, name)
+
+    def close(self) -> None:
+        with self._lock:
+            for mapped in self._maps.values():
+                try:
+                    mapped.close()
+                except BufferError:
+                    # There are views of it still. They keep it alive, and it is unmapped when
+                    # the last of them is released.
+                    pass
+            for fd in self._fds.values():
+                os.close(fd)
+            self._maps = {}
+            self._fds = {}
+
+    def __enter__(self) -> 'PackedDataset':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def _unpacked_path(self, name: str) -> Path:
+        if name not in self._unpacked:
+            raise FileNotFoundError(f'{name} is not in dataset {self.cache_entry.dataset_id()}.')
+        return self.cache_entry.local_path() / name
+
+    def _fd(self, pack: int) -> int:
+        with self._lock:
+            if pack not in self._fds:
+                self._fds[pack] = os.open(str(_pack_path(self.packs_path, pack)), os.O_RDONLY)
+            return self._fds[pack]
+
+    def _map(self, pack: int) -> mmap.mmap:
+        fd = self._fd(pack)
+        with self._lock:
+            if pack not in self._maps:
+                self._maps[pack] = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+            return self._maps[pack]
+
+
+class _PackedFile(io.RawIOBase):
+    """One file in a pack, read with positioned reads, so that it shares the pack's descriptor."""
+
+    def __init__(self, fd: int, offset: int, size: int, name: str):
+        super().__init__()
+        self.fd = fd
+        self.offset = offset
+        self.size = size
+        self.name = name
+        self._position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        n = max(0, min(len(b), self.size - self._position))
+        if n == 0:
+            return 0
+        data = os.pread(self.fd, n, self.offset + self._position)
+        n = len(data)
+        with memoryview(b) as view, view.cast('B') as target:
+            target[:n] = data
+        self._position += n
+        return n
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self._position + offset
+        elif whence == io.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError(f'Invalid whence: {whence}')
+        if position < 0:
+            raise ValueError(f'Negative seek position: {position}')
+        self._position = position
+        return position
+
+    def tell(self) -> int:
+        return self._position
+
+
+class PackedPath:
+    """A path-like view of a file, or a directory, in a packed dataset.
+
+    It has the parts of pathlib.Path that make sense for reading, so that code that walks a
+    dataset's directory can be pointed at its packs instead. It isn't a real path, though: it
+    can't be passed to things that open files by name.
+    """
+
+    def __init__(self, dataset: PackedDataset, name: str = ''):
+        self.dataset = dataset
+        self._name = name.strip('/')
+
+    @property
+    def name(self) -> str:
+        return self._name.rsplit('/', 1)[-1]
+
+    def __truediv__(self, other: str) -> 'PackedPath':
+        return PackedPath(self.dataset, f'{self._name}/{other}' if self._name else other)
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, PackedPath) and \
+            (self.dataset, self._name) == (other.dataset, other._name)
+
+    def __hash__(self) -> int:
+        return hash((id(self.dataset), self._name))
+
+    def __str__(self) -> str:
+        return f'{self.dataset.cache_entry.dataset_id()}/{self._name}'
+
+    def __repr__(self) -> str:
+        return f'PackedPath({str(self)!r})'
+
+    def is_file(self) -> bool:
+        return self._name in self.dataset
+
+    def is_dir(self) -> bool:
+        prefix = f'{self._name}/' if self._name else ''
+        return any(n.startswith(prefix) for n in self.dataset.names())
+
+    def exists(self) -> bool:
+        return self.is_file() or self.is_dir()
+
+    def iterdir(self) -> Iterator['PackedPath']:
+        prefix = f'{self._name}/' if self._name else ''
+        children = {n[len(prefix):].split('/', 1)[0]
+                    for n in self.dataset.names() if n.startswith(prefix)}
+        for child in sorted(children):
+            yield self / child
+
+    def open(self, mode: str = 'rb', buffering: int = io.DEFAULT_BUFFER_SIZE) -> BinaryIO:
+        if mode != 'rb':
+            raise ValueError(f'Packed files can only be opened with mode "rb", not "{mode}".')
+        return self.dataset.open(self._name, buffering)
+
+    def read_bytes(self) -> bytes:
+        return self.dataset.read(self._name)
+
+    def stat_size(self) -> int:
+        return self.dataset.size(self._name)
+
+
+def packed(given_path: str,
+           which_beaker: BeakerOptions = BeakerOptions.PUBLIC,
+           cache: Optional[Cache] = None,
+           options: Optional[DownloadOptions] = None,
+           max_file_size: int = 1024 * 1024,
+           pack_size: int = 256 * 1024 * 1024) -> PackedDataset:
+    """The given dataset, in packed form, downloading and packing it if need be.
+
+    Files of up to 'max_file_size' bytes go in packs of about 'pack_size' bytes. Larger ones are
+    kept in the cache as usual. These only matter when the dataset is packed: once it is, it is
+    used as it is. A dataset that was completely downloaded as usual is packed from the cache,
+    without asking Beaker.
+    """
+    cache = Cache() if cache is None else cache
+    item_request = ItemRequest(given_path, which_beaker)
+    options = DownloadOptions() if options is None else options
+
+    cached_entry = item_request.to_cached_entry(cache)
+    if cached_entry is not None and cached_entry.is_dir():
+        if cached_entry.packed_marker_path().is_file():
+            events.emit('cache_hit', kind='packed', key=cached_entry.cache_key())
+            cache.record_access(cached_entry)
+            return PackedDataset(cached_entry)
+
+        if cached_entry.marker_path().is_file() and cached_entry.manifest() is not None:
+            cached_entry.set_options(options)
+            return _pack_entry(cached_entry, None, max_file_size, pack_size)
+
+    from .http import make_session
+
+    sess = make_session(options)
+
+    def download_and_pack(look_up: bool) -> PackedDataset:
+        beaker_item = item_request.to_beaker_item(sess, index=cache.index(),
+                                                  credentials=cache.credentials(),
+                                                  revalidate=look_up)
+        if not beaker_item.is_dir:
+            raise NotADirectoryError(f'{given_path} is a file within a dataset, not a dataset.')
+
+        cache_entry = DirCacheEntry(beaker_item)
+        cache_entry.set_cache(cache)
+        cache_entry.set_options(options)
+        return _pack_entry(cache_entry, sess, max_file_size, pack_size)
+
+    try:
+        return download_and_pack(False)
+    except StaleMetadataError as e:
+        # see beakerstore.paths()
+        _logger.info(f'{e} Looking it up again.')
+        return download_and_pack(True)
+
+
+def _pack_entry(cache_entry: DirCacheEntry, sess, max_file_size: int,
+                pack_size: int) -> PackedDataset:
+    """Packs the dataset, unless someone else does it first. See _pack()."""
+    cache = cache_entry.get_cache()
+    events.emit('cache_miss', kind='packed', key=cache_entry.cache_key())
+
+    cache_entry._prepare_parent_dir()
+    lock = CacheLock(cache_entry)
+    lock.get_lock()
+    try:
+        # someone else could have packed it while this waited for the lock
+        if not cache_entry.packed_marker_path().is_file():
+            _pack(cache_entry, sess, max_file_size, pack_size)
+            _write_atomically(cache_entry.packed_marker_path(),
+                              json.dumps({'completed_at': time.time()}))
+            cache.record_entry(cache_entry)
+    finally:
+        lock.release_lock()
+
+    return PackedDataset(cache_entry)
+
+
+def _pack(cache_entry: DirCacheEntry, sess, max_file_size: int, pack_size: int) -> None:
+    """Downloads the dataset, into packs and otherwise. Only call this while holding its lock.
+
+    Without a session, the dataset is complete in the cache already, and its small files are
+    packed from there. Its large files are left where they are.
+    """
+
+    start = time.time()
+    options = cache_entry.get_options()
+    manifest = cache_entry.manifest() if sess is None else cache_entry.fetch_manifest(sess)
+    small = [f for f in manifest if f.get('size') is not None and f['size'] <= max_file_size]
+    large = [f for f in manifest if f.get('size') is None or f['size'] > max_file_size]
+
+    # whatever is here is from an attempt that didn't finish
+    packs_path = cache_entry.packs_path()
+    shutil.rmtree(str(packs_path), ignore_errors=True)
+    packs_path.mkdir(parents=True, exist_ok=True)
+
+    packed: Dict[str, Tuple[int, int, int]] = {}
+    total_bytes = 0
+    with ThreadPoolExecutor(max_workers=options.max_workers) as executor:
+        if sess is None:
+            large_futures = []
+            get_contents = _read_cached
+        else:
+            large_entries = [cache_entry.dir_to_file(f['path'], f.get('size'), f.get('digest'))
+                             for f in large]
+            large_futures = [executor.submit(e.download, sess) for e in large_entries]
+            get_contents = partial(_get_contents, sess=sess)
+
+        # The small files are gotten several at a time, and written out in the order of the
+        # manifest, a batch at a time so that not too many are held in memory.
+        writer = _PackWriter(packs_path, pack_size)
+        try:
+            batch_size = 4 * options.max_workers
+            for i in range(0, len(small), batch_size):
+                batch = [cache_entry.dir_to_file(f['path'], f.get('size'), f.get('digest'))
+                         for f in small[i:i + batch_size]]
+                for file_entry, contents in zip(batch, executor.map(get_contents, batch)):
+                    packed[file_entry.file_name] = writer.append(contents)
+                    total_bytes += len(contents)
+        finally:
+            writer.close()
+
+        total_bytes += sum(future.result() for future in large_futures)
+
+    _write_atomically(packs_path / 'index.json', json.dumps({
+        'packed': packed,
+        'unpacked': [f['path'] for f in large]
+    }))
+
+    seconds = time.time() - start
+    _logger.info(f'Packed {len(packed)} files of dataset {cache_entry.dataset_id()} into '
+                 f'{writer.pack + 1} packs in {seconds:.1f} seconds.')
+    if sess is not None:
+        events.emit('dataset_download', dataset=cache_entry.dataset_id(), files=len(manifest),
+                    bytes=total_bytes, seconds=seconds)
+
+
+def _read_cached(file_entry: FileCacheEntry) -> bytes:
+    return file_entry.local_path().read_bytes()
+
+
+def _get_contents(file_entry: FileCacheEntry, sess) -> bytes:
+    """Downloads a small file into memory, checking it against the manifest."""
+    from .http import TRANSIENT_ERRORS
+
+    options = file_entry.get_options()
+    attempt = 0
+    while True:
+        try:
+            res = file_entry.beaker_item.make_one_file_download_request(file_entry.file_name, sess)
+            try:
+                if res.status_code != 200:
+                    raise BeakerstoreError((f'Unable to get the requested file. '
+                                            f'Response code: {res.status_code}.'))
+                contents = res.content
+                _check_received(res, len(contents))
+            finally:
+                res.close()
+            break
+        except TRANSIENT_ERRORS as e:
+            if attempt >= options.max_retries:
+                raise
+            delay = options.retry_delay(attempt)
+            events.emit('retry', reason='interrupted', item=file_entry.item_name())
+            _logger.info(f'Getting {file_entry.file_name} of dataset {file_entry.dataset_id()} '
+                         f'broke off ({type(e).__name__}). Trying again in {delay:.1f} seconds.')
+            time.sleep(delay)
+            attempt += 1
+
+    file_entry._throttle(len(contents))
+
+    problem = None
+    if file_entry.size is not None and len(contents) != file_entry.size:
+        problem = f'Expected {file_entry.size} bytes, got {len(contents)}.'
+    expected = None if file_entry.digest is None else _blob_key(file_entry.digest)
+    if problem is None and expected is not None:
+        algorithm = expected.split('/', 1)[0]
+        computed = f'{algorithm}/{hashlib.new(algorithm, contents).hexdigest()}'
+        if computed != expected:
+            problem = f'Expected digest {file_entry.digest}, got {computed}.'
+    if problem is not None:
+        events.emit('integrity_failure', item=file_entry.item_name(), problem=problem)
+        raise IntegrityError(f'{file_entry.file_name} of dataset {file_entry.dataset_id()} is not '
+                             f'right. {problem}')
+
+    return contents
+
+
+def _pack_path(packs_path: Path, pack: int) -> Path:
+    return packs_path / f'pack-{pack:05}.bin'
+
+
+class _PackWriter:
+    """Appends files to packs, starting a new pack once the current one is full."""
+
+    def __init__(self, packs_path: Path, pack_size: int):
+        self.packs_path = packs_path
+        self.pack_size = pack_size
+        self.pack = 0
+        self._offset = 0
+        self._f = _pack_path(packs_path, 0).open('wb')
+
+    def append(self, contents: bytes) -> Tuple[int, int, int]:
+        """Writes 'contents' to the current pack. Returns the pack, the offset, and the size."""
+        if self._offset > 0 and self._offset + len(contents) > self.pack_size:
+            self._f.close()
+            self.pack += 1
+            self._offset = 0
+            self._f = _pack_path(self.packs_path, self.pack).open('wb')
+
+        location = (self.pack, self._offset, len(contents))
+        self._f.write(contents)
+        self._offset += len(contents)
+        return location
+
+    def close(self) -> None:
+        self._f.close()
@@ -0,0 +1,267 @@
+import argparse
+import json
+import os
+import signal
+import socket
+import threading
+import time
+import uuid
+
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence
+
+from . import events
+from .beakerstore import (BeakerOptions, Cache, DownloadOptions, RateLimiter, _logger,
+                          _process_exists, _write_atomically, enable_logging, paths)
+
+
+# A prefetch daemon: a long-running process that gets datasets and files into a cache before
+# the jobs that need them ask for them. Anyone on the node can submit() a request to the cache's
+# spool directory. The daemon takes the requests in order of priority, and downloads what they
+# ask for, with all its downloads sharing one bandwidth budget.
+#
+#   beakerstore-prefetch run --bandwidth 100000000 &
+#   beakerstore-prefetch submit ds_abc --priority 10
+#
+# Nothing changes for the jobs themselves: path() finds what the daemon got in the cache, and
+# for a file that the daemon is in the middle of getting, waits on that download (by way of the
+# file's lock) rather than starting another.
+#
+# The spool is a directory of JSON files, one per request. A daemon claims a request by moving
+# it into spool/active, under a name with its host and process id, so several daemons can share
+# a spool. It touches the requests it is working on every so often, so that daemons on other
+# hosts can tell that they aren't abandoned. Requests that fail are moved to spool/failed, along
+# with the error.
+
+
+def submit(given_path: str,
+           which_beaker: BeakerOptions = BeakerOptions.PUBLIC,
+           cache: Optional[Cache] = None,
+           priority: int = 0,
+           include: Optional[Sequence[str]] = None,
+           exclude: Optional[Sequence[str]] = None) -> Path:
+    """Asks the prefetch daemon to get the given dataset, or file within a dataset, into the cache.
+
+    Requests with a higher 'priority' are taken first, and of those, the ones submitted first.
+    'include' and 'exclude' are as in path(). Returns the path of the request in the spool.
+    """
+    cache = Cache() if cache is None else cache
+    request = {
+        'path': given_path,
+        'which_beaker': which_beaker.value,
+        'priority': priority,
+        'include': None if include is None else list(include),
+        'exclude': None if exclude is None else list(exclude),
+        'submitted_at': time.time()
+    }
+    request_path = cache.spool_loc() / f'{uuid.uuid4().hex}.json'
+    _write_atomically(request_path, json.dumps(request))
+    return request_path
+
+
+class Prefetcher:
+    """Takes requests from the spool of a cache, and gets what they ask for into the cache.
+
+    Up to 'max_requests' requests are worked on at the same time, each downloading up to
+    options.max_workers files at once. To limit the bandwidth used, give the options a
+    bandwidth_limiter.
+    """
+    def __init__(self,
+                 cache: Optional[Cache] = None,
+                 options: Optional[DownloadOptions] = None,
+                 max_requests: int = 2,
+                 poll_interval: float = 1.,
+                 claim_timeout: float = 10 * 60.):
+        self.cache = Cache() if cache is None else cache
+        self.options = DownloadOptions() if options is None else options
+        self.max_requests = max_requests
+
+        # how many seconds to wait between looks at the spool, when there is nothing to do
+        self.poll_interval = poll_interval
+
+        # A request claimed by a daemon on another host is taken to be abandoned once it hasn't
+        # been touched for this many seconds. Ones claimed on this host are put back as soon as
+        # the daemon that claimed them is gone.
+        self.claim_timeout = claim_timeout
+
+        self._stop = threading.Event()
+
+    def active_loc(self) -> Path:
+        return self.cache.spool_loc() / 'active'
+
+    def failed_loc(self) -> Path:
+        return self.cache.spool_loc() / 'failed'
+
+    def pending(self) -> List[Path]:
+        """The requests waiting in the spool, in the order they are to be taken."""
+        found = []
+        for request_path in self.cache.spool_loc().glob('*.json'):
+            try:
+                request = json.loads(request_path.read_text())
+                found.append((-request['priority'], request['submitted_at'], request_path))
+            except FileNotFoundError:
+                # someone else took it
+                pass
+            except (ValueError, KeyError) as e:
+                _logger.warning(f'Unable to read the prefetch request {request_path}: {e}')
+                self._fail(request_path, {}, e)
+        return [request_path for _, _, request_path in sorted(found)]
+
+    def run(self, until_empty: bool = False) -> int:
+        """Takes requests until stop() is called, or with 'until_empty', until there are none left.
+
+        Returns how many requests were taken.
+        """
+        taken = 0
+        running: Dict[Future, Path] = {}
+        with ThreadPoolExecutor(max_workers=self.max_requests) as executor:
+            while not self._stop.is_set():
+                running = {f: claimed for f, claimed in running.items() if not f.done()}
+                for claimed in running.values():
+                    _touch(claimed)
+                self._requeue_abandoned()
+
+                pending = self.pending()
+                for request_path in pending[:self.max_requests - len(running)]:
+                    claimed = self._claim(request_path)
+                    if claimed is not None:
+                        running[executor.submit(self._fetch, claimed)] = claimed
+                        taken += 1
+
+                if until_empty and not running and not pending:
+                    break
+                if running:
+                    wait(running, timeout=self.poll_interval, return_when=FIRST_COMPLETED)
+                else:
+                    self._stop.wait(self.poll_interval)
+        return taken
+
+    def stop(self) -> None:
+        """Has run() return once the requests it is working on are done."""
+        self._stop.set()
+
+    def _claim(self, request_path: Path) -> Optional[Path]:
+        """Moves a request into the active directory. Returns where to, or None if it was gone."""
+        claimed = self.active_loc() / f'{socket.gethostname()}-{os.getpid()}-{request_path.name}'
+        if not claimed.parent.is_dir():
+            claimed.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            os.rename(str(request_path), str(claimed))
+        except FileNotFoundError:
+            return None
+        return claimed
+
+    def _requeue_abandoned(self) -> None:
+        """Puts back the requests that were claimed by daemons that are no longer running."""
+        for claimed in self.active_loc().glob('*.json'):
+            # host names can have dashes in them, but process ids and request names don't
+            host, pid, name = (claimed.name.rsplit('-', 2) + ['', ''])[:3]
+            if not pid.isdigit() or not name:
+                continue
+            try:
+                age = time.time() - claimed.stat().st_mtime
+            except FileNotFoundError:
+                continue
+
+            if host == socket.gethostname():
+                abandoned = not _process_exists(int(pid))
+            else:
+                abandoned = age > self.claim_timeout
+            if not abandoned:
+                continue
+
+            _logger.info(f'Putting back the prefetch request {name}, abandoned by process {pid} '
+                         f'on {host}.')
+            try:
+                os.rename(str(claimed), str(self.cache.spool_loc() / name))
+            except FileNotFoundError:
+                pass
+
+    def _fetch(self, claimed: Path) -> None:
+        request = json.loads(claimed.read_text())
+        given_path = request['path']
+        start = time.time()
+        try:
+            _logger.info(f'Prefetching {given_path}.')
+            paths([given_path], BeakerOptions(request['which_beaker']), self.cache, self.options,
+                  include=request['include'], exclude=request['exclude'])
+        except Exception as e:
+            _logger.warning(f'Unable to prefetch {given_path}: {e}')
+            self._fail(claimed, request, e)
+            events.emit('prefetch', item=given_path, seconds=time.time() - start, failed=True)
+        else:
+            claimed.unlink()
+            events.emit('prefetch', item=given_path, seconds=time.time() - start, failed=False)
+
+    def _fail(self, request_path: Path, request: dict, error: Exception) -> None:
+        _write_atomically(self.failed_loc() / request_path.name,
+                          json.dumps({**request, 'error': repr(error)}))
+        try:
+            request_path.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def _touch(claimed: Path) -> None:
+    try:
+        os.utime(str(claimed))
+    except FileNotFoundError:
+        pass
+
+
+def main(args: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(
+        description='Gets Beaker datasets and files into the cache ahead of time.')
+    parser.add_argument('--cache-dir', type=Path, help='the cache. Defaults to the usual one.')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    run_parser = subparsers.add_parser('run', help='take requests, until stopped')
+    run_parser.add_argument('--bandwidth', type=float,
+                            help='the most bytes a second to download, across the daemons on the '
+                                 'cache')
+    run_parser.add_argument('--max-workers', type=int, default=8,
+                            help='files to download at once, per request')
+    run_parser.add_argument('--max-requests', type=int, default=2,
+                            help='requests to work on at once')
+    run_parser.add_argument('--poll-interval', type=float, default=1.)
+    run_parser.add_argument('--once', action='store_true',
+                            help='stop once there are no requests left')
+
+    submit_parser = subparsers.add_parser('submit',
+                                          help='ask for datasets, or files within datasets')
+    submit_parser.add_argument('path', nargs='+')
+    submit_parser.add_argument('--priority', type=int, default=0, help='higher is sooner')
+    submit_parser.add_argument('--internal', action='store_true', help='from internal Beaker')
+    submit_parser.add_argument('--include', action='append',
+                               help='a glob pattern for which files to get')
+    submit_parser.add_argument('--exclude', action='append',
+                               help='a glob pattern for which files not to get')
+
+    parsed = parser.parse_args(args)
+    enable_logging()
+    cache = Cache(parsed.cache_dir)
+
+    if parsed.command == 'submit':
+        which_beaker = BeakerOptions.INTERNAL if parsed.internal else BeakerOptions.PUBLIC
+        for given_path in parsed.path:
+            submit(given_path, which_beaker, cache, parsed.priority, parsed.include, parsed.exclude)
+        return
+
+    bandwidth_limiter = None
+    if parsed.bandwidth is not None:
+        bandwidth_limiter = RateLimiter(parsed.bandwidth,
+                                        state_path=cache.meta_loc() / 'prefetch-bandwidth.json')
+    options = DownloadOptions(max_workers=parsed.max_workers, bandwidth_limiter=bandwidth_limiter)
+    prefetcher = Prefetcher(cache, options, parsed.max_requests, parsed.poll_interval)
+
+    signal.signal(signal.SIGTERM, lambda *_: prefetcher.stop())
+    try:
+        prefetcher.run(until_empty=parsed.once)
+    except KeyboardInterrupt:
+        prefetcher.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,30 @@
+import asyncio
+import datetime
+import json
 import pytest
 import os
+import requests
+import socket
+import subprocess
+import sys
+import threading
+import time
 import unittest
 
+from contextlib import contextmanager
+from unittest import mock
+
 from pathlib import Path
 
-from .. import path, BeakerOptions
-from ..beakerstore import Cache, DatasetNotFoundError
+from .. import (events, http, list_files, memory_map, packs, path, paths, prefetch, sync, using,
+                view, BeakerOptions)
+from .. import open as beakerstore_open
+from ..beakerstore import (BeakerItem, BeakerstoreError, Cache, CacheEntry, CacheLock,
+                           CredentialCache, DatasetNotFoundError, DownloadOptions, EvictionPolicy,
+                           FollowStream, IncompleteDownloadError, IntegrityError, ItemRequest,
+                           LockBackend, LockTimeoutError, MetadataIndex, Promotion, RateLimiter,
+                           Revalidate, Verification, _token_expiry)
+from .mock_beaker import MockBeaker, MockDataset
 
 
 @pytest.fixture(scope='class')
@@ -13,6 +32,18 @@ def cache_test_dir(request, tmpdir_factory):
     request.cls.tmpdir = tmpdir_factory.mktemp('cache_test_dir')
 
 
+@pytest.fixture(scope='class')
+def mock_beaker(request):
+    request.cls.mock = MockBeaker(page_size=50).start()
+
+    # Beaker itself is stood in for by the mock too
+    with mock.patch.object(ItemRequest, '_get_beaker_dataset_url',
+                           lambda _, identifier: request.cls.mock.dataset_url(identifier)):
+        yield
+
+    request.cls.mock.stop()
+
+
 class TestBeakerstore(unittest.TestCase):
 
     def single_directory_helper(self, directory, which_beaker, test_cache, exp_num_files):
@@ -111,3 +142,1070 @@ class TestBeakerStoreInternal(TestBeakerstore):
                                 test_cache=test_cache)
         self.nonexistent_helper('chloea/nonexistent', which_beaker=BeakerOptions.INTERNAL,
                                 test_cache=test_cache)
+
+
+@pytest.mark.usefixtures('cache_test_dir', 'mock_beaker')
+class TestBeakerStoreMock(unittest.TestCase):
+
+    def make_dataset(self, dataset_id, num_files, file_size=100, author_and_name=None):
+        files = {f'file{i:04}.txt': bytes([i % 256]) * file_size for i in range(num_files)}
+        dataset = MockDataset(dataset_id, files, author_and_name=author_and_name)
+        self.mock.add_dataset(dataset)
+        return dataset
+
+    def make_entry(self, dataset, file_name=None, cache=None, options=None):
+        beaker_item = BeakerItem(file_name is None, self.mock.beaker_info(dataset), file_name)
+        entry = CacheEntry.from_beaker_item(beaker_item)
+        entry.set_cache(Cache(Path(str(self.tmpdir))) if cache is None else cache)
+        if options is not None:
+            entry.set_options(options)
+        return entry
+
+    def test_parallel_directory_download(self):
+        dataset = self.make_dataset('ds_parallel', num_files=175)
+        entry = self.make_entry(dataset, options=DownloadOptions(max_workers=8))
+
+        with requests.Session() as sess:
+            self.assertEqual(entry.download(sess), 175 * 100)
+
+            # everything is there now, so nothing more is downloaded
+            self.assertEqual(entry.download(sess), 0)
+
+        self.assertEqual(sorted(os.listdir(str(entry.cache_path()))), sorted(dataset.files))
+        for name, contents in dataset.files.items():
+            self.assertEqual((entry.cache_path() / name).read_bytes(), contents)
+
+    def test_complete_entries_skip_beaker(self):
+        test_cache = Cache(Path(str(self.tmpdir)))
+        dataset = self.make_dataset('ds_complete', num_files=3)
+        entry = self.make_entry(dataset, cache=test_cache)
+
+        with requests.Session() as sess:
+            entry.download(sess)
+        entry.mark_complete()
+
+        # None of these talk to Beaker: there is no Beaker to talk to for this dataset.
+        self.assertEqual(path('ds_complete', cache=test_cache), entry.cache_path())
+        self.assertEqual(path('ds_complete/file0001.txt', cache=test_cache),
+                         entry.cache_path() / 'file0001.txt')
+        self.assertEqual(path('ds_complete', cache=test_cache, revalidate=Revalidate.TTL, ttl=60),
+                         entry.cache_path())
+
+        # These do go to Beaker
+        for revalidate in [Revalidate.ALWAYS, Revalidate.TTL]:
+            num_requests = self.mock.request_counts.get('api', 0)
+            self.assertEqual(path('ds_complete', cache=test_cache, revalidate=revalidate, ttl=0),
+                             entry.cache_path())
+            self.assertEqual(self.mock.request_counts['api'], num_requests + 1)
+
+    def test_metadata_index(self):
+        test_cache = Cache(Path(str(self.tmpdir)))
+        dataset = self.make_dataset('ds_indexed', num_files=2)
+        beaker_info = dict(self.mock.beaker_info(dataset), name='indexed',
+                           author={'name': 'someone'})
+
+        index = test_cache.index()
+        self.assertIsNone(index.alias_target(BeakerOptions.PUBLIC, 'someone/indexed'))
+        index.record(BeakerOptions.PUBLIC, 'ds_indexed', beaker_info)
+
+        self.assertEqual(index.alias_target(BeakerOptions.PUBLIC, 'someone/indexed'), 'ds_indexed')
+        self.assertIsNone(index.alias_target(BeakerOptions.INTERNAL, 'someone/indexed'))
+        self.assertNotIn('token', index.dataset_info(BeakerOptions.PUBLIC, 'ds_indexed')['storage'])
+
+        # the alias works without Beaker once the dataset is in the cache
+        entry = self.make_entry(dataset, cache=test_cache)
+        with requests.Session() as sess:
+            entry.download(sess)
+        entry.mark_complete()
+        self.assertEqual(path('someone/indexed/file0001.txt', cache=test_cache),
+                         entry.cache_path() / 'file0001.txt')
+
+        cached_entry = ItemRequest('someone/indexed').to_cached_entry(test_cache)
+        self.assertEqual(cached_entry.cache_path(), entry.cache_path())
+
+        # A known alias isn't looked up again, and a storage token is only gotten when something
+        # has to be downloaded.
+        self.make_dataset('ds_lazy', num_files=3, author_and_name='someone/lazy')
+        path('someone/lazy/file0000.txt', cache=test_cache)
+        test_cache.credentials().forget(BeakerOptions.PUBLIC, 'ds_lazy')
+        api_requests = self.mock.request_counts['api']
+        CacheEntry.from_cache_key('public/ds_lazy/file0000.txt', test_cache).marker_path().unlink()
+        path('someone/lazy/file0000.txt', cache=test_cache)
+        self.assertEqual(self.mock.request_counts['api'], api_requests)
+        path('someone/lazy/file0001.txt', cache=test_cache)
+        path('someone/lazy/file0002.txt', cache=test_cache)
+        self.assertEqual(self.mock.request_counts['api'], api_requests + 1)
+
+        # another process forgetting the dataset is noticed by this one
+        other = MetadataIndex(index.db_path)
+        other.forget_dataset(BeakerOptions.PUBLIC, 'ds_indexed')
+        self.assertIsNone(index.alias_target(BeakerOptions.PUBLIC, 'someone/indexed'))
+        self.assertIsNone(index.dataset_info(BeakerOptions.PUBLIC, 'ds_indexed'))
+
+    def test_stale_index(self):
+        test_cache = Cache(Path(str(self.tmpdir.mkdir('stale_index'))))
+        index = test_cache.index()
+        credentials = test_cache.credentials()
+
+        # a name that moved to another dataset, with the old one deleted, is looked up again,
+        # whether or not there is a token for the old one
+        for name, forget_token in (('someone/moved', True), ('someone/moved-with-token', False)):
+            old = self.make_dataset(f'ds_old_{forget_token}', num_files=2, author_and_name=name)
+            path(f'{name}/file0000.txt', cache=test_cache)
+            if forget_token:
+                credentials.forget(BeakerOptions.PUBLIC, old.dataset_id)
+            self.mock.remove_dataset(old)
+            new = self.make_dataset(f'ds_new_{forget_token}', num_files=2, file_size=200,
+                                    author_and_name=name)
+
+            p = path(f'{name}/file0001.txt', cache=test_cache)
+            self.assertEqual(p.read_bytes(), new.files['file0001.txt'])
+            self.assertEqual(index.alias_target(BeakerOptions.PUBLIC, name), new.dataset_id)
+            self.assertIsNone(index.dataset_info(BeakerOptions.PUBLIC, old.dataset_id))
+
+        # and so is one whose dataset is still there, but goes by another name now
+        renamed = self.make_dataset('ds_renamed', num_files=2, author_and_name='someone/renamed')
+        path('someone/renamed/file0000.txt', cache=test_cache)
+        credentials.forget(BeakerOptions.PUBLIC, 'ds_renamed')
+        self.mock.remove_dataset(renamed)
+        self.mock.add_dataset(MockDataset('ds_renamed', renamed.files,
+                                          author_and_name='someone/other'))
+        taken = self.make_dataset('ds_taken', num_files=2, file_size=200,
+                                  author_and_name='someone/renamed')
+        with beakerstore_open('someone/renamed/file0001.txt', cache=test_cache) as f:
+            self.assertEqual(f.read(), taken.files['file0001.txt'])
+        self.assertEqual(index.alias_target(BeakerOptions.PUBLIC, 'someone/renamed'), 'ds_taken')
+
+    def test_lock_hand_off(self):
+        dataset = self.make_dataset('ds_locked', num_files=1)
+        entry = self.make_entry(dataset, file_name='file0000.txt')
+        entry._prepare_parent_dir()
+
+        holder = CacheLock(entry)
+        holder.get_lock()
+        self.assertFalse(CacheLock(entry).try_lock())
+        with self.assertRaises(LockTimeoutError):
+            CacheLock(entry).get_lock(timeout=0.05)
+
+        acquired = []
+
+        def wait_for_lock():
+            waiter = CacheLock(entry)
+            waiter.get_lock()
+            acquired.append(time.time())
+            waiter.release_lock()
+
+        thread = threading.Thread(target=wait_for_lock)
+        thread.start()
+        time.sleep(0.1)
+        released = time.time()
+        holder.release_lock()
+        thread.join()
+
+        self.assertLess(acquired[0] - released, 0.5)
+        self.assertFalse(Path(f'{entry.cache_path()}.lock').exists())
+
+    def test_abandoned_file_lock(self):
+        test_cache = Cache(Path(str(self.tmpdir)), lock_backend=LockBackend.FILE, lock_timeout=5)
+        dataset = self.make_dataset('ds_abandoned', num_files=1)
+        entry = self.make_entry(dataset, file_name='file0000.txt', cache=test_cache)
+        entry._prepare_parent_dir()
+
+        # a lock file left behind by a process on this host that is no longer around
+        dead = subprocess.Popen([sys.executable, '-c', 'pass'])
+        dead.wait()
+        Path(f'{entry.cache_path()}.lock').write_text(f'{socket.gethostname()} {dead.pid}\n')
+
+        lock = CacheLock(entry)
+        lock.get_lock()
+        lock.release_lock()
+
+        # A lock that is held is touched every so often, so that other hosts don't take it for
+        # abandoned. Once it has been taken over, it isn't removed by the one who had it.
+        lock_loc = Path(f'{entry.cache_path()}.lock')
+        lock = CacheLock(entry)
+        lock.stale_after = 0.2
+        lock.get_lock()
+        os.utime(str(lock_loc), (0, 0))
+        time.sleep(0.3)
+        self.assertGreater(lock_loc.stat().st_mtime, time.time() - 1)
+        lock_loc.write_text('otherhost 1234\n')
+        lock.release_lock()
+        self.assertEqual(lock_loc.read_text(), 'otherhost 1234\n')
+
+    def test_resume_interrupted_download(self):
+        contents = os.urandom(1024 * 1024)
+        dataset = MockDataset('ds_resume', {'big.bin': contents})
+        self.mock.add_dataset(dataset)
+        entry = self.make_entry(dataset, file_name='big.bin',
+                                options=DownloadOptions(segment_threshold=None, max_retries=0))
+
+        self.mock.drop_after = 700 * 1024
+        try:
+            with requests.Session() as sess:
+                with self.assertRaises(requests.exceptions.RequestException):
+                    entry.download(sess)
+        finally:
+            self.mock.drop_after = None
+
+        received = entry.partial_download().size()
+        self.assertGreater(received, 0)
+        self.assertFalse(entry.already_exists())
+
+        with requests.Session() as sess:
+            self.assertEqual(entry.download(sess), len(contents) - received)
+
+        self.assertEqual(self.mock.ranges_requested[-1], f'bytes={received}-')
+        self.assertEqual(entry.cache_path().read_bytes(), contents)
+        self.assertFalse(entry.partial_download().path.exists())
+        self.assertFalse(entry.partial_download().sidecar_path.exists())
+
+        # With urllib3 1.x, the connection going away looks like the end of the body. That is
+        # noticed, and carried on from, rather than the first part of the file taken for all of it.
+        for i, options in enumerate((
+                DownloadOptions(segment_threshold=None, max_retries=0),
+                DownloadOptions(segment_threshold=None, max_retries=0, write_buffers=2),
+                DownloadOptions(segment_threshold=None, max_retries=0, mapped_writes=True))):
+            entry = self.make_entry(dataset, file_name='big.bin', options=options,
+                                    cache=Cache(Path(str(self.tmpdir.mkdir(f'urllib3_1_{i}')))))
+            with self.urllib3_1_reads():
+                with self.assertRaises(IncompleteDownloadError):
+                    with requests.Session() as sess:
+                        entry.download(sess)
+                self.assertFalse(entry.already_exists())
+                self.assertEqual(entry.partial_download().size(), 700 * 1024)
+
+                options.max_retries = 1
+                with requests.Session() as sess:
+                    entry.download(sess)
+            self.assertEqual(entry.cache_path().read_bytes(), contents)
+
+        # and reading it as it downloads fails, instead of ending early, and is carried on from
+        test_cache = Cache(Path(str(self.tmpdir.mkdir('urllib3_1_stream'))))
+        with self.urllib3_1_reads():
+            with beakerstore_open('ds_resume/big.bin', cache=test_cache) as f:
+                with self.assertRaises(IncompleteDownloadError):
+                    f.read()
+        received = CacheEntry.from_cache_key('public/ds_resume/big.bin',
+                                             test_cache).partial_download().size()
+        self.assertGreater(received, 0)
+        with beakerstore_open('ds_resume/big.bin', cache=test_cache) as f:
+            self.assertEqual(f.read(), contents)
+        self.assertEqual(self.mock.ranges_requested[-1], f'bytes={received}-')
+
+    @contextmanager
+    def urllib3_1_reads(self):
+        """Has responses cut off after 700KiB, and reading them end there without an error."""
+        read_into = http.read_into
+
+        def read_into_without_error(res, buffer):
+            try:
+                return read_into(res, buffer)
+            except requests.exceptions.RequestException:
+                return 0
+
+        self.mock.drop_after = 700 * 1024
+        try:
+            with mock.patch.object(http, 'read_into', read_into_without_error):
+                yield
+        finally:
+            self.mock.drop_after = None
+
+    def test_resume_without_range_support(self):
+        contents = os.urandom(512 * 1024)
+        dataset = MockDataset('ds_no_ranges', {'big.bin': contents})
+        self.mock.add_dataset(dataset)
+        entry = self.make_entry(dataset, file_name='big.bin',
+                                options=DownloadOptions(segment_threshold=None))
+
+        partial = entry.partial_download()
+        partial.path.write_bytes(b'something that is not part of the file')
+
+        self.mock.support_ranges = False
+        try:
+            with requests.Session() as sess:
+                self.assertEqual(entry.download(sess), len(contents))
+        finally:
+            self.mock.support_ranges = True
+
+        self.assertEqual(entry.cache_path().read_bytes(), contents)
+
+    def test_segmented_download(self):
+        contents = os.urandom(1024 * 1024 + 123)
+        dataset = MockDataset('ds_segmented', {'big.bin': contents, 'other.bin': contents})
+        self.mock.add_dataset(dataset)
+        options = DownloadOptions(segment_threshold=0, segment_size=64 * 1024, segment_workers=4)
+
+        num_requests = len(self.mock.ranges_requested)
+        entry = self.make_entry(dataset, file_name='big.bin', options=options)
+        with requests.Session() as sess:
+            self.assertEqual(entry.download(sess), len(contents))
+
+        self.assertEqual(entry.cache_path().read_bytes(), contents)
+        self.assertEqual(len(self.mock.ranges_requested) - num_requests, 17)
+        self.assertFalse(entry.partial_download().sidecar_path.exists())
+
+        # without range support, it's one request for everything
+        num_requests = len(self.mock.ranges_requested)
+        self.mock.support_ranges = False
+        try:
+            entry = self.make_entry(dataset, file_name='other.bin', options=options)
+            with requests.Session() as sess:
+                self.assertEqual(entry.download(sess), len(contents))
+        finally:
+            self.mock.support_ranges = True
+
+        self.assertEqual(entry.cache_path().read_bytes(), contents)
+        self.assertEqual(len(self.mock.ranges_requested) - num_requests, 1)
+
+        # the segments of a file only get the connections that max_workers has to spare
+        options = DownloadOptions(max_workers=2, segment_threshold=0, segment_size=64 * 1024,
+                                  segment_workers=4)
+        entry = self.make_entry(dataset, file_name='big.bin', options=options,
+                                cache=Cache(Path(str(self.tmpdir.mkdir('segment_workers')))))
+        self.mock.bandwidth = 2 * 1024 * 1024
+        self.mock.max_files_in_flight = 0
+        try:
+            with requests.Session() as sess:
+                self.assertEqual(entry.download(sess), len(contents))
+        finally:
+            self.mock.bandwidth = None
+        self.assertEqual(self.mock.max_files_in_flight, 2)
+        self.assertEqual(options._connections, 0)
+
+        # a segment that ends short is carried on with, like any download that breaks off
+        options = DownloadOptions(segment_threshold=0, segment_size=768 * 1024, max_retries=0)
+        entry = self.make_entry(dataset, file_name='big.bin', options=options,
+                                cache=Cache(Path(str(self.tmpdir.mkdir('short_segment')))))
+        with self.urllib3_1_reads():
+            with self.assertRaises(IncompleteDownloadError):
+                with requests.Session() as sess:
+                    entry.download(sess)
+        self.assertIsNotNone(entry.partial_download().segments_state())
+
+        with requests.Session() as sess:
+            entry.download(sess)
+        self.assertEqual(entry.cache_path().read_bytes(), contents)
+
+    def test_eviction(self):
+        test_cache = Cache(Path(str(self.tmpdir.mkdir('eviction'))), max_bytes=2500,
+                           eviction_grace=0)
+        entries = []
+        for i in range(4):
+            dataset = self.make_dataset(f'ds_evict{i}', num_files=10)
+            entry = self.make_entry(dataset, cache=test_cache)
+            with requests.Session() as sess:
+                entry.download(sess)
+            entry.mark_complete()
+            test_cache.record_entry(entry)
+            entries.append(entry)
+            time.sleep(0.01)
+
+        self.assertEqual(test_cache.index().total_size(), 4000)
+
+        # The oldest one was used recently, and the third one is in use, by another process as
+        # far as this Cache knows. A lease left behind by a process that is gone doesn't count.
+        test_cache.record_access(entries[0])
+        dead = subprocess.Popen([sys.executable, '-c', 'pass'])
+        dead.wait()
+        with test_cache.index()._lock:
+            test_cache.index()._conn.execute(
+                'INSERT INTO leases VALUES (?, ?, ?, ?)',
+                (entries[1].cache_key(), socket.gethostname(), dead.pid, time.time()))
+        with Cache(test_cache.base_path).in_use(entries[2]):
+            self.assertEqual(test_cache.gc(), 2000)
+
+        self.assertTrue(entries[0].is_complete())
+        self.assertFalse(entries[1].is_complete())
+        self.assertFalse(entries[1].cache_path().exists())
+        self.assertTrue(entries[2].is_complete())
+        self.assertFalse(entries[3].is_complete())
+        self.assertEqual(test_cache.index().total_size(), 2000)
+
+        # with LFU, the one that was used twice stays
+        test_cache.eviction_policy = EvictionPolicy.LFU
+        self.assertEqual(test_cache.gc(max_bytes=1000), 1000)
+        self.assertTrue(entries[0].is_complete())
+        self.assertFalse(entries[2].is_complete())
+
+        # what using() gives isn't evicted until the with block is left
+        with using('ds_evict0', cache=Cache(test_cache.base_path)) as p:
+            self.assertEqual(p, entries[0].cache_path())
+            self.assertEqual(test_cache.gc(max_bytes=0), 0)
+        self.assertEqual(test_cache.gc(max_bytes=0), 1000)
+
+    def test_paths(self):
+        test_cache = Cache(Path(str(self.tmpdir)))
+        first = self.make_dataset('ds_batch1', num_files=60, author_and_name='someone/batch1')
+        second = self.make_dataset('ds_batch2', num_files=5)
+
+        given_paths = ['ds_batch1', 'someone/batch1', 'ds_batch1/file0003.txt',
+                       'ds_batch2/file0001.txt', 'ds_batch2/file0002.txt']
+        num_requests = self.mock.request_counts.get('files', 0)
+        result = paths(given_paths, cache=test_cache)
+
+        self.assertEqual(list(result), given_paths)
+        self.assertEqual(result['ds_batch1'], result['someone/batch1'])
+        self.assertEqual(len(os.listdir(str(result['ds_batch1']))), 60)
+        self.assertEqual(result['ds_batch1/file0003.txt'], result['ds_batch1'] / 'file0003.txt')
+        self.assertEqual(result['ds_batch2/file0002.txt'].read_bytes(),
+                         second.files['file0002.txt'])
+
+        # each file was downloaded once
+        self.assertEqual(self.mock.request_counts.get('files', 0) - num_requests, 62)
+        self.assertEqual(paths(given_paths, cache=test_cache), result)
+
+        with self.assertRaises(DatasetNotFoundError):
+            paths(['ds_batch1', 'nonexistent'], cache=test_cache)
+
+    def test_content_addressed(self):
+        test_cache = Cache(Path(str(self.tmpdir.mkdir('content_addressed'))),
+                           content_addressed=True)
+        shared = {f'shared{i}.bin': os.urandom(1000) for i in range(5)}
+        first = MockDataset('ds_version1', dict(shared, **{'only1.bin': os.urandom(1000)}))
+        second = MockDataset('ds_version2', dict(shared, **{'only2.bin': os.urandom(1000)}))
+        for dataset in (first, second):
+            self.mock.add_dataset(dataset)
+
+        num_requests = self.mock.request_counts.get('files', 0)
+        with requests.Session() as sess:
+            self.assertEqual(self.make_entry(first, cache=test_cache).download(sess), 6000)
+            self.assertEqual(self.make_entry(second, cache=test_cache).download(sess), 1000)
+        self.assertEqual(self.mock.request_counts.get('files', 0) - num_requests, 7)
+
+        entry = self.make_entry(second, cache=test_cache)
+        for name, contents in second.files.items():
+            self.assertEqual((entry.cache_path() / name).read_bytes(), contents)
+        self.assertEqual((entry.cache_path() / 'shared0.bin').stat().st_nlink, 3)
+
+        # a file without a digest is hashed while it is downloaded
+        single = self.make_entry(first, file_name='only1.bin', cache=test_cache,
+                                 options=DownloadOptions(segment_threshold=None))
+        single.cache_path().unlink()
+        with requests.Session() as sess:
+            single.download(sess)
+        self.assertEqual(single.cache_path().stat().st_nlink, 2)
+
+        # blobs that nothing links to anymore can be removed
+        (entry.cache_path() / 'only2.bin').unlink()
+        self.assertEqual(test_cache.prune_blobs(), 1000)
+
+        # the ledger counts each blob once, and evicting frees the blobs nothing else links to
+        for dataset in (first, second):
+            entry = self.make_entry(dataset, cache=test_cache)
+            entry.mark_complete()
+            test_cache.record_entry(entry)
+        self.assertEqual(test_cache.index().total_size(), 6000)
+        test_cache.eviction_grace = 0
+        self.assertEqual(test_cache.gc(max_bytes=0), 6000)
+        self.assertEqual(test_cache.index().total_size(), 0)
+        self.assertFalse(any(p.is_file() for p in test_cache.blobs_loc().rglob('*')))
+
+    def test_integrity(self):
+        test_cache = Cache(Path(str(self.tmpdir.mkdir('integrity'))))
+        dataset = self.make_dataset('ds_integrity', num_files=20)
+        entry = self.make_entry(dataset, cache=test_cache)
+        with requests.Session() as sess:
+            entry.download(sess)
+        entry.mark_complete()
+        self.assertEqual(test_cache.verify(entry), [])
+
+        # same size, different contents
+        corrupt = entry.cache_path() / 'file0003.txt'
+        corrupt.write_bytes(b'x' * 100)
+        truncated = entry.cache_path() / 'file0007.txt'
+        truncated.write_bytes(b'x' * 10)
+
+        self.assertEqual(test_cache.verify(entry, Verification.SIZE), [truncated])
+        self.assertEqual(test_cache.verify(entry, Verification.FULL), [corrupt, truncated])
+
+        # with verify on read, the bad files are noticed and downloaded again
+        test_cache.verify_on_read = Verification.FULL
+        self.assertFalse(entry.is_complete())
+        with requests.Session() as sess:
+            self.assertEqual(entry.download(sess), 200)
+        self.assertEqual(corrupt.read_bytes(), dataset.files['file0003.txt'])
+
+        # what is downloaded is checked against the manifest
+        entry.cache_path().joinpath('file0001.txt').unlink()
+        dataset.files['file0001.txt'] = b'not what the manifest says'
+        real_manifest_entry = dataset.manifest_entry
+        dataset.manifest_entry = lambda name: dict(real_manifest_entry(name), size=100)
+        with requests.Session() as sess:
+            with self.assertRaises(IntegrityError):
+                entry.download(sess)
+
+    def test_apath(self):
+        from .. import apath
+
+        test_cache = Cache(Path(str(self.tmpdir.mkdir('async'))))
+        dataset = self.make_dataset('ds_async', num_files=130, author_and_name='someone/async')
+        options = DownloadOptions(max_workers=64)
+
+        async def get_all():
+            return await asyncio.gather(
+                apath('someone/async', cache=test_cache, options=options),
+                apath('ds_async/file0005.txt', cache=test_cache, options=options))
+
+        dirpath, filepath = asyncio.run(get_all())
+        self.assertEqual(sorted(os.listdir(str(dirpath))), sorted(dataset.files))
+        self.assertEqual(filepath.read_bytes(), dataset.files['file0005.txt'])
+
+        # cached now
+        self.assertEqual(asyncio.run(apath('ds_async', cache=test_cache)), dirpath)
+
+    def test_open(self):
+        test_cache = Cache(Path(str(self.tmpdir.mkdir('open'))))
+        dataset = MockDataset('ds_open', {'big.bin': os.urandom(300000)})
+        self.mock.add_dataset(dataset)
+        contents = dataset.files['big.bin']
+
+        # read part of it, and stop: what was read stays behind to be resumed
+        with beakerstore_open('ds_open/big.bin', cache=test_cache) as f:
+            self.assertEqual(f.read(1000), contents[:1000])
+        entry = test_cache.cache_base() / 'public' / 'ds_open' / 'big.bin'
+        self.assertFalse(entry.exists())
+
+        self.mock.ranges_requested.clear()
+        with beakerstore_open('ds_open/big.bin', cache=test_cache, buffering=0) as f:
+            buf = bytearray(4096)
+            read = bytearray()
+            n = f.readinto(buf)
+            while n:
+                read += buf[:n]
+                n = f.readinto(buf)
+        self.assertEqual(bytes(read), contents)
+        self.assertIsNotNone(self.mock.ranges_requested[0])
+
+        # it was put in the cache on the way
+        self.assertEqual(entry.read_bytes(), contents)
+        files_requests = self.mock.request_counts.get('files', 0)
+        with beakerstore_open('ds_open/big.bin', cache=test_cache) as f:
+            self.assertEqual(f.read(), contents)
+        self.assertEqual(self.mock.request_counts.get('files', 0), files_requests)
+
+        with self.assertRaises(IsADirectoryError):
+            beakerstore_open('ds_open', cache=test_cache)
+
+    def test_filters(self):
+        test_cache = Cache(Path(str(self.tmpdir.mkdir('filters'))))
+        files = {f'shard{s}/part{i}.{ext}': b'x' * 10 for s in range(3) for i in range(4)
+                 for ext in ('idx', 'bin')}
+        dataset = MockDataset('ds_filters', files)
+        self.mock.add_dataset(dataset)
+
+        def files_requests():
+            return self.mock.request_counts.get('files', 0)
+
+        before = files_requests()
+        p = path('ds_filters', cache=test_cache, include=['*.idx'], exclude=['shard2/*'])
+        got = sorted(str(f.relative_to(p)) for f in p.rglob('*') if f.is_file())
+        self.assertEqual(got, sorted(f for f in files
+                                     if f.endswith('.idx') and not f.startswith('shard2/')))
+        self.assertEqual(files_requests() - before, 8)
+
+        # the same subset again is complete already
+        manifest_requests = self.mock.request_counts.get('manifest', 0)
+        path('ds_filters', cache=test_cache, include=['*.idx'], exclude=['shard2/*'])
+        self.assertEqual(self.mock.request_counts.get('manifest', 0), manifest_requests)
+
+        # more of it only gets what is missing
+        before = files_requests()
+        path('ds_filters', cache=test_cache, include=['*.idx'])
+        self.assertEqual(files_requests() - before, 4)
+
+        # and a file that was asked for by name is gotten even if the filters leave it out
+        before = files_requests()
+        ps = paths(['ds_filters', 'ds_filters/shard0/part0.bin'], cache=test_cache,
+                   include=['shard0/*'])
+        self.assertTrue(ps['ds_filters/shard0/part0.bin'].is_file())
+        self.assertEqual(files_requests() - before, 4)
+
+        # all of it
+        before = files_requests()
+        p = path('ds_filters', cache=test_cache)
+        self.assertEqual(sum(1 for f in p.rglob('*') if f.is_file()), len(files))
+        self.assertEqual(files_requests() - before, len(files) - 16)
+
+    def test_layers(self):
+        shared = Cache(Path(str(self.tmpdir.mkdir('shared'))))
+        dataset = self.make_dataset('ds_layered', num_files=5)
+        other = self.make_dataset('ds_layered_other', num_files=5)
+        shared_dir = path('ds_layered', cache=shared)
+        path('ds_layered_other/file0001.txt', cache=shared)
+
+        # used from where it is, without asking Beaker
+        self.mock.remove_dataset(dataset)
+        local = Cache(Path(str(self.tmpdir.mkdir('local'))), layers=[shared.cache_base()])
+        self.assertEqual(path('ds_layered', cache=local), shared_dir)
+        self.assertEqual(path('ds_layered/file0002.txt', cache=local), shared_dir / 'file0002.txt')
+        self.assertFalse((local.cache_base() / 'public' / 'ds_layered').exists())
+
+        # copied over
+        promoting = Cache(Path(str(self.tmpdir.mkdir('promoting'))), layers=[shared.cache_base()],
+                          promotion=Promotion.COPY)
+        p = path('ds_layered', cache=promoting)
+        self.assertEqual(p, promoting.cache_base() / 'public' / 'ds_layered')
+        self.assertEqual(sorted(os.listdir(str(p))), sorted(dataset.files))
+        self.assertFalse((p / 'file0000.txt').is_symlink())
+        self.assertEqual(path('ds_layered', cache=promoting), p)
+
+        # the rest of a dataset that the layer only has some of is downloaded
+        files_requests = self.mock.request_counts.get('files', 0)
+        p = path('ds_layered_other', cache=local)
+        self.assertEqual(sorted(os.listdir(str(p))), sorted(other.files))
+        self.assertTrue((p / 'file0001.txt').is_symlink())
+        self.assertEqual(self.mock.request_counts.get('files', 0) - files_requests, 4)
+
+    def test_injected_errors(self):
+        dataset = self.make_dataset('ds_errors', num_files=1)
+        test_cache = Cache(Path(str(self.tmpdir.mkdir('errors'))))
+        entry = self.make_entry(dataset, 'file0000.txt', cache=test_cache,
+                                options=DownloadOptions(max_retries=0))
+
+        self.mock.error_rate = 1.
+        try:
+            with requests.Session() as sess:
+                with self.assertRaises(BeakerstoreError):
+                    entry.download(sess)
+        finally:
+            self.mock.error_rate = 0.
+        self.assertGreater(self.mock.request_counts.get('errors', 0), 0)
+
+    def test_events(self):
+        test_cache = Cache(Path(str(self.tmpdir.mkdir('events'))))
+        self.make_dataset('ds_events', num_files=60)
+
+        metrics = events.Metrics()
+        seen = []
+        events.add_sink(metrics)
+        events.add_sink(seen.append)
+        try:
+            path('ds_events', cache=test_cache)
+            path('ds_events', cache=test_cache)
+        finally:
+            events.remove_sink(metrics)
+            events.remove_sink(seen.append)
+
+        names = [e.name for e in seen]
+        self.assertEqual(names.count('cache_miss'), 1)
+        self.assertEqual(names.count('cache_hit'), 1)
+        self.assertEqual(names.count('manifest_page'), 2)
+        self.assertEqual(names.count('file_download'), 60)
+
+        counts = {(c['event'], tuple(sorted(c['labels'].items()))): c['count']
+                  for c in json.loads(metrics.to_json())['counts']}
+        self.assertEqual(counts[('cache_hit', (('kind', 'dataset'),))], 1)
+        self.assertEqual(counts[('file_download', (('segmented', 'False'),))], 60)
+
+        prometheus = metrics.to_prometheus()
+        self.assertIn('beakerstore_cache_miss_total{kind="dataset"} 1', prometheus)
+        self.assertIn('beakerstore_file_download_bytes_total{segmented="False"} 6000', prometheus)
+        self.assertIn('# TYPE beakerstore_dataset_download_seconds_total counter', prometheus)
+
+    def test_retries(self):
+        test_cache = Cache(Path(str(self.tmpdir.mkdir('retries'))))
+        dataset = self.make_dataset('ds_retries', num_files=40)
+        big = MockDataset('ds_retries_big', {'big.bin': os.urandom(1024 * 1024)})
+        self.mock.add_dataset(big)
+        limiter = RateLimiter(1000, state_path=test_cache.meta_loc() / 'rate')
+        options = DownloadOptions(backoff=0.01, max_retries=10, segment_threshold=None,
+                                  rate_limiter=limiter)
+
+        retries = []
+
+        def sink(event):
+            if event.name == 'retry':
+                retries.append(event.fields['reason'])
+
+        events.add_sink(sink)
+        self.mock.error_rate = 0.3
+        self.mock.error_retry_after = '0'
+        try:
+            p = path('ds_retries', cache=test_cache, options=options)
+        finally:
+            self.mock.error_rate = 0.
+            self.mock.error_retry_after = None
+        self.assertEqual(sorted(os.listdir(str(p))), sorted(dataset.files))
+        self.assertIn('status 503', retries)
+
+        # waits are kept to max_backoff, and a server that asks for longer isn't waited for
+        self.assertLessEqual(options.retry_delay(0, 3600.), options.max_backoff)
+        self.mock.error_rate = 1.
+        self.mock.error_retry_after = '3600'
+        num_requests = self.mock.request_counts.get('files', 0)
+        try:
+            with self.assertRaises(BeakerstoreError):
+                path('ds_retries_big/big.bin', cache=test_cache, options=options)
+        finally:
+            self.mock.error_rate = 0.
+            self.mock.error_retry_after = None
+        self.assertEqual(self.mock.request_counts.get('files', 0) - num_requests, 1)
+
+        # a download that breaks off carries on from where it got to
+        self.mock.drop_after = 400 * 1024
+        self.mock.ranges_requested.clear()
+        try:
+            p = path('ds_retries_big/big.bin', cache=test_cache, options=options)
+        finally:
+            self.mock.drop_after = None
+            events.remove_sink(sink)
+        self.assertEqual(p.read_bytes(), big.files['big.bin'])
+        self.assertIn('interrupted', retries)
+        self.assertIsNone(self.mock.ranges_requested[0])
+        self.assertRegex(self.mock.ranges_requested[1], r'^bytes=[1-9][0-9]*-$')
+
+    def test_one_download_per_file(self):
+        test_cache = Cache(Path(str(self.tmpdir.mkdir('coordination'))))
+        dataset = self.make_dataset('ds_coordination', num_files=20)
+
+        # someone else is downloading one of the files
+        held = self.make_entry(dataset, 'file0007.txt', cache=test_cache)
+        held._prepare_parent_dir()
+        lock = CacheLock(held)
+        lock.get_lock()
+
+        files_requests = self.mock.request_counts.get('files', 0)
+        result = {}
+        thread = threading.Thread(
+            target=lambda: result.update(p=path('ds_coordination', cache=test_cache)))
+        thread.start()
+
+        # the other files are downloaded in the meantime
+        others = [test_cache.cache_base() / 'public' / 'ds_coordination' / n
+                  for n in dataset.files if n != 'file0007.txt']
+        deadline = time.time() + 10
+        while not all(p.exists() for p in others) and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(all(p.exists() for p in others))
+        self.assertTrue(thread.is_alive())
+
+        held.local_path().write_bytes(dataset.files['file0007.txt'])
+        lock.release_lock()
+        thread.join()
+
+        self.assertEqual(sorted(os.listdir(str(result['p']))), sorted(dataset.files))
+        self.assertEqual(self.mock.request_counts.get('files', 0) - files_requests, 19)
+
+    def test_follow_download(self):
+        test_cache = Cache(Path(str(self.tmpdir.mkdir('follow'))))
+        dataset = MockDataset('ds_follow', {'big.bin': os.urandom(2 * 1024 * 1024)})
+        self.mock.add_dataset(dataset)
+        contents = dataset.files['big.bin']
+        files_requests = self.mock.request_counts.get('files', 0)
+
+        leader = beakerstore_open('ds_follow/big.bin', cache=test_cache, buffering=0)
+        first = leader.read(64 * 1024)
+
+        followed = []
+        follower = beakerstore_open('ds_follow/big.bin', cache=test_cache)
+        self.assertIsInstance(follower.raw, FollowStream)
+        thread = threading.Thread(target=lambda: followed.append(follower.read()))
+        thread.start()
+
+        rest = bytearray()
+        chunk = leader.read(64 * 1024)
+        while chunk:
+            rest += chunk
+            chunk = leader.read(64 * 1024)
+        leader.close()
+        thread.join(10)
+        follower.close()
+
+        self.assertEqual(first + bytes(rest), contents)
+        self.assertEqual(followed, [contents])
+        self.assertEqual(self.mock.request_counts.get('files', 0) - files_requests, 1)
+
+    def test_warm_lookup_imports(self):
+        test_cache_dir = self.tmpdir.mkdir('warm')
+        dataset = self.make_dataset('ds_warm', num_files=2)
+        path('ds_warm', cache=Cache(Path(str(test_cache_dir))))
+
+        # in a new process, so that what is imported is only what the lookup needs
+        code = (f'import sys; from pathlib import Path; import beakerstore; '
+                f'from beakerstore.beakerstore import Cache; '
+                f'p = beakerstore.path("ds_warm/file0001.txt", '
+                f'cache=Cache(Path({str(test_cache_dir)!r}))); '
+                f'print(p.read_bytes() == {dataset.files["file0001.txt"]!r}, '
+                f'"requests" in sys.modules)')
+        output = subprocess.check_output([sys.executable, '-c', code],
+                                         cwd=str(Path(__file__).parent.parent.parent))
+        self.assertEqual(output.split(), [b'True', b'False'])
+
+    def test_sync(self):
+        test_cache = Cache(Path(str(self.tmpdir.mkdir('sync'))))
+        dataset = self.make_dataset('ds_sync', num_files=4)
+        dataset_path = path('ds_sync', cache=test_cache)
+
+        # the files are listed from the stored manifest, without asking Beaker
+        requests_before = dict(self.mock.request_counts)
+        self.assertEqual(list_files('ds_sync', cache=test_cache), sorted(dataset.files))
+        self.assertEqual(self.mock.request_counts, requests_before)
+
+        dataset.files['file0001.txt'] = b'changed'
+        dataset.files['file0009.txt'] = b'new'
+        del dataset.files['file0002.txt']
+
+        files_requests = self.mock.request_counts['files']
+        self.assertEqual(sync('ds_sync', cache=test_cache), dataset_path)
+
+        # only what is new or changed is downloaded, and what is gone stays until pruned
+        self.assertEqual(self.mock.request_counts['files'] - files_requests, 2)
+        self.assertEqual((dataset_path / 'file0001.txt').read_bytes(), b'changed')
+        self.assertEqual((dataset_path / 'file0009.txt').read_bytes(), b'new')
+        self.assertTrue((dataset_path / 'file0002.txt').is_file())
+
+        # files whose lock is held are left alone, along with the temporary files next to them
+        locks = [CacheLock(CacheEntry.from_cache_key(f'public/ds_sync/{name}', test_cache))
+                 for name in ('file0002.txt', 'file0003.txt')]
+        for lock in locks:
+            lock.get_lock()
+        tmp_file = dataset_path / f'.file0003.txt.{os.getpid()}.1.tmp'
+        tmp_file.write_bytes(b'partly')
+        sync('ds_sync', cache=test_cache, prune=True)
+        self.assertTrue((dataset_path / 'file0002.txt').is_file())
+        self.assertTrue(tmp_file.is_file())
+        for lock in locks:
+            lock.release_lock()
+
+        sync('ds_sync', cache=test_cache, prune=True)
+        self.assertEqual(self.mock.request_counts['files'] - files_requests, 2)
+        self.assertEqual(sorted(os.listdir(str(dataset_path))), sorted(dataset.files))
+        self.assertEqual(list_files('ds_sync', cache=test_cache), sorted(dataset.files))
+        self.assertEqual(path('ds_sync', cache=test_cache), dataset_path)
+
+        # a file that changed is noticed even when the sync that went past it didn't want it
+        dataset.files['file0000.txt'] = b'changed too'
+        sync('ds_sync', cache=test_cache, include=['file0001.txt'])
+        self.assertFalse((dataset_path / 'file0000.txt').exists())
+        self.assertEqual(path('ds_sync/file0000.txt', cache=test_cache).read_bytes(),
+                         b'changed too')
+        self.assertEqual((path('ds_sync', cache=test_cache) / 'file0000.txt').read_bytes(),
+                         b'changed too')
+
+    def test_prefetch(self):
+        test_cache = Cache(Path(str(self.tmpdir.mkdir('prefetch'))))
+        self.make_dataset('ds_prefetch_later', num_files=3)
+        self.make_dataset('ds_prefetch_sooner', num_files=2, file_size=1000)
+
+        prefetch.submit('ds_prefetch_later', cache=test_cache)
+        prefetch.submit('ds_prefetch_sooner', cache=test_cache, priority=5)
+        prefetch.submit('ds_prefetch_missing', cache=test_cache, priority=-5)
+
+        seen = []
+        events.add_sink(seen.append)
+        try:
+            # a thousand bytes a second, so the second file of ds_prefetch_sooner waits a second
+            options = DownloadOptions(bandwidth_limiter=RateLimiter(1000))
+            prefetcher = prefetch.Prefetcher(test_cache, options, max_requests=1,
+                                             poll_interval=0.01)
+            start = time.time()
+            self.assertEqual(prefetcher.run(until_empty=True), 3)
+        finally:
+            events.remove_sink(seen.append)
+
+        self.assertGreater(time.time() - start, 0.9)
+        self.assertEqual([(e.fields['item'], e.fields['failed'])
+                          for e in seen if e.name == 'prefetch'],
+                         [('ds_prefetch_sooner', False), ('ds_prefetch_later', False),
+                          ('ds_prefetch_missing', True)])
+        self.assertEqual(prefetcher.pending(), [])
+        self.assertEqual(len(list(prefetcher.failed_loc().glob('*.json'))), 1)
+
+        # Requests claimed by a daemon that is gone are put back: on this host once its process
+        # is, and on other hosts once they haven't been touched for a while.
+        dead = subprocess.Popen([sys.executable, '-c', 'pass'])
+        dead.wait()
+        active = prefetcher.active_loc()
+        claims = ((f'{socket.gethostname()}-{dead.pid}', 'a'), ('other-host-1', 'b'),
+                  ('other-host-2', 'c'))
+        for claimer, name in claims:
+            (active / f'{claimer}-{name}.json').write_text(
+                json.dumps({'priority': 0, 'submitted_at': 0}))
+        os.utime(str(active / 'other-host-2-c.json'), (0, 0))
+        prefetcher._requeue_abandoned()
+        self.assertEqual([p.name for p in active.glob('*.json')], ['other-host-1-b.json'])
+        self.assertEqual(sorted(p.name for p in prefetcher.pending()), ['a.json', 'c.json'])
+
+        # what was prefetched is there for the taking
+        requests_before = dict(self.mock.request_counts)
+        self.assertEqual(len(os.listdir(str(path('ds_prefetch_later', cache=test_cache)))), 3)
+        self.assertEqual(len(os.listdir(str(path('ds_prefetch_sooner', cache=test_cache)))), 2)
+        self.assertEqual(self.mock.request_counts, requests_before)
+
+    def test_memory_map(self):
+        test_cache = Cache(Path(str(self.tmpdir.mkdir('mapped'))))
+        contents = os.urandom(1024 * 1024)
+        dataset = MockDataset('ds_mapped', {'big.bin': contents, 'empty.bin': b''})
+        self.mock.add_dataset(dataset)
+        options = DownloadOptions(segment_threshold=None, max_retries=0, mapped_writes=True)
+
+        # written through a memory map, and cut short
+        entry = self.make_entry(dataset, file_name='big.bin', cache=test_cache, options=options)
+        self.mock.drop_after = 700 * 1024
+        try:
+            with requests.Session() as sess:
+                with self.assertRaises(requests.exceptions.RequestException):
+                    entry.download(sess)
+        finally:
+            self.mock.drop_after = None
+
+        # what is left is only what was received, so it carries on from there
+        received = entry.partial_download().size()
+        self.assertGreater(received, 0)
+        self.assertLess(received, len(contents))
+        self.assertNotIn('mapped', entry.partial_download().sidecar())
+
+        mapped = memory_map('ds_mapped/big.bin', cache=test_cache, options=options)
+        self.assertEqual(self.mock.ranges_requested[-1], f'bytes={received}-')
+        with mapped:
+            self.assertEqual(len(mapped), len(contents))
+            self.assertEqual(mapped[:], contents)
+            with self.assertRaises(TypeError):
+                mapped[0] = 0
+
+        contents_view = view('ds_mapped/big.bin', cache=test_cache)
+        self.assertTrue(contents_view.readonly)
+        self.assertEqual(contents_view[1000:2000], contents[1000:2000])
+        contents_view.release()
+
+        self.assertEqual(view('ds_mapped/empty.bin', cache=test_cache, options=options), b'')
+        with self.assertRaises(ValueError):
+            memory_map('ds_mapped/empty.bin', cache=test_cache)
+        with self.assertRaises(IsADirectoryError):
+            memory_map('ds_mapped', cache=test_cache)
+
+    def test_packed(self):
+        test_cache = Cache(Path(str(self.tmpdir.mkdir('packed'))))
+        files = {f'shard-{i // 50}/{i:04}.json': f'{{"n": {i}}}'.encode('utf-8')
+                 for i in range(120)}
+        files['big.bin'] = os.urandom(4096)
+        files['empty.txt'] = b''
+        self.mock.add_dataset(MockDataset('ds_packed', files))
+        options = DownloadOptions(max_workers=4)
+
+        with packs.packed('ds_packed', cache=test_cache, options=options, max_file_size=1024,
+                          pack_size=1000) as dataset:
+            self.assertEqual(dataset.names(), sorted(files))
+            for name, contents in files.items():
+                self.assertEqual(dataset.read(name), contents)
+                self.assertEqual(dataset.view(name), contents)
+                with dataset.open(name) as f:
+                    self.assertEqual(f.read(), contents)
+
+            with dataset.open('shard-1/0077.json') as f:
+                f.seek(2)
+                self.assertEqual(f.read(4), b'n": ')
+
+            root = dataset.path()
+            self.assertEqual([p.name for p in root.iterdir()],
+                             ['big.bin', 'empty.txt', 'shard-0', 'shard-1', 'shard-2'])
+            self.assertTrue((root / 'shard-2').is_dir())
+            self.assertEqual((root / 'shard-2' / '0100.json').read_bytes(), b'{"n": 100}')
+            self.assertFalse((root / 'shard-3').exists())
+
+        # the small files are in a few packs, and the large one is kept as usual
+        packs_path = test_cache.packs_loc() / 'public' / 'ds_packed'
+        self.assertEqual(sorted(p.name for p in packs_path.iterdir())[-1], 'pack-00001.bin')
+        self.assertFalse((test_cache.base_path / 'public' / 'ds_packed' / 'shard-0').exists())
+        self.assertTrue((test_cache.base_path / 'public' / 'ds_packed' / 'big.bin').is_file())
+
+        # after that, it is used as it is, without asking Beaker
+        requests_before = dict(self.mock.request_counts)
+        with packs.packed('ds_packed', cache=test_cache) as dataset:
+            self.assertEqual(dataset.read('shard-0/0001.json'), b'{"n": 1}')
+            view = dataset.view('shard-0/0001.json')
+        self.assertEqual(self.mock.request_counts, requests_before)
+
+        # a view that outlives the dataset keeps its pack mapped until it is released
+        self.assertEqual(view, b'{"n": 1}')
+        view.release()
+
+        # a dataset that was downloaded as usual is packed from the cache
+        dataset = self.make_dataset('ds_unpacked', num_files=30)
+        path('ds_unpacked', cache=test_cache)
+        requests_before = dict(self.mock.request_counts)
+        with packs.packed('ds_unpacked', cache=test_cache) as packed_dataset:
+            self.assertEqual(packed_dataset.names(), sorted(dataset.files))
+            self.assertEqual(packed_dataset.read('file0007.txt'), dataset.files['file0007.txt'])
+        self.assertEqual(self.mock.request_counts, requests_before)
+
+    def test_credentials(self):
+        test_cache = Cache(Path(str(self.tmpdir.mkdir('credentials'))), share_credentials=True)
+        dataset = self.make_dataset('ds_credentials', num_files=40)
+        path('ds_credentials/file0000.txt', cache=test_cache)
+
+        # the storage token is kept, so the next file doesn't need a lookup
+        api_requests = self.mock.request_counts['api']
+        path('ds_credentials/file0001.txt', cache=test_cache)
+        self.assertEqual(self.mock.request_counts['api'], api_requests)
+
+        # When the token is rejected, the workers that find that out all wait on one lookup, and
+        # carry on with the new token.
+        self.mock.rotate_token(dataset)
+        rejected = self.mock.request_counts.get('rejected', 0)
+        dataset_path = path('ds_credentials', cache=test_cache,
+                            options=DownloadOptions(max_workers=8))
+        self.assertEqual(self.mock.request_counts['api'], api_requests + 1)
+        self.assertGreater(self.mock.request_counts['rejected'], rejected)
+        self.assertEqual(sorted(os.listdir(str(dataset_path))), sorted(dataset.files))
+
+        # the new token is in the cache too, for other processes, and only they can read it
+        credentials_path = test_cache.meta_loc() / 'credentials.json'
+        self.assertEqual(os.stat(str(credentials_path)).st_mode & 0o777, 0o600)
+        shared = CredentialCache(credentials_path)
+        self.assertEqual(shared.get(BeakerOptions.PUBLIC, 'ds_credentials')['token'],
+                         self.mock.beaker_info(dataset)['storage']['token'])
+
+        # asking to check with Beaker still does
+        path('ds_credentials/file0002.txt', cache=test_cache, revalidate=Revalidate.ALWAYS)
+        self.assertEqual(self.mock.request_counts['api'], api_requests + 2)
+
+        # expiry times are taken with their time zone, and to the second
+        expected = datetime.datetime(2030, 1, 2, 3, 4, 5, tzinfo=datetime.timezone.utc).timestamp()
+        for expires in ('2030-01-02T03:04:05Z', '2030-01-02T03:04:05.123456789Z',
+                        '2030-01-02T05:04:05+02:00', '2030-01-02T03:04:05'):
+            self.assertEqual(int(_token_expiry({'tokenExpires': expires})), expected)
+
+    def test_buffered_writes(self):
+        test_cache = Cache(Path(str(self.tmpdir.mkdir('buffered'))))
+        contents = os.urandom(3 * 1024 * 1024 + 12345)
+        dataset = MockDataset('ds_buffered', {'big.bin': contents, 'small.bin': b'small'})
+        self.mock.add_dataset(dataset)
+        options = DownloadOptions(segment_threshold=None, max_retries=0, write_buffers=2,
+                                  min_chunk_size=16 * 1024, max_chunk_size=256 * 1024,
+                                  preallocate=True, fadvise=True)
+
+        # made full size up front, and cut down to what was received when it breaks off
+        entry = self.make_entry(dataset, file_name='big.bin', cache=test_cache, options=options)
+        self.mock.drop_after = 1024 * 1024
+        try:
+            with requests.Session() as sess:
+                with self.assertRaises(requests.exceptions.RequestException):
+                    entry.download(sess)
+        finally:
+            self.mock.drop_after = None
+        self.assertEqual(entry.partial_download().size(), 1024 * 1024)
+
+        # carried on from there, with the rest written while more is received
+        buffered = path('ds_buffered/big.bin', cache=test_cache, options=options)
+        self.assertEqual(buffered.read_bytes(), contents)
+        self.assertEqual(self.mock.ranges_requested[-1], f'bytes={1024 * 1024}-')
+
+        # and without a thread to write with
+        for name in ('big.bin', 'small.bin'):
+            other_cache = Cache(Path(str(self.tmpdir.mkdir(f'unthreaded-{name}'))))
+            self.assertEqual(path(f'ds_buffered/{name}', cache=other_cache).read_bytes(),
+                             dataset.files[name])
+
+    def test_connection_reuse(self):
+        test_cache = Cache(Path(str(self.tmpdir.mkdir('connections'))))
+        dataset = self.make_dataset('ds_connections', 20, file_size=200 * 1024)
+        connections = self.mock.request_counts.get('connections', 0)
+        files_requests = self.mock.request_counts.get('files', 0)
+
+        # the lookup, the manifest and all the files go over the connections of the pool
+        options = DownloadOptions(max_workers=2)
+        path('ds_connections', cache=test_cache, options=options)
+        self.assertEqual(self.mock.request_counts['files'] - files_requests, 20)
+        self.assertLessEqual(self.mock.request_counts['connections'] - connections, 2)
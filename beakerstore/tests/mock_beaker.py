@@ -0,0 +1,279 @@
+import base64
+import hashlib
+import json
+import random
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs, unquote, urlparse
+
+
+# A small stand-in for the fileheap storage that Beaker datasets live in, so that tests
+# can run without talking to Beaker.
+
+
+class MockDataset:
+    def __init__(self,
+                 dataset_id: str,
+                 files: Dict[str, bytes],
+                 storage_id: Optional[str] = None,
+                 author_and_name: Optional[str] = None):
+        self.dataset_id = dataset_id
+        self.files = files
+        self.storage_id = f'st_{dataset_id}' if storage_id is None else storage_id
+        self.author_and_name = author_and_name
+
+    def manifest_entry(self, name: str) -> dict:
+        contents = self.files[name]
+        digest = base64.b64encode(hashlib.sha256(contents).digest()).decode('ascii')
+        return {'path': name, 'size': len(contents), 'digest': f'SHA256 {digest}'}
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class MockBeaker:
+    """Serves the Beaker dataset API, and the fileheap manifest and file endpoints."""
+    def __init__(self, page_size: int = 1000):
+        self.page_size = page_size
+
+        # by storage id, and by dataset id or author/name
+        self.datasets: Dict[str, MockDataset] = {}
+        self.api_datasets: Dict[str, MockDataset] = {}
+        self.request_counts: Dict[str, int] = {}
+
+        # the storage token of each dataset, by storage id. Fileheap requests without it get a 403.
+        self.tokens: Dict[str, str] = {}
+
+        # whether Range headers are honored
+        self.support_ranges = True
+
+        # if set, responses with files are cut off after this many bytes
+        self.drop_after: Optional[int] = None
+
+        # the Range headers of the file requests received
+        self.ranges_requested: List[Optional[str]] = []
+
+        # the most file requests that were being answered at the same time
+        self.max_files_in_flight = 0
+        self._files_in_flight = 0
+
+        # seconds to wait before answering each request
+        self.latency = 0.
+
+        # if set, each response with a file is sent at no more than this many bytes per second
+        self.bandwidth: Optional[int] = None
+
+        # the fraction of file requests that fail with 'error_status' instead, and the Retry-After
+        # header that comes with them, if any
+        self.error_rate = 0.
+        self.error_status = 503
+        self.error_retry_after: Optional[str] = None
+        self._random = random.Random(0)
+
+        self._lock = threading.Lock()
+
+        self._server = _ThreadingHTTPServer(('127.0.0.1', 0), self._make_handler())
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self) -> 'MockBeaker':
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def add_dataset(self, dataset: MockDataset) -> None:
+        self.datasets[dataset.storage_id] = dataset
+        self.api_datasets[dataset.dataset_id] = dataset
+        if dataset.author_and_name is not None:
+            self.api_datasets[dataset.author_and_name] = dataset
+
+    def remove_dataset(self, dataset: MockDataset) -> None:
+        for datasets in (self.datasets, self.api_datasets):
+            for key in [k for k, d in datasets.items() if d is dataset]:
+                del datasets[key]
+
+    def rotate_token(self, dataset: MockDataset) -> None:
+        """Gives the dataset a new storage token, so that the one handed out before is rejected."""
+        with self._lock:
+            self.tokens[dataset.storage_id] = f'mock-token-{len(self.tokens)}-{time.time()}'
+
+    def dataset_url(self, identifier: str) -> str:
+        """What the Beaker dataset API url for 'identifier' is, with this standing in for Beaker."""
+        return f'{self.url}/api/v3/datasets/{identifier}'
+
+    def beaker_info(self, dataset: MockDataset) -> dict:
+        """What the Beaker API would return for this dataset."""
+        info = {
+            'id': dataset.dataset_id,
+            'storage': {
+                'address': self.url,
+                'id': dataset.storage_id,
+                'token': self.tokens.get(dataset.storage_id, 'mock-token'),
+                'tokenExpires': time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                                              time.gmtime(time.time() + 60 * 60))
+            }
+        }
+        if dataset.author_and_name is not None:
+            author, name = dataset.author_and_name.split('/')
+            info.update(author={'name': author}, name=name)
+        return info
+
+    def _fail(self) -> bool:
+        """Should this request fail, given the error rate?"""
+        if self.error_rate <= 0:
+            return False
+        with self._lock:
+            return self._random.random() < self.error_rate
+
+    def _count(self, key: str) -> None:
+        with self._lock:
+            self.request_counts[key] = self.request_counts.get(key, 0) + 1
+
+    def _make_handler(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # keep connections open between requests, like Beaker does
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                super().setup()
+                mock._count('connections')
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                if mock.latency > 0:
+                    time.sleep(mock.latency)
+
+                parsed = urlparse(self.path)
+                if parsed.path.startswith('/api/v3/datasets/'):
+                    mock._count('api')
+                    return self._api(unquote(parsed.path[len('/api/v3/datasets/'):]))
+
+                parts = parsed.path.strip('/').split('/', 3)
+
+                if len(parts) < 3 or parts[0] != 'datasets' or parts[1] not in mock.datasets:
+                    return self._send(404, b'not found')
+                dataset = mock.datasets[parts[1]]
+
+                token = mock.tokens.get(dataset.storage_id, 'mock-token')
+                if self.headers.get('Authorization') != f'Bearer {token}':
+                    mock._count('rejected')
+                    return self._send(403, b'forbidden')
+
+                if parts[2] == 'manifest':
+                    mock._count('manifest')
+                    return self._manifest(dataset, parse_qs(parsed.query))
+                elif parts[2] == 'files' and len(parts) == 4:
+                    mock._count('files')
+                    name = unquote(parts[3])
+                    if name not in dataset.files:
+                        return self._send(404, b'not found')
+                    if mock._fail():
+                        mock._count('errors')
+                        headers = None if mock.error_retry_after is None else \
+                            {'Retry-After': mock.error_retry_after}
+                        return self._send(mock.error_status, b'injected error', headers=headers)
+                    with mock._lock:
+                        mock._files_in_flight += 1
+                        mock.max_files_in_flight = max(mock.max_files_in_flight,
+                                                       mock._files_in_flight)
+                    try:
+                        return self._file(dataset.files[name])
+                    finally:
+                        with mock._lock:
+                            mock._files_in_flight -= 1
+
+                return self._send(404, b'not found')
+
+            def _api(self, identifier: str):
+                if identifier not in mock.api_datasets:
+                    return self._send(404, b'not found')
+                body = json.dumps(mock.beaker_info(mock.api_datasets[identifier]))
+                self._send(200, body.encode('utf-8'), 'application/json')
+
+            def _manifest(self, dataset: MockDataset, query: dict):
+                names = sorted(dataset.files)
+                start = int(query.get('cursor', ['0'])[0])
+                end = start + mock.page_size
+
+                body = {'files': [dataset.manifest_entry(n) for n in names[start:end]]}
+                if end < len(names):
+                    body['cursor'] = str(end)
+                self._send(200, json.dumps(body).encode('utf-8'), 'application/json')
+
+            def _file(self, contents: bytes):
+                etag = f'"{hashlib.md5(contents).hexdigest()}"'
+                byte_range = self.headers.get('Range')
+                with mock._lock:
+                    mock.ranges_requested.append(byte_range)
+
+                if_range = self.headers.get('If-Range')
+                if byte_range is None or not mock.support_ranges or if_range not in (None, etag):
+                    return self._send(200, contents, headers={'ETag': etag})
+
+                start, end = byte_range[len('bytes='):].split('-')
+                start = int(start)
+                end = len(contents) - 1 if end == '' else min(int(end), len(contents) - 1)
+                if start >= len(contents):
+                    return self._send(416, b'',
+                                      headers={'Content-Range': f'bytes */{len(contents)}'})
+
+                self._send(206, contents[start:end + 1], headers={
+                    'ETag': etag,
+                    'Content-Range': f'bytes {start}-{end}/{len(contents)}'
+                })
+
+            def _send(self,
+                      status: int,
+                      body: bytes,
+                      content_type: str = 'application/octet-stream',
+                      headers: Optional[dict] = None):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.send_header('Accept-Ranges', 'bytes')
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+
+                # only files are held to the bandwidth, not API responses or manifests
+                throttle = content_type != 'application/json'
+
+                if mock.drop_after is not None and len(body) > mock.drop_after:
+                    # pretend the connection went away partway through
+                    self._write(body[:mock.drop_after], throttle)
+                    self.wfile.flush()
+                    self.close_connection = True
+                    return
+                self._write(body, throttle)
+
+            def _write(self, body: bytes, throttle: bool):
+                if mock.bandwidth is None or not throttle:
+                    self.wfile.write(body)
+                    return
+
+                # a chunk at a time, keeping to the bandwidth on average
+                start = time.time()
+                chunk_size = max(1, min(64 * 1024, mock.bandwidth // 10))
+                for offset in range(0, len(body), chunk_size):
+                    self.wfile.write(body[offset:offset + chunk_size])
+                    ahead = (offset + chunk_size) / mock.bandwidth - (time.time() - start)
+                    if ahead > 0:
+                        time.sleep(ahead)
+
+        return Handler
@@ -0,0 +1,335 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from pathlib import Path
+from typing import Callable, List, Optional
+
+sys.path.insert(0, str(Path(__file__).absolute().parent.parent))
+
+import beakerstore  # noqa: E402
+
+from beakerstore.beakerstore import Cache, DownloadOptions  # noqa: E402
+from beakerstore.tests.mock_beaker import MockBeaker, MockDataset  # noqa: E402
+
+
+# Benchmarks of beakerstore against a local stand-in for Beaker (see tests/mock_beaker.py), so
+# that they can run anywhere, and the numbers don't depend on the network.
+#
+#   python benchmarks/run.py --output report.json
+#
+# The report is JSON, so that runs can be compared to find regressions. The stand-in can be
+# slowed down to be more like the real thing with --latency and --bandwidth, and made to fail
+# some of the time with --error-rate.
+
+
+def make_dataset(mock: MockBeaker, dataset_id: str, num_files: int, file_size: int) -> MockDataset:
+    files = {f'file{i:05}.bin': os.urandom(file_size) for i in range(num_files)}
+    dataset = MockDataset(dataset_id, files)
+    mock.add_dataset(dataset)
+    return dataset
+
+
+def timed(f: Callable[[], object]) -> float:
+    start = time.perf_counter()
+    f()
+    return time.perf_counter() - start
+
+
+def summary(seconds: List[float]) -> dict:
+    return {
+        'runs': len(seconds),
+        'median_s': statistics.median(seconds),
+        'min_s': min(seconds),
+        'max_s': max(seconds)
+    }
+
+
+def bench_latency(mock: MockBeaker, workdir: Path, repeat: int) -> dict:
+    """How long path() takes when the item isn't cached (cold), and when it is (warm)."""
+    dataset = make_dataset(mock, 'ds_latency', num_files=10, file_size=1024)
+    results = {}
+    for name, given_path in (('dataset', dataset.dataset_id),
+                             ('file', f'{dataset.dataset_id}/file00000.bin')):
+        cold = []
+        warm = []
+        for i in range(repeat):
+            cache = Cache(Path(tempfile.mkdtemp(dir=str(workdir))))
+            cold.append(timed(lambda: beakerstore.path(given_path, cache=cache)))
+            warm.extend(timed(lambda: beakerstore.path(given_path, cache=cache)) for _ in range(10))
+
+            # before the cache is cleaned up, rather than when the benchmarks exit
+            cache.index().flush_accesses()
+        results[name] = {'cold': summary(cold), 'warm': summary(warm)}
+    return results
+
+
+def bench_import(mock: MockBeaker, workdir: Path, repeat: int) -> dict:
+    """How long 'import beakerstore' takes in a new process, and what a warm lookup imports."""
+    root = str(Path(__file__).absolute().parent.parent)
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.check_call([sys.executable, '-c', 'import beakerstore'], cwd=root)
+        seconds.append(time.perf_counter() - start)
+
+    # a process that starts with the item already in the cache shouldn't need the HTTP stack
+    dataset = make_dataset(mock, 'ds_import', num_files=1, file_size=1024)
+    cache_dir = tempfile.mkdtemp(dir=str(workdir))
+    beakerstore.path(dataset.dataset_id, cache=Cache(Path(cache_dir)))
+    code = ('import json, sys; from pathlib import Path; import beakerstore; '
+            'from beakerstore.beakerstore import Cache; '
+            f'beakerstore.path("{dataset.dataset_id}", cache=Cache(Path({cache_dir!r}))); '
+            'print(json.dumps([m for m in ("requests", "urllib3", "ssl") if m in sys.modules]))')
+    imported = json.loads(subprocess.check_output([sys.executable, '-c', code], cwd=root))
+    mock.remove_dataset(dataset)
+
+    baseline = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.check_call([sys.executable, '-c', 'pass'])
+        baseline.append(time.perf_counter() - start)
+
+    return {
+        'process': summary(seconds),
+        'bare_interpreter': summary(baseline),
+        'import_s': statistics.median(seconds) - statistics.median(baseline),
+        'warm_lookup_imported': imported
+    }
+
+
+def bench_throughput(mock: MockBeaker,
+                     workdir: Path,
+                     file_counts: List[int],
+                     file_sizes: List[int],
+                     max_total: int,
+                     options: DownloadOptions) -> List[dict]:
+    """How fast a whole dataset is downloaded, by how many files it has and how big they are."""
+    results = []
+    for num_files in file_counts:
+        for file_size in file_sizes:
+            if num_files * file_size > max_total:
+                continue
+            dataset = make_dataset(mock, f'ds_{num_files}x{file_size}', num_files, file_size)
+            cache = Cache(Path(tempfile.mkdtemp(dir=str(workdir))))
+            result = {'num_files': num_files, 'file_size': file_size}
+            try:
+                seconds = timed(lambda: beakerstore.path(dataset.dataset_id, cache=cache,
+                                                         options=options))
+            except Exception as e:
+                result['error'] = repr(e)
+            else:
+                total = num_files * file_size
+                result.update(seconds=seconds,
+                              mib_per_s=total / (1024 * 1024) / seconds,
+                              files_per_s=num_files / seconds)
+            results.append(result)
+            mock.remove_dataset(dataset)
+    return results
+
+
+def bench_contention(mock: MockBeaker,
+                     workdir: Path,
+                     process_counts: List[int],
+                     num_files: int) -> List[dict]:
+    """How long it takes N processes that share a cache to all get the same dataset."""
+    results = []
+    for num_processes in process_counts:
+        dataset = make_dataset(mock, f'ds_contention{num_processes}', num_files,
+                               file_size=64 * 1024)
+        cache_dir = tempfile.mkdtemp(dir=str(workdir))
+        files_before = mock.request_counts.get('files', 0)
+
+        # the processes all start at the same time, once they are all up
+        start_at = time.time() + 1. + 0.1 * num_processes
+        env = dict(os.environ, AI2_BEAKERSTORE_BEAKER_URL=mock.url)
+        command = [sys.executable, __file__, '--worker', cache_dir, dataset.dataset_id,
+                   str(start_at)]
+        workers = [subprocess.Popen(command, env=env, stdout=subprocess.PIPE)
+                   for _ in range(num_processes)]
+        outputs = [json.loads(w.communicate()[0]) for w in workers]
+
+        seconds = [o['seconds'] for o in outputs if 'seconds' in o]
+        result = {
+            'num_processes': num_processes,
+            'num_files': num_files,
+            'errors': [o['error'] for o in outputs if 'error' in o],
+            'file_requests': mock.request_counts.get('files', 0) - files_before,
+        }
+        if seconds:
+            finished_at = max(o['finished_at'] for o in outputs if 'seconds' in o)
+            result.update(summary(seconds), wall_s=finished_at - start_at)
+        results.append(result)
+        mock.remove_dataset(dataset)
+    return results
+
+
+def bench_writes(mock: MockBeaker, workdir: Path, file_size: int, repeat: int) -> List[dict]:
+    """How fast one large file is downloaded, and how much CPU time that takes, for each way of
+    writing it to disk (see DownloadOptions).
+
+    Each download is done by a process of its own, so that its CPU time is beakerstore's alone,
+    not the stand-in's too.
+    """
+    dataset = make_dataset(mock, 'ds_writes', num_files=1, file_size=file_size)
+    given_path = f'{dataset.dataset_id}/file00000.bin'
+    configs = {
+        # as it used to be: iter_content() and file.write(), 256KiB at a time
+        'iter_content': {'iter_content': True},
+        # the same fixed chunk size, but read into a buffer that is used over and over
+        'fixed_chunks': {'write_buffers': 0, 'min_chunk_size': 256 * 1024,
+                         'max_chunk_size': 256 * 1024},
+        'adaptive_chunks': {'write_buffers': 0},
+        'write_thread': {'write_buffers': 4},
+        'write_thread_preallocated': {'write_buffers': 4, 'preallocate': True, 'fadvise': True},
+        'mapped_writes': {'mapped_writes': True},
+    }
+
+    results = []
+    env = dict(os.environ, AI2_BEAKERSTORE_BEAKER_URL=mock.url)
+    for name, config in configs.items():
+        outputs = []
+        for _ in range(repeat):
+            cache_dir = tempfile.mkdtemp(dir=str(workdir))
+            command = [sys.executable, __file__, '--download-worker', cache_dir, given_path,
+                       json.dumps(config)]
+            outputs.append(json.loads(subprocess.check_output(command, env=env)))
+            shutil.rmtree(cache_dir)
+
+        seconds = [o['seconds'] for o in outputs]
+        cpu_seconds = [o['cpu_seconds'] for o in outputs]
+        results.append(dict(
+            summary(seconds),
+            config=name,
+            options=config,
+            file_size=file_size,
+            mib_per_s=file_size / (1024 * 1024) / statistics.median(seconds),
+            cpu_s_per_gib=statistics.median(cpu_seconds) / (file_size / (1024 * 1024 * 1024))))
+    mock.remove_dataset(dataset)
+    return results
+
+
+def download_worker(cache_dir: str, given_path: str, config: str) -> None:
+    """What each of the processes in bench_writes runs."""
+    config = json.loads(config)
+    iter_content = config.pop('iter_content', False)
+    options = DownloadOptions(segment_threshold=None, **config)
+    cache = Cache(Path(cache_dir))
+
+    # the HTTP stack is loaded up front, so that it isn't counted
+    import beakerstore.http  # noqa: F401
+
+    if iter_content:
+        # the buffered ways of writing are only used for responses they can read into
+        def body_is_not_file(res) -> bool:
+            return False
+        beakerstore.beakerstore._body_is_file = body_is_not_file
+
+    before = resource.getrusage(resource.RUSAGE_SELF)
+    seconds = timed(lambda: beakerstore.path(given_path, cache=cache, options=options))
+    after = resource.getrusage(resource.RUSAGE_SELF)
+    cpu_seconds = (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime)
+    print(json.dumps({'seconds': seconds, 'cpu_seconds': cpu_seconds}))
+
+
+def worker(cache_dir: str, dataset_id: str, start_at: float) -> None:
+    """What each of the processes in bench_contention runs."""
+    cache = Cache(Path(cache_dir))
+    time.sleep(max(0., start_at - time.time()))
+    try:
+        seconds = timed(lambda: beakerstore.path(dataset_id, cache=cache))
+        output = {'seconds': seconds, 'finished_at': time.time()}
+    except Exception as e:
+        output = {'error': repr(e)}
+    print(json.dumps(output))
+
+
+def main(args: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(
+        description='Benchmarks beakerstore against a local stand-in for Beaker.')
+    parser.add_argument('--output', help='where to write the report. Printed if not given.')
+    parser.add_argument('--quick', action='store_true', help='smaller, faster runs')
+    parser.add_argument('--latency', type=float, default=0., help='seconds before each response')
+    parser.add_argument('--bandwidth', type=int, help='bytes per second for each file response')
+    parser.add_argument('--error-rate', type=float, default=0.,
+                        help='fraction of file requests that fail')
+    parser.add_argument('--max-workers', type=int, default=8)
+    parser.add_argument('--mapped-writes', action='store_true',
+                        help='write downloads through memory maps (see DownloadOptions)')
+    parser.add_argument('--worker', nargs=3, help=argparse.SUPPRESS)
+    parser.add_argument('--download-worker', nargs=3, help=argparse.SUPPRESS)
+    parsed = parser.parse_args(args)
+
+    # logging every file that is downloaded would get in the way
+    logging.getLogger('beakerstore').setLevel(logging.WARNING)
+
+    if parsed.worker is not None:
+        cache_dir, dataset_id, start_at = parsed.worker
+        worker(cache_dir, dataset_id, float(start_at))
+        return
+    if parsed.download_worker is not None:
+        download_worker(*parsed.download_worker)
+        return
+
+    kib = 1024
+    mib = 1024 * kib
+    if parsed.quick:
+        repeat = 3
+        file_counts = [1, 100]
+        file_sizes = [kib, mib]
+        max_total = 64 * mib
+        process_counts = [1, 4]
+        large_file_size = 64 * mib
+    else:
+        repeat = 10
+        file_counts = [1, 10, 100, 1000]
+        file_sizes = [kib, 64 * kib, mib, 16 * mib]
+        max_total = 512 * mib
+        process_counts = [1, 2, 4, 8, 16]
+        large_file_size = 512 * mib
+
+    mock = MockBeaker(page_size=1000)
+    mock.latency = parsed.latency
+    mock.bandwidth = parsed.bandwidth
+    mock.error_rate = parsed.error_rate
+    mock.start()
+    os.environ['AI2_BEAKERSTORE_BEAKER_URL'] = mock.url
+
+    options = DownloadOptions(max_workers=parsed.max_workers, mapped_writes=parsed.mapped_writes)
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            report = {
+                'beakerstore_version': beakerstore.__version__,
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'started_at': time.time(),
+                'config': {k: v for k, v in vars(parsed).items()
+                           if k not in ('output', 'worker', 'download_worker')},
+                'latency': bench_latency(mock, Path(workdir), repeat),
+                'import': bench_import(mock, Path(workdir), repeat),
+                'throughput': bench_throughput(mock, Path(workdir), file_counts, file_sizes,
+                                               max_total, options),
+                'contention': bench_contention(mock, Path(workdir), process_counts, num_files=50),
+                'writes': bench_writes(mock, Path(workdir), large_file_size, repeat),
+            }
+    finally:
+        mock.stop()
+
+    report_json = json.dumps(report, indent=2)
+    if parsed.output is None:
+        print(report_json)
+    else:
+        Path(parsed.output).write_text(report_json)
+
+
+if __name__ == '__main__':
+    main()
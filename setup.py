@@ -17,5 +17,8 @@ setup(
     python_requires='>=3',
     install_requires=[
         'requests >= 2.22.0'
-    ]
+    ],
+    entry_points={
+        'console_scripts': ['beakerstore-prefetch = beakerstore.prefetch:main']
+    }
 )